@@ -3,120 +3,118 @@ Simple Gradio app to preview the preliminary results for retrieving nature repre
 Code by Michela Vignoli partially generated with Chat GPT3, GPT4 (free version), and Claude (free version).
 """
 
-# Import packages
-import gradio as gr
-import pandas as pd
-from difflib import SequenceMatcher
+# Import packages (pandas and gradio are imported only when they are needed)
+import json
+import os
+import pickle
 import re
-
-# Import results
-results_clean = pd.read_csv("data/retrieval_results/sonnini_cleaned/i_onit-sonnini-DHd2025-clean-q_Pferd, Pferde.csv").head(100)
-results_prep = pd.read_csv("data/retrieval_results/sonnini_llm_corrected/i_onit-sonnini-DHd2025-prep-q_Pferd, Pferde.csv").head(100)
-results_orig = pd.read_csv("data/retrieval_results/sonnini_original_ocr/i_onit-test-index-sonnini-q_Pferd-Pferde.csv").head(100)
-annotations = pd.read_csv("data/annotations/DHd2025_referenceReports_annotations_preview_horses.csv")
-
-# Drop 'text_prep' from results_orig
-results_clean.drop(columns=['text_prep'], inplace=True)
-
-# Modify the "document" column to remove "_page175.txt" and keep the "Z166069305_00175"
-results_orig['document'] = results_orig['document'].str[:-12]
-
-# Modify the "page" column to extract the numeric part and remove leading zeroes
-results_orig['page'] = results_orig['page'].str.extract(r'(\d+)', expand=False).astype(int)
-
-data_sources = {"Results Cleaned OCR": results_clean, "Results LLM Preprocessed OCR": results_prep, "Results Original OCR": results_orig, "Annotations": annotations}
+import time
+from functools import lru_cache
+from highlight_alignment import highlight_text
+
+start_time = time.perf_counter()
+
+# Results
+source_files = {
+    "Results Cleaned OCR": "data/retrieval_results/sonnini_cleaned/i_onit-sonnini-DHd2025-clean-q_Pferd, Pferde.csv",
+    "Results LLM Preprocessed OCR": "data/retrieval_results/sonnini_llm_corrected/i_onit-sonnini-DHd2025-prep-q_Pferd, Pferde.csv",
+    "Results Original OCR": "data/retrieval_results/sonnini_original_OCR/i_onit-test-index-sonnini-q_Pferd-Pferde.csv",
+    "Annotations": "data/annotations/DHd2025_referenceReports_annotations_preview_horses.csv",
+}
+
+# Prepared data sources, rebuilt whenever a result file changes
+cache_file = "data/retrieval_results/explorer_cache.pickle"
+CACHE_VERSION = 2
+
+# Columns shown in the app
+COLUMNS = ["document", "barcode", "page", "iiif_link", "_score", "rank", "unpacked_highlights", "text_prep", "text_clean", "text", "chunk_offsets"]
+
+# Page text shown in the details, in order of preference
+TEXT_FIELDS = ["text_prep", "text_clean", "text"]
+
+def prepare_data_sources():
+    """Read the result files and return every data source as a list of rows (dicts)."""
+    import pandas as pd
+
+    # Import results
+    results_clean = pd.read_csv(source_files["Results Cleaned OCR"])
+    results_prep = pd.read_csv(source_files["Results LLM Preprocessed OCR"])
+    results_orig = pd.read_csv(source_files["Results Original OCR"])
+    annotations = pd.read_csv(source_files["Annotations"])
+
+    # Drop 'text_prep' from results_orig
+    results_clean.drop(columns=['text_prep'], inplace=True)
+
+    # Modify the "document" column to remove "_page175.txt" and keep the "Z166069305_00175"
+    results_orig['document'] = results_orig['document'].str[:-12]
+
+    # Modify the "page" column to extract the numeric part and remove leading zeroes
+    results_orig['page'] = results_orig['page'].str.extract(r'(\d+)', expand=False).astype(int)
+
+    frames = {"Results Cleaned OCR": results_clean, "Results LLM Preprocessed OCR": results_prep, "Results Original OCR": results_orig, "Annotations": annotations}
+    return {name: frame[[column for column in COLUMNS if column in frame]].to_dict('records') for name, frame in frames.items()}
+
+def load_data_sources():
+    """Return the data sources from the cache file if it is up to date, otherwise prepare them and update the cache."""
+    mtimes = {path: os.stat(path).st_mtime_ns for path in source_files.values()}
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+        if cache["version"] == CACHE_VERSION and cache["mtimes"] == mtimes:
+            return cache["data_sources"], True
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    data_sources = prepare_data_sources()
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({"version": CACHE_VERSION, "mtimes": mtimes, "data_sources": data_sources}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return data_sources, False
+
+data_sources, from_cache = load_data_sources()
+
+# Index from document name to row position for each data source (first row per document)
+document_index = {name: {} for name in data_sources}
+for name, data_source in data_sources.items():
+    for position, document in enumerate(row['document'] for row in data_source):
+        document_index[name].setdefault(document, position)
 
 # Pagination settings
 R = 5  # Number of preview rows per page
 
-def normalize_text(text):
-    """Normalize text for better matching by removing extra whitespace and standardizing characters."""
-    # Remove extra whitespace
-    text = ' '.join(text.split())
-    # Could add more normalization steps here if needed
-    return text
-
-def find_best_match(needle, haystack):
-    """Find the best matching position of needle in haystack using fuzzy matching."""
-    matcher = SequenceMatcher(None, needle, haystack)
-    matches = matcher.get_matching_blocks()
-    
-    # Find the best match that exceeds our threshold
-    best_match = None
-    best_match_ratio = 0.5  # Initialize the best match ratio with our minimum threshold
-    
-    for match in matches:
-        i, j, n = match
-        if n > 0:  # Only consider non-zero length matches
-            subsequence = haystack[j:j+n]
-            ratio = SequenceMatcher(None, needle, subsequence).ratio()
-            if ratio > best_match_ratio:
-                best_match = (j, j+n)
-                best_match_ratio = ratio
-    
-    return best_match
-
-def highlight_text(text, highlights):
-    """
-    Highlight specified text segments using fuzzy matching and HTML mark tags.
-    
-    Args:
-        text (str): The original text to highlight
-        highlights (str or list): Text segment(s) to highlight
-    
-    Returns:
-        str: Text with highlights wrapped in <mark> tags
-    """
-    if not text or not highlights:
-        return text
-    
-    # Ensure highlights is a list
-    if isinstance(highlights, str):
-        highlights = [highlights]
-    
-    # Remove empty or None highlights
-    highlights = [h for h in highlights if h]
-    if not highlights:
-        return text
-    
-    # Sort highlights by length (longest first) to avoid nested highlights
-    highlights = sorted(highlights, key=len, reverse=True)
-    
-    # Store positions to highlight
-    positions_to_highlight = []
-    
-    # Find positions for each highlight
-    for highlight in highlights:
-        normalized_highlight = normalize_text(highlight)
-        normalized_text = normalize_text(text)
-        
-        match = find_best_match(normalized_highlight, normalized_text)
-        if match:
-            start, end = match
-            # Convert positions back to original text
-            original_start = len(text[:start].rstrip())
-            original_end = original_start + len(text[start:end].strip())
-            positions_to_highlight.append((original_start, original_end))
-    
-    # Sort positions by start position
-    positions_to_highlight.sort()
-    
-    # Apply highlights from end to start to avoid position shifting
-    for start, end in reversed(positions_to_highlight):
-        text = f"{text[:start]}<mark>{text[start:end]}</mark>{text[end:]}"
-    
-    return text
-
-# Function to create preview rows
+# Number of rendered preview pages and highlighted pages kept in memory
+PREVIEW_CACHE_SIZE = 1024
+HIGHLIGHT_CACHE_SIZE = 256
+
+def page_count(selected_data_source):
+    return max(1, -(-len(data_sources[selected_data_source]) // R))
+
+def find_row(document_name, selected_data_source):
+    """Return the row of a document in a data source, or None."""
+    position = document_index[selected_data_source].get(document_name)
+    if position is None:
+        return None
+    return data_sources[selected_data_source][position]
+
+def chunk_lookup(row, field):
+    """Return a dict from the text of every indexed chunk of a field to its offsets (from 'chunk_offsets', see src/indexing/sentence_chunker.py)."""
+    if not isinstance(row.get('chunk_offsets'), str):
+        return {}
+    text = row[field]
+    return {text[start:end]: (start, end) for start, end in json.loads(row['chunk_offsets']).get(field, [])}
+
+# Function to create preview rows, cached per (page, data source)
+@lru_cache(maxsize=PREVIEW_CACHE_SIZE)
 def preview_results(page, selected_data_source):
     data_source = data_sources[selected_data_source]
     start_idx = (page - 1) * R
     end_idx = min(start_idx + R, len(data_source))
     
-    results = data_source.iloc[start_idx:end_idx]
+    results = data_source[start_idx:end_idx]
 
     row_elements = []
-    for idx, (_, row) in enumerate(results.iterrows(), start=start_idx + 1):
+    for idx, row in enumerate(results, start=start_idx + 1):
         highlighted_text = row['unpacked_highlights']
         # Highlight "Pferd" and "Pferde" using a span with a yellow background
         highlighted_text = re.sub(r'\b(Pferd\w*)\b', r"<span style='background-color: yellow; font-weight: bold;'>\1</span>", highlighted_text, flags=re.IGNORECASE)
@@ -130,21 +128,28 @@ def preview_results(page, selected_data_source):
 
     return "".join(row_elements)
 
+# Highlighted page text, cached per (document, data source)
+@lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)
+def highlighted_page(document_name, selected_data_source):
+    row = find_row(document_name, selected_data_source)
+    field = next((field for field in TEXT_FIELDS if row.get(field)), None)
+    if field is None:
+        return row.get('text')
+    return highlight_text(row[field], row["unpacked_highlights"], chunk_lookup(row, field))
+
 # Function to show details of a selected row
 def show_details(document_name, selected_data_source):
-    data_source = data_sources[selected_data_source]
-    row = data_source[data_source["document"] == document_name]
+    row = find_row(document_name, selected_data_source)
     
-    if row.empty:
+    if row is None:
         return "<p style='color:red;'>Document not found. Please select a valid document.</p>"
 
-    row = row.iloc[0]  # Extract first matching row
     return f"""
     <div style="display: flex; justify-content: space-between; align-items: start;">
         <div style="width: 65%; font-size: 18px;">
             <h3>📄 Preview: {document_name}</h3>
             <p><b>Retrieved text chunk: </b><i>{row["unpacked_highlights"]}</i></p>
-            <p><b>Text on page {row['page']}: </b>{highlight_text(row.get('text_prep') or row.get('text_clean') or row.get('text'), row["unpacked_highlights"])}</p>
+            <p><b>Text on page {row['page']}: </b>{highlighted_page(document_name, selected_data_source)}</p>
             <p><a href="https://digital.onb.ac.at/OnbViewer/viewer.faces?doc=ABO_%2B{row['barcode']}&order={row['page']}&view=SINGLE" target="_blank">🔍 Open ÖNB Viewer</a></p>
         </div>
         <div style="width: 30%; text-align: right;">
@@ -158,12 +163,17 @@ def show_details(document_name, selected_data_source):
     </div>
     """
 
+print(f"Loaded {sum(len(data_source) for data_source in data_sources.values())} results "
+      f"from {cache_file if from_cache else 'the result files'} in {time.perf_counter() - start_time:.3f} s")
+
 # Gradio Interface
+import gradio as gr
+
 with gr.Blocks() as demo:
     gr.Markdown("""
                 ## 🔍 Preview Text Retrieval Results with Marqo Vector Database
                 <div style="font-size: 18px;">
-                <p><b>Instructions:</b> Browse through the retrieval results for the text prompt <i>"Pferd, Pferde"</i> by sliding the page slider (up to 100 first retrieval results can be inspected). 
+                <p><b>Instructions:</b> Browse through the retrieval results for the text prompt <i>"Pferd, Pferde"</i> by sliding the page slider (all retrieval results can be inspected). 
                 Select the data source: Choose between <i>Results Cleaned OCR, Results LLM Preprocessed OCR, Results Original OCR,</i> and our <i>Annotations</i> of text passages mentioning <i>horses and kindred animals</i> in the text. 
                 To visualise details about the retrieved text chunk, copy and paste the document name (e.g. <i>Z166069305_430</i>) in the search bar below and click on the <i>Inspect</i> button. 
                 Please note that pressing <i>Enter</i> does not work. 
@@ -171,7 +181,7 @@ with gr.Blocks() as demo:
                 </div>""")
 
     data_source_dropdown = gr.Dropdown(choices=list(data_sources.keys()), label="Select Data Source", value="Results Cleaned OCR")
-    page_slider = gr.Slider(1, 1, step=1, label="Page", interactive=True)
+    page_slider = gr.Slider(1, page_count("Results Cleaned OCR"), step=1, label="Page", interactive=True)
     preview_output = gr.HTML()
 
     gr.Markdown("## 📝 Inspect Document Details")
@@ -182,13 +192,12 @@ with gr.Blocks() as demo:
 
     # Function to update preview when data source changes
     def update_data_source(selected_data_source):
-        max_page = (len(data_sources[selected_data_source]) // R) + 1
-        page_slider.maximum = max_page  # Update the max page count dynamically
-        return preview_results(1, selected_data_source), 1  # Reset slider to 1
+        # Update the max page count and reset slider to 1
+        return preview_results(1, selected_data_source), gr.update(maximum=page_count(selected_data_source), value=1)
 
     # Function to update preview when page slider changes
     def update_preview(page, selected_data_source):
-        return preview_results(page, selected_data_source)
+        return preview_results(int(page), selected_data_source)
 
     # Function to update document details
     def update_details(doc_name, selected_data_source):
@@ -207,7 +216,7 @@ with gr.Blocks() as demo:
     inspect_button.click(update_details, inputs=[doc_name_input, data_source_dropdown], outputs=[inspect_output])
 
     # Initialize preview with default data source
-    preview_output.value = update_data_source("Results Cleaned OCR")
+    preview_output.value = preview_results(1, "Results Cleaned OCR")
     
     # Further information block at the end
     gr.Markdown("""
@@ -225,4 +234,5 @@ with gr.Blocks() as demo:
     </div>
     """)
 
+print(f"Interface ready after {time.perf_counter() - start_time:.3f} s")
 demo.launch()
\ No newline at end of file
@@ -0,0 +1,315 @@
+"""
+Fast fuzzy alignment of retrieved text chunks (highlights) to the page text, used by explore_retrieval_results.py.
+
+The page is normalized once, keeping a map from every normalized character to its position in the original text.
+A highlight is located by exact search first; otherwise character n-grams of the highlight are looked up in an n-gram
+index of the page, and the seed hits vote for alignment diagonals. Around the best diagonals the seeds are chained into
+anchors and the alignment is verified by an edit distance restricted to the band between consecutive anchors, so only
+small pieces of the page are ever compared character by character.
+
+highlight_text marks the highlights of a result in the page text with <mark> tags, looking up indexed chunks by their
+offsets and aligning all other highlights with a PageAligner.
+
+Run this file to benchmark the per-page latency on the longest pages of the retrieval results against the previous
+SequenceMatcher implementation:
+    python highlight_alignment.py
+
+Code by Michela Vignoli.
+"""
+
+import re
+from collections import Counter, defaultdict
+
+SEED_LENGTH = 6
+# Seeds that occur more often than this on a page (e.g. ' der ') carry no information about the position
+MAX_SEED_OCCURRENCES = 64
+# Width of the diagonal ranges seed hits vote for
+DIAGONAL_BUCKET = 32
+# Band around the diagonal for the edit distance between two anchors; consecutive anchors may also drift apart by this
+# much plus a quarter of their distance (insertions and deletions in the OCR)
+GAP_BAND = 8
+# Number of candidate diagonals verified per highlight
+CANDIDATES = 3
+# Minimum similarity (1 - edit distance / highlight length) of an accepted match
+MIN_RATIO = 0.5
+
+WORD_PATTERN = re.compile(r'\S+')
+
+
+def normalize_text(text):
+    """Normalize text for better matching by removing extra whitespace."""
+    return ' '.join(text.split())
+
+
+def normalize_with_offsets(text):
+    """Normalize text like normalize_text and return the position in text of every normalized character."""
+    parts = []
+    offsets = []
+    for match in WORD_PATTERN.finditer(text):
+        if parts:
+            parts.append(' ')
+            offsets.append(match.start() - 1)
+        parts.append(match.group())
+        offsets.extend(range(match.start(), match.end()))
+    return ''.join(parts), offsets
+
+
+def banded_edit_distance(a, b, band=GAP_BAND):
+    """
+    Levenshtein distance between a and b, computed only within band cells of the diagonal (plus the length difference).
+    Alignments that leave the band are not considered, so the result is an upper bound that is exact for similar strings.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    band += len(a) - len(b)
+    infinity = len(a) + len(b) + 1
+    previous = [j if j <= band else infinity for j in range(len(b) + 1)]
+    for i, char in enumerate(a, start=1):
+        current = [i if i <= band else infinity] + [infinity] * len(b)
+        for j in range(max(1, i - band), min(len(b), i + band) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != b[j - 1]))
+        previous = current
+    return previous[-1]
+
+
+def prefix_edit_distance(needle, haystack, band=GAP_BAND):
+    """
+    Align the whole needle to the best prefix of haystack, within band cells of the diagonal.
+
+    Returns:
+    - tuple: (edit distance, length of the haystack prefix).
+    """
+    haystack = haystack[:len(needle) + band]
+    infinity = len(needle) + len(haystack) + 1
+    previous = [j if j <= band else infinity for j in range(len(haystack) + 1)]
+    for i, char in enumerate(needle, start=1):
+        current = [i if i <= band else infinity] + [infinity] * len(haystack)
+        for j in range(max(1, i - band), min(len(haystack), i + band) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != haystack[j - 1]))
+        previous = current
+    length = min(range(len(previous)), key=lambda j: (previous[j], abs(j - len(needle))))
+    return previous[length], length
+
+
+class PageAligner:
+    """Locates highlights in one page; build it once per page and reuse it for all highlights of the page."""
+
+    def __init__(self, text):
+        self.text = text
+        self.normalized, self.offsets = normalize_with_offsets(text)
+        self._seed_index = {}
+
+    def _seeds(self, seed_length):
+        if seed_length not in self._seed_index:
+            index = defaultdict(list)
+            for position in range(len(self.normalized) - seed_length + 1):
+                index[self.normalized[position:position + seed_length]].append(position)
+            self._seed_index[seed_length] = index
+        return self._seed_index[seed_length]
+
+    def find(self, highlight):
+        """Return the (start, end) span of the best match in the normalized page, or None."""
+        needle = normalize_text(highlight)
+        if not needle or not self.normalized:
+            return None
+
+        position = self.normalized.find(needle)
+        if position >= 0:
+            return position, position + len(needle)
+
+        # Seed hits vote for the diagonal (start of the highlight in the page) they lie on
+        seed_length = min(SEED_LENGTH, max(2, len(needle) // 4))
+        seeds = self._seeds(seed_length)
+        hits = []
+        votes = Counter()
+        for i in range(len(needle) - seed_length + 1):
+            positions = seeds.get(needle[i:i + seed_length], ())
+            if len(positions) <= MAX_SEED_OCCURRENCES:
+                for position in positions:
+                    hits.append((i, position))
+                    votes[(position - i) // DIAGONAL_BUCKET] += 1
+
+        # Chain the seeds outwards from the best diagonals and verify the chains
+        best = None
+        chains = set()
+        for diagonal_bucket, _ in votes.most_common(CANDIDATES):
+            core = [hit for hit in hits if (hit[1] - hit[0]) // DIAGONAL_BUCKET == diagonal_bucket]
+            pivot = core[len(core) // 2]
+            before = [hit for hit in reversed(hits) if hit[0] < pivot[0]]
+            after = [hit for hit in hits if hit[0] > pivot[0]]
+            anchors = self._chain(pivot, before, seed_length)[::-1] + self._chain(pivot, after, seed_length)[1:]
+            if tuple(anchors) in chains:
+                continue
+            chains.add(tuple(anchors))
+            max_distance = len(needle) * (1 - MIN_RATIO) if best is None else best[0]
+            alignment = self._verify(needle, anchors, seed_length, max_distance)
+            if alignment is not None:
+                best = alignment
+
+        if best is None or 1 - best[0] / len(needle) <= MIN_RATIO:
+            return None
+        _, start, end = best
+        return start, end
+
+    @staticmethod
+    def _chain(pivot, hits, seed_length):
+        """
+        Follow the seed hits (ordered by needle position, forwards or backwards) from pivot, keeping non-overlapping
+        hits whose diagonal stays close to the diagonal of the previous anchor.
+        """
+        anchors = [pivot]
+        for i, position in hits:
+            last_i, last_position = anchors[-1]
+            distance = abs(i - last_i)
+            if distance < seed_length or abs(position - last_position) < seed_length:
+                continue
+            if (i > last_i) != (position > last_position):
+                continue
+            if abs((position - i) - (last_position - last_i)) <= GAP_BAND + distance // 4:
+                anchors.append((i, position))
+        return anchors
+
+    def _verify(self, needle, anchors, seed_length, max_distance):
+        """
+        Return (edit distance, start, end) of the alignment of needle through the anchors (exact seed matches), or None
+        as soon as the edit distance exceeds max_distance.
+        """
+        text = self.normalized
+
+        # Extend from the first anchor to the start of the needle (aligning the reversed strings)
+        first_i, first_position = anchors[0]
+        head = needle[:first_i]
+        window = max(0, first_position - len(head) - GAP_BAND)
+        distance, length = prefix_edit_distance(head[::-1], text[window:first_position][::-1])
+        start = first_position - length
+
+        # Only the gaps between consecutive anchors have to be compared character by character
+        for (i, position), (next_i, next_position) in zip(anchors, anchors[1:]):
+            gap = needle[i + seed_length:next_i]
+            text_gap = text[position + seed_length:next_position]
+            if distance + abs(len(gap) - len(text_gap)) > max_distance:
+                return None
+            distance += banded_edit_distance(gap, text_gap)
+
+        # Extend from the last anchor to the end of the needle
+        last_i, last_position = anchors[-1]
+        tail = needle[last_i + seed_length:]
+        tail_start = last_position + seed_length
+        tail_distance, length = prefix_edit_distance(tail, text[tail_start:])
+        distance += tail_distance
+        if distance > max_distance:
+            return None
+        return distance, start, tail_start + length
+
+    def find_original(self, highlight):
+        """Return the (start, end) span of the best match in the original page text, or None."""
+        match = self.find(highlight)
+        if match is None or match[0] >= match[1]:
+            return None
+        start, end = match
+        return self.offsets[start], self.offsets[end - 1] + 1
+
+
+def highlight_text(text, highlights, chunks=None):
+    """
+    Highlight specified text segments using HTML mark tags. Segments that are indexed chunks of the text are looked up
+    by their offsets, others are located with fuzzy matching.
+    
+    Args:
+        text (str): The original text to highlight
+        highlights (str or list): Text segment(s) to highlight
+        chunks (dict): Offsets of the indexed chunks of the text, from chunk_lookup
+    
+    Returns:
+        str: Text with highlights wrapped in <mark> tags
+    """
+    if not text or not highlights:
+        return text
+    
+    # Ensure highlights is a list
+    if isinstance(highlights, str):
+        highlights = [highlights]
+    
+    # Remove empty or None highlights
+    highlights = [h for h in highlights if h]
+    if not highlights:
+        return text
+    
+    # Sort highlights by length (longest first) to avoid nested highlights
+    highlights = sorted(highlights, key=len, reverse=True)
+    
+    # Store positions to highlight
+    positions_to_highlight = []
+    
+    # Find positions for each highlight (for fuzzy matching the page is normalized and indexed only once)
+    aligner = None
+    for highlight in highlights:
+        match = chunks.get(highlight) if chunks else None
+        if match is None:
+            aligner = aligner or PageAligner(text)
+            match = aligner.find_original(highlight)
+        if match:
+            positions_to_highlight.append(match)
+    
+    # Sort positions by start position and drop overlapping matches
+    non_overlapping = []
+    for start, end in sorted(positions_to_highlight):
+        if not non_overlapping or start >= non_overlapping[-1][1]:
+            non_overlapping.append((start, end))
+    positions_to_highlight = non_overlapping
+    
+    # Apply highlights from end to start to avoid position shifting
+    for start, end in reversed(positions_to_highlight):
+        text = f"{text[:start]}<mark>{text[start:end]}</mark>{text[end:]}"
+    
+    return text
+
+
+if __name__ == '__main__':
+    import statistics
+    import time
+    from difflib import SequenceMatcher
+    import pandas as pd
+
+    # Previous implementation, for comparison
+    def find_best_match_difflib(needle, haystack):
+        matcher = SequenceMatcher(None, needle, haystack)
+        best_match = None
+        best_match_ratio = 0.5
+        for i, j, n in matcher.get_matching_blocks():
+            if n > 0:
+                ratio = SequenceMatcher(None, needle, haystack[j:j + n]).ratio()
+                if ratio > best_match_ratio:
+                    best_match = (j, j + n)
+                    best_match_ratio = ratio
+        return best_match
+
+    result_files = [
+        "data/retrieval_results/sonnini_cleaned/i_onit-sonnini-DHd2025-clean-q_Pferd, Pferde.csv",
+        "data/retrieval_results/sonnini_llm_corrected/i_onit-sonnini-DHd2025-prep-q_Pferd, Pferde.csv",
+        "data/retrieval_results/sonnini_original_OCR/i_onit-test-index-sonnini-q_Pferd-Pferde.csv",
+    ]
+    pages = []
+    for result_file in result_files:
+        results = pd.read_csv(result_file)
+        for _, row in results.iterrows():
+            text = row.get('text_prep') if isinstance(row.get('text_prep'), str) else None
+            text = text or (row.get('text_clean') if isinstance(row.get('text_clean'), str) else None) or row.get('text')
+            if isinstance(text, str) and isinstance(row['unpacked_highlights'], str):
+                pages.append((text, row['unpacked_highlights']))
+
+    # The longest pages in the corpus
+    pages = sorted(pages, key=lambda page: len(page[0]), reverse=True)[:20]
+    print(f"Benchmarking {len(pages)} pages of {len(pages[-1][0])}-{len(pages[0][0])} characters")
+
+    for name, align in (
+        ("SequenceMatcher", lambda text, highlight: find_best_match_difflib(normalize_text(highlight),
+                                                                             normalize_text(text))),
+        ("n-gram seeds + banded edit distance", lambda text, highlight: PageAligner(text).find(highlight)),
+    ):
+        latencies = []
+        for text, highlight in pages:
+            start = time.perf_counter()
+            align(text, highlight)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{name:>36}: median {statistics.median(latencies):8.2f} ms, max {max(latencies):8.2f} ms per page")
@@ -0,0 +1,208 @@
+"""
+This script evaluates retrieval results against the text annotations in
+text_annotations_final/ONiT_text_annotations_final.csv and the single-topic annotations in data/annotations/
+(topic_annotation_files, e.g. the pages with horses). A retrieved page counts as relevant for a query if it carries
+an annotation with the query's tag. Results and annotations are joined through an integer (barcode, page) key, and
+recall@k, precision@k, MRR and nDCG@k are computed for all runs at once on a (runs x ranks) hit matrix.
+
+A run is one result file i_<index>-q_<query>.csv (e.g. from batch_query.py); the corpus variant (clean, prep, orig)
+is derived from the index name and the tag from the query (see QUERY_TAGS for queries that are not tag labels).
+Only the annotated pages of the barcodes a run searched count as relevant for it: the barcode filter of the run is read
+from the JSON file that batch_query.py writes next to the result file, or is DEFAULT_FILTER_STRING for result files
+without one. Runs without any relevant page have no metrics (NaN) and are left out of the means.
+
+Usage:
+    python src/analysis/evaluate_retrieval.py [results_dir] [output.csv]
+
+Code by Michela Vignoli.
+"""
+
+import json
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+annotations_file = "text_annotations_final/ONiT_text_annotations_final.csv"
+# Annotations of a single topic and their tag (see load_relevance)
+topic_annotation_files = {
+    "data/annotations/DHd2025_referenceReports_annotations_preview_horses.csv": "horses and kindred animals",
+}
+results_dir = "data/retrieval_results/"
+output_file = "data/retrieval_analysis/retrieval_evaluation.csv"
+
+CUTOFFS = [10, 50, 100]
+
+# Queries that are not tag labels themselves
+QUERY_TAGS = {
+    "Pferd, Pferde": "horses and kindred animals",
+    "Pferd-Pferde": "horses and kindred animals",
+}
+
+# Filter of the result files without run metadata: the results in data/retrieval_results/ were all searched in
+# Sonnini Bd. 1
+DEFAULT_FILTER_STRING = "barcode:(Z166069305)"
+
+RESULT_FILE_PATTERN = re.compile(r'^i_(?P<index>.+?)-q_(?P<query>.+)\.csv$')
+ICONCLASS_PATTERN = re.compile(r'\s+\d[\dA-Z()+.:]*')
+PAGE_PATTERN = re.compile(r'(\d+)')
+BARCODE_FILTER_PATTERN = re.compile(r'barcode:\(([^)]*)\)')
+
+# Keys combine barcode number and page into one integer
+PAGE_FACTOR = 1_000_000
+
+
+def tag_label(tag):
+    """Tag label without Iconclass notation, e.g. 'horses and kindred animals 46C1314' -> 'horses and kindred animals'."""
+    return ' '.join(ICONCLASS_PATTERN.sub(' ', tag.strip().strip("'")).split())
+
+
+def searched_barcodes(filter_string):
+    """Barcodes of the filter string, e.g. 'barcode:(Z166069305) OR barcode:(Z166069408)', or None for all barcodes."""
+    barcodes = [barcode.strip() for values in BARCODE_FILTER_PATTERN.findall(filter_string or '')
+                for barcode in re.split(r'\s+OR\s+|,', values) if barcode.strip()]
+    return sorted(set(barcodes)) if barcodes else None
+
+
+def corpus_variant(index_name):
+    for variant in ("clean", "prep"):
+        if f"-{variant}" in index_name:
+            return variant
+    return "orig"
+
+
+class PageKeys:
+    """Maps (barcode, page) pairs to integer keys."""
+
+    def __init__(self):
+        self.barcodes = {}
+
+    def encode(self, barcodes, pages):
+        barcode_numbers = pd.Series(barcodes, dtype=str).map(
+            lambda barcode: self.barcodes.setdefault(barcode, len(self.barcodes)))
+        # Pages like 430 or '00175_page175.txt' (original OCR index)
+        page_numbers = pd.Series(pages).astype(str).str.extract(PAGE_PATTERN, expand=False).astype(np.int64)
+        return barcode_numbers.to_numpy(np.int64) * PAGE_FACTOR + page_numbers.to_numpy(np.int64)
+
+
+def load_relevance(annotations_file, keys, tag=None):
+    """
+    Return a frame of unique (tag, barcode, key) rows: the annotated pages of every tag.
+    Files without an 'annotation' column, such as data/annotations/DHd2025_referenceReports_annotations_preview_horses.csv,
+    annotate a single topic; pass its tag as tag.
+    """
+    annotations = pd.read_csv(annotations_file)
+    annotations = annotations.rename(columns={"onb_barcode": "barcode"}).dropna(subset=["barcode", "page"])
+    if tag is None:
+        annotations["tag"] = annotations["annotation"].fillna('').str.split("', '")
+        annotations = annotations.explode("tag")
+        annotations["tag"] = annotations["tag"].map(tag_label)
+    else:
+        annotations["tag"] = tag
+    annotations["key"] = keys.encode(annotations["barcode"], annotations["page"])
+    annotations["barcode"] = annotations["barcode"].astype(str)
+    return annotations[["tag", "barcode", "key"]].drop_duplicates()
+
+
+def load_all_relevance(keys):
+    """Relevant pages of the tagged annotations and of all single-topic annotation files."""
+    relevance = [load_relevance(annotations_file, keys)]
+    relevance += [load_relevance(file, keys, tag) for file, tag in topic_annotation_files.items()]
+    return pd.concat(relevance, ignore_index=True).drop_duplicates(ignore_index=True)
+
+
+def load_runs(results_dir, keys, max_rank):
+    """Read all result files below results_dir into one long frame (run, rank, key) and a frame of run metadata."""
+    runs = []
+    ranked = []
+    for folder, _, files in os.walk(results_dir):
+        for file in sorted(files):
+            match = RESULT_FILE_PATTERN.match(file)
+            if not match:
+                continue
+            results = pd.read_csv(os.path.join(folder, file),
+                                  usecols=lambda column: column in {"barcode", "page", "rerank"})
+            if "rerank" not in results:
+                results["rerank"] = np.arange(1, len(results) + 1)
+            results = results[results["rerank"] <= max_rank]
+
+            metadata_path = os.path.join(folder, os.path.splitext(file)[0] + '.json')
+            filter_string = DEFAULT_FILTER_STRING
+            if os.path.exists(metadata_path):
+                with open(metadata_path, 'r', encoding='utf-8') as f:
+                    filter_string = json.load(f).get("filter_string")
+
+            run = len(runs)
+            query = match["query"]
+            runs.append({"run": run, "index": match["index"], "variant": corpus_variant(match["index"]),
+                         "query": query, "tag": QUERY_TAGS.get(query, query), "filter_string": filter_string,
+                         "file": file})
+            ranked.append(pd.DataFrame({"run": run, "rank": results["rerank"].to_numpy(np.int64),
+                                        "key": keys.encode(results["barcode"], results["page"])}))
+
+    runs = pd.DataFrame(runs, columns=["run", "index", "variant", "query", "tag", "filter_string", "file"])
+    ranked = pd.concat(ranked, ignore_index=True) if ranked else pd.DataFrame(columns=["run", "rank", "key"])
+    return runs, ranked
+
+
+def count_relevant(runs, relevance):
+    """Number of pages annotated with the tag of every run in the barcodes the run searched."""
+    per_tag = runs["tag"].map(relevance.groupby("tag").size()).fillna(0)
+
+    # Runs with a barcode filter only count the pages of their barcodes
+    searched = runs[["run", "tag"]].assign(barcode=runs["filter_string"].map(searched_barcodes))
+    searched = searched.dropna(subset=["barcode"]).explode("barcode")
+    per_run = searched.merge(relevance, on=["tag", "barcode"]).groupby("run").size()
+    filtered = runs["run"].isin(searched["run"])
+    return np.where(filtered, runs["run"].map(per_run).fillna(0), per_tag).astype(np.float32)
+
+
+def evaluate(runs, ranked, relevance, cutoffs=CUTOFFS):
+    """Compute recall@k, precision@k, MRR and nDCG@k for every run, NaN for runs without relevant pages."""
+    max_rank = max(cutoffs)
+
+    # Mark retrieved pages that are annotated with the run's tag
+    ranked = ranked.merge(runs[["run", "tag"]], on="run")
+    hits = ranked.merge(relevance[["tag", "key"]], on=["tag", "key"])
+    hit_matrix = np.zeros((len(runs), max_rank), dtype=np.float32)
+    hit_matrix[hits["run"].to_numpy(), hits["rank"].to_numpy() - 1] = 1.0
+
+    n_relevant = count_relevant(runs, relevance)
+    cumulative_hits = np.cumsum(hit_matrix, axis=1)
+    discounts = 1.0 / np.log2(np.arange(2, max_rank + 2))
+    ideal_dcg = np.concatenate([[0.0], np.cumsum(discounts)])
+
+    metrics = runs.copy()
+    metrics["relevant"] = n_relevant.astype(int)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in cutoffs:
+            metrics[f"recall@{k}"] = np.where(n_relevant > 0, cumulative_hits[:, k - 1] / n_relevant, np.nan)
+            metrics[f"precision@{k}"] = np.where(n_relevant > 0, cumulative_hits[:, k - 1] / k, np.nan)
+            ideal = ideal_dcg[np.minimum(n_relevant, k).astype(int)]
+            metrics[f"ndcg@{k}"] = np.where(ideal > 0, hit_matrix[:, :k] @ discounts[:k] / ideal, np.nan)
+        first_hit = np.argmax(hit_matrix > 0, axis=1)
+        metrics["mrr"] = np.where(n_relevant > 0, np.where(hit_matrix.any(axis=1), 1.0 / (first_hit + 1), 0.0), np.nan)
+    return metrics
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        results_dir = sys.argv[1]
+    if len(sys.argv) > 2:
+        output_file = sys.argv[2]
+
+    keys = PageKeys()
+    relevance = load_all_relevance(keys)
+    runs, ranked = load_runs(results_dir, keys, max(CUTOFFS))
+    metrics = evaluate(runs, ranked, relevance)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    metrics.drop(columns=["run"]).to_csv(output_file, index=False)
+
+    # Mean over queries per corpus variant
+    metric_columns = [column for column in metrics.columns if "@" in column or column == "mrr"]
+    print(metrics.groupby("variant")[metric_columns].mean().round(3).T)
+    without_relevant = int((metrics["relevant"] == 0).sum())
+    print(f"Evaluated {len(runs)} runs ({without_relevant} without relevant pages in the searched barcodes, "
+          f"left out), saved to {output_file}")
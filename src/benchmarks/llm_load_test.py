@@ -0,0 +1,178 @@
+"""
+Load test of the LLM client (ollama_client.py with page_packing.py, as used by llm_preprocessing.py and
+llm_keywords.py): sends synthetic pages through PagePacker for every combination of concurrency (requests in flight)
+and batch size (pages per request) and reports the throughput and the tail latency of the requests.
+
+By default the requests go to a mock server started in-process (mock_ollama.py) with the given timing and failures, so
+the client can be tuned on any machine; --url sends them to a running server instead (a mock in its own process, or a
+real Ollama server, which is then fully occupied). Nothing is cached, so every run sends all pages.
+
+The pages are the cleaned OCR of synthetic pages (see synthetic_corpus.py), including the short odd pages. The results
+are written to results_file.
+
+Usage:
+    python src/benchmarks/llm_load_test.py [--pages 200] [--concurrency 1,2,4,8] [--batch-sizes 1,4,16]
+        [--latency lognormal:0.5,0.5] [--tokens-per-second 20] [--parallel 4] [--error-rate 0.01] [--url URL]
+
+Code by Michela Vignoli.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+for folder in ('preprocessing', 'utils'):
+    sys.path.append(os.path.join(here, '..', folder))
+from clean_books import clean_book
+from llm_preprocessing import PROMPT
+from metrics import Histogram
+from mock_ollama import MockOllamaServer, LATENCY, TOKENS_PER_SECOND, PROMPT_TOKENS_PER_SECOND, PARALLEL
+from ollama_client import OllamaClient
+from page_packing import PagePacker, TOKEN_BUDGET
+from synthetic_corpus import page_text, original_page, SEED
+
+benchmark_dir = 'data/benchmarks/'
+results_file = os.path.join(benchmark_dir, 'llm_load_test.json')
+
+PAGES = 200
+CONCURRENCY = [1, 2, 4, 8]
+BATCH_SIZES = [1, 4, 16]
+
+
+def synthetic_pages(count, seed=SEED):
+    """Cleaned OCR of count synthetic pages, about 8% of them empty or odd pages."""
+    rng = random.Random(seed)
+    pages = []
+    for page_number in range(1, count + 1):
+        corrected = page_text(rng) if rng.random() >= 0.08 else None
+        pages.append('\n'.join(clean_book(original_page(rng, page_number, corrected))))
+    return pages
+
+
+class NullCache:
+    """Cache that never has an answer, so that every run sends all pages."""
+
+    def get(self, model, prompt_template, text):
+        return None
+
+    def put(self, model, prompt_template, text, response):
+        pass
+
+
+class TimedClient(OllamaClient):
+    """OllamaClient that records the latency of every request (with its retries) and the failed requests."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = Histogram()
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def generate(self, prompt, retries=3, options=None):
+        start = time.perf_counter()
+        answer = super().generate(prompt, retries, options)
+        with self._lock:
+            self.latencies.observe(time.perf_counter() - start)
+            self.failures += answer is None
+        return answer
+
+
+def run_load(url, pages, concurrency, batch_size, budget=TOKEN_BUDGET):
+    """Send the pages with concurrency requests in flight and up to batch_size pages per request."""
+    client = TimedClient(url=url, max_in_flight=concurrency)
+    failed_pages = []
+    packer = PagePacker(PROMPT, client, NullCache(), lambda item, answer: failed_pages.append(answer is None), budget,
+                        max_pages=batch_size)
+    start = time.perf_counter()
+    try:
+        packer.process(({"text": text} for text in pages), concurrency)
+    finally:
+        client.close()
+    seconds = time.perf_counter() - start
+
+    latencies = client.latencies.summary()
+    return {
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "pages": len(pages),
+        "requests": latencies["count"],
+        "seconds": seconds,
+        "pages_per_second": len(pages) / seconds if seconds > 0 else 0.0,
+        "requests_per_second": latencies["count"] / seconds if seconds > 0 else 0.0,
+        "latency_p50": latencies["p50"],
+        "latency_p90": latencies["p90"],
+        "latency_p99": latencies["p99"],
+        "latency_max": latencies["max"],
+        "failed_requests": client.failures,
+        "failed_pages": sum(failed_pages),
+        "resent_pages": packer.stats["resent"],
+    }
+
+
+def parse_list(value):
+    return [int(number) for number in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep concurrency and batch size of the LLM client against a mock "
+                                                 "(or real) Ollama server.")
+    parser.add_argument('--pages', type=int, default=PAGES)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--concurrency', type=parse_list, default=CONCURRENCY, help="comma-separated, e.g. 1,2,4,8")
+    parser.add_argument('--batch-sizes', type=parse_list, default=BATCH_SIZES,
+                        help="comma-separated numbers of pages per request, e.g. 1,4,16")
+    parser.add_argument('--token-budget', type=int, default=TOKEN_BUDGET, help="tokens of page text per request")
+    parser.add_argument('--url', help="server to test instead of the in-process mock")
+    mock = parser.add_argument_group("in-process mock server (see mock_ollama.py)")
+    mock.add_argument('--latency', default=LATENCY)
+    mock.add_argument('--tokens-per-second', type=float, default=TOKENS_PER_SECOND)
+    mock.add_argument('--prompt-tokens-per-second', type=float, default=PROMPT_TOKENS_PER_SECOND)
+    mock.add_argument('--parallel', type=int, default=PARALLEL)
+    mock.add_argument('--error-rate', type=float, default=0.0)
+    mock.add_argument('--malformed-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = MockOllamaServer(('127.0.0.1', 0), args.latency, args.tokens_per_second, args.prompt_tokens_per_second,
+                                  args.parallel, args.error_rate, args.malformed_rate, args.seed).start()
+        url = server.url
+        print(f"Mock server on {url}: latency {args.latency}, {args.tokens_per_second} tokens/s, "
+              f"{args.prompt_tokens_per_second} prompt tokens/s, {args.parallel} parallel, "
+              f"{args.error_rate:.1%} errors, {args.malformed_rate:.1%} malformed lines")
+
+    pages = synthetic_pages(args.pages, args.seed)
+    results = {"url": url, "mock": None if args.url else {key: getattr(args, key) for key in (
+                   "latency", "tokens_per_second", "prompt_tokens_per_second", "parallel", "error_rate",
+                   "malformed_rate")},
+               "python": platform.python_version(), "created": time.strftime('%Y-%m-%d %H:%M:%S'), "runs": []}
+    try:
+        for batch_size in args.batch_sizes:
+            for concurrency in args.concurrency:
+                results["runs"].append(run_load(url, pages, concurrency, batch_size, args.token_budget))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    print(f"{'batch':>5} {'in flight':>9} {'pages/s':>8} {'requests':>8} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} "
+          f"{'max s':>7} {'failed':>6}")
+    for run in results["runs"]:
+        print(f"{run['batch_size']:5d} {run['concurrency']:9d} {run['pages_per_second']:8.2f} {run['requests']:8d} "
+              + ' '.join(f"{run[key]:7.2f}" if run[key] is not None else f"{'-':>7}"
+                         for key in ("latency_p50", "latency_p90", "latency_p99", "latency_max"))
+              + f" {run['failed_pages']:6d}")
+
+    os.makedirs(benchmark_dir, exist_ok=True)
+    tmp_path = results_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp_path, results_file)
+    print(f"Results saved to {results_file}")
@@ -0,0 +1,236 @@
+"""
+Local stand-in for the Ollama /api/generate endpoint, for tuning the LLM clients (ollama_client.py, page_packing.py)
+without the GPU server, e.g. with llm_load_test.py.
+
+Like Ollama, the server streams the answer as NDJSON lines ({"response": ..., "done": false}, one per token, and a
+final line with "done": true and the token counts) over a keep-alive HTTP/1.1 connection, or sends a single JSON object
+for "stream": false. The answer echoes the page text of the prompt: everything from the first <<<PAGE n>>> line for
+packed prompts (so page_packing.py finds every page in it), else the text after the last blank line. Its timing and
+failures are configurable:
+- latency: time before the first token, drawn from a distribution: fixed:SECONDS, uniform:MIN,MAX,
+  exponential:MEAN or lognormal:MEDIAN,SIGMA,
+- prompt_tokens_per_second: prompt processing speed, added to the latency (0: instant),
+- tokens_per_second: generation speed of every request (0: instant),
+- parallel: number of requests processed at the same time (OLLAMA_NUM_PARALLEL), further requests wait for a slot,
+- error_rate: share of requests that fail with HTTP 500,
+- malformed_rate: share of the NDJSON lines that are cut off (invalid JSON).
+
+Tokens are counted as in page_packing.py (about CHARS_PER_TOKEN characters each).
+
+Usage:
+    python src/benchmarks/mock_ollama.py [--port 11434] [--latency lognormal:0.5,0.5] [--tokens-per-second 20]
+        [--prompt-tokens-per-second 400] [--parallel 4] [--error-rate 0.01] [--malformed-rate 0.001]
+
+Code by Michela Vignoli.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from page_packing import estimate_tokens, CHARS_PER_TOKEN
+
+HOST = '127.0.0.1'
+PORT = 11434
+LATENCY = 'lognormal:0.5,0.5'
+TOKENS_PER_SECOND = 20.0
+PROMPT_TOKENS_PER_SECOND = 400.0
+PARALLEL = 4
+
+PACKED_PAGES_PATTERN = re.compile(r'<<<PAGE \d+>>>.*', re.DOTALL)
+
+
+def parse_distribution(spec):
+    """Return a function that draws a latency in seconds from rng, for a spec like lognormal:0.5,0.5."""
+    name, _, parameters = spec.partition(':')
+    values = [float(value) for value in parameters.split(',') if value]
+    distributions = {
+        "fixed": (1, lambda rng, seconds: seconds),
+        "uniform": (2, lambda rng, low, high: rng.uniform(low, high)),
+        "exponential": (1, lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0),
+        "lognormal": (2, lambda rng, median, sigma: median * rng.lognormvariate(0, sigma)),
+    }
+    if name not in distributions or len(values) != distributions[name][0]:
+        raise ValueError(f"Invalid latency distribution {spec!r}, expected fixed:SECONDS, uniform:MIN,MAX, "
+                         f"exponential:MEAN or lognormal:MEDIAN,SIGMA")
+    draw = distributions[name][1]
+    return lambda rng: max(0.0, draw(rng, *values))
+
+
+def echo_answer(prompt):
+    """The page text of the prompt, as the answer of a model that changes nothing."""
+    packed = PACKED_PAGES_PATTERN.search(prompt)
+    if packed:
+        return packed.group(0).strip()
+    return prompt.rsplit('\n\n', 1)[-1].strip()
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    """
+    HTTP server answering /api/generate like Ollama, with the given timing and failures.
+
+    Parameters:
+    - address (tuple): Host and port to listen on (port 0: any free port).
+    - latency (str): Distribution of the time to the first token (see parse_distribution).
+    - tokens_per_second (float): Generation speed per request, 0 for instant answers.
+    - prompt_tokens_per_second (float): Prompt processing speed, 0 for instant.
+    - parallel (int): Requests processed at the same time.
+    - error_rate (float): Share of requests that fail with HTTP 500.
+    - malformed_rate (float): Share of the response lines that are not valid JSON.
+    - seed (int): Seed of the random draws.
+    - answer (callable): Returns the answer text for a prompt.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=(HOST, PORT), latency=LATENCY, tokens_per_second=TOKENS_PER_SECOND,
+                 prompt_tokens_per_second=PROMPT_TOKENS_PER_SECOND, parallel=PARALLEL, error_rate=0.0,
+                 malformed_rate=0.0, seed=0, answer=echo_answer):
+        super().__init__(address, MockOllamaHandler)
+        self.draw_latency = parse_distribution(latency)
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.answer = answer
+        self.slots = threading.Semaphore(parallel)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "malformed_lines": 0, "prompt_tokens": 0, "response_tokens": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    def random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def latency(self):
+        with self._lock:
+            return self.draw_latency(self._rng)
+
+    def count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def start(self):
+        """Serve on a daemon thread and return the server."""
+        threading.Thread(target=self.serve_forever, name="mock-ollama", daemon=True).start()
+        return self
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, as the pooled connections of OllamaClient expect
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+
+    def _line(self, obj):
+        line = json.dumps(obj, ensure_ascii=False)
+        if self.server.malformed_rate and self.server.random() < self.server.malformed_rate:
+            self.server.count(malformed_lines=1)
+            line = line[:len(line) // 2]
+        return (line + '\n').encode('utf-8')
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/api/generate':
+            self._send(404, b'{"error": "not found"}')
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            prompt = payload["prompt"]
+        except (ValueError, KeyError, TypeError):
+            self._send(400, b'{"error": "invalid request"}')
+            return
+        server = self.server
+        server.count(requests=1)
+        model = payload.get("model", "mock")
+
+        with server.slots:
+            start = time.perf_counter()
+            prompt_tokens = estimate_tokens(prompt)
+            delay = server.latency()
+            if server.prompt_tokens_per_second:
+                delay += prompt_tokens / server.prompt_tokens_per_second
+            time.sleep(delay)
+
+            if server.error_rate and server.random() < server.error_rate:
+                server.count(errors=1)
+                self._send(500, b'{"error": "mock failure"}')
+                return
+
+            answer = server.answer(prompt)
+            tokens = [answer[i:i + CHARS_PER_TOKEN] for i in range(0, len(answer), CHARS_PER_TOKEN)]
+            server.count(prompt_tokens=prompt_tokens, response_tokens=len(tokens))
+
+            if not payload.get("stream", True):
+                if server.tokens_per_second:
+                    time.sleep(len(tokens) / server.tokens_per_second)
+                self._send(200, self._line({"model": model, "response": answer, "done": True,
+                                            "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)}))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            generation_start = time.perf_counter()
+            for i, token in enumerate(tokens):
+                if server.tokens_per_second:
+                    # Sleep until the token is due, so that slow writes do not add up
+                    wait = generation_start + (i + 1) / server.tokens_per_second - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                self._write_chunk(self._line({"model": model, "response": token, "done": False}))
+            self._write_chunk(self._line({"model": model, "response": "", "done": True,
+                                          "total_duration": int((time.perf_counter() - start) * 1e9),
+                                          "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)}))
+            self._write_chunk(b'')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a mock of the Ollama /api/generate endpoint.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency', default=LATENCY, help="time to the first token, e.g. fixed:0.5, uniform:0.2,1, "
+                                                           "exponential:0.5 or lognormal:0.5,0.5 (median, sigma)")
+    parser.add_argument('--tokens-per-second', type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=PROMPT_TOKENS_PER_SECOND)
+    parser.add_argument('--parallel', type=int, default=PARALLEL, help="requests processed at the same time")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests failing with HTTP 500")
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help="share of invalid NDJSON lines")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockOllamaServer((args.host, args.port), args.latency, args.tokens_per_second,
+                              args.prompt_tokens_per_second, args.parallel, args.error_rate, args.malformed_rate,
+                              args.seed)
+    print(f"Mock Ollama server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.stats}")
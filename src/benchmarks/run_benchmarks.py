@@ -0,0 +1,286 @@
+"""
+Benchmarks the hot paths of the pipeline on a synthetic corpus (see synthetic_corpus.py) and compares the results to a
+stored baseline:
+- clean_book (clean_books.py): cleaning the original OCR of every book,
+- combine_data (extract_data.py): reading and combining the clean, orig and prep variants of every page,
+- find_number_before_position and find_pages (annotations_preprocessing.py): resolving the page of every annotation
+  in the merged text of its book, one position at a time and all positions of a book at once,
+- process_report (annotations_preprocessing.py): processing the Recogito export of every book,
+- highlight_text (highlight_alignment.py, used by the explorer): highlighting an indexed chunk and an OCR variant of
+  another chunk on a page.
+
+The benchmarks that work on texts in memory use the first SAMPLE_BOOKS books (highlight_text the first SAMPLE_PAGES
+pages), the others the whole corpus. Every benchmark is run repeats times and the fastest run counts. Peak memory is
+the peak of the memory allocated while the benchmark runs (tracemalloc), measured in one extra run because tracing
+slows the code down.
+
+The results are written to results_file. With --save-baseline they are stored as the baseline, otherwise they are
+compared to the baseline of the same corpus: a throughput that is more than TOLERANCE lower or a peak memory that is
+more than TOLERANCE higher is reported as a regression, and the script exits with status 1.
+
+Usage:
+    python src/benchmarks/run_benchmarks.py [--books 100] [--pages 50] [--repeats 3] [--only clean_book,find_pages]
+                                            [--save-baseline]
+
+Code by Michela Vignoli.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+for folder in ('preprocessing', 'utils', 'indexing'):
+    sys.path.append(os.path.join(here, '..', folder))
+sys.path.append(os.path.join(here, '..', '..'))
+import annotations_preprocessing
+from annotations_preprocessing import build_page_index, find_pages, find_number_before_position, process_report
+from clean_books import clean_book
+from extract_data import collect_files, combine_data
+from highlight_alignment import highlight_text
+from sentence_chunker import chunk_spans
+from synthetic_corpus import generate_corpus, barcode_of, BOOKS, PAGES_PER_BOOK, SEED
+
+benchmark_dir = 'data/benchmarks/'
+baseline_file = os.path.join(benchmark_dir, 'baseline.json')
+results_file = os.path.join(benchmark_dir, 'latest.json')
+
+REPEATS = 3
+# Books used by the benchmarks that hold their input in memory, and pages used by highlight_text
+SAMPLE_BOOKS = 200
+SAMPLE_PAGES = 1000
+# Allowed relative loss of throughput (or growth of peak memory) before a result counts as a regression
+TOLERANCE = 0.15
+
+
+##
+## Benchmarks: every benchmark has a function that prepares its input from the corpus directory and a function that
+## runs it and returns the number of units it processed
+##
+
+def sample_barcodes(corpus):
+    return [barcode_of(book_number) for book_number in range(min(corpus['books'], SAMPLE_BOOKS))]
+
+
+def read_text(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def prepare_clean_book(corpus_dir, corpus):
+    folder = os.path.join(corpus_dir, 'original')
+    return [os.path.join(folder, fname) for fname in sorted(os.listdir(folder))]
+
+
+def run_clean_book(paths):
+    lines = 0
+    for path in paths:
+        text = read_text(path)
+        clean_book(text)
+        lines += text.count('\n')
+    return lines
+
+
+def prepare_combine_data(corpus_dir, corpus):
+    return [collect_files(os.path.join(corpus_dir, 'pages', variant)) for variant in ('clean', 'orig', 'prep')]
+
+
+def run_combine_data(files):
+    return sum(1 for _ in combine_data(*files))
+
+
+def prepare_annotations(corpus_dir, corpus):
+    """Merged texts and annotation offsets of the sample books."""
+    import pandas as pd
+
+    books = []
+    for barcode in sample_barcodes(corpus):
+        merged = read_text(os.path.join(corpus_dir, 'merged', f"{barcode}_clean_merged.txt"))
+        anchors = pd.read_csv(os.path.join(corpus_dir, 'annotations', f"{barcode}_annotations.csv"))['ANCHOR']
+        books.append((merged, [int(anchor.split(':')[1]) for anchor in anchors]))
+    return books
+
+
+def run_find_number_before_position(books):
+    for merged, positions in books:
+        for position in positions:
+            find_number_before_position(merged, position)
+    return sum(len(positions) for _, positions in books)
+
+
+def run_find_pages(books):
+    for merged, positions in books:
+        find_pages(build_page_index(merged), positions)
+    return sum(len(positions) for _, positions in books)
+
+
+def prepare_process_report(corpus_dir, corpus):
+    annotations_preprocessing.merged_dir = os.path.join(corpus_dir, 'merged')
+    folder = os.path.join(corpus_dir, 'annotations')
+    return [os.path.join(folder, fname) for fname in sorted(os.listdir(folder))]
+
+
+def run_process_report(exports):
+    return sum(len(process_report(export_path)[1]) for export_path in exports)
+
+
+def prepare_highlight_text(corpus_dir, corpus):
+    """
+    Pages of the sample books (corrected text, as shown in the explorer) with two highlights: an indexed chunk that is
+    looked up by its offsets, and the same passage of another chunk in the cleaned OCR that has to be aligned.
+    """
+    pages = []
+    for barcode in sample_barcodes(corpus):
+        prep_dir = os.path.join(corpus_dir, 'pages', 'prep', f"{barcode}_clean_preprocessed")
+        clean_dir = os.path.join(corpus_dir, 'pages', 'clean', f"{barcode}_clean")
+        for page_number in range(1, corpus['pages_per_book'] + 1):
+            text = read_text(os.path.join(prep_dir, f"{page_number:05d}_corrected.txt"))
+            clean_text = read_text(os.path.join(clean_dir, f"{page_number:05d}.txt")).replace('\n', ' ')
+            chunks = {text[start:end]: (start, end) for start, end in chunk_spans(text)}
+            clean_chunks = [clean_text[start:end] for start, end in chunk_spans(clean_text)]
+            if len(chunks) < 2 or len(clean_chunks) < 2:
+                continue
+            highlights = [next(iter(chunks)), clean_chunks[len(clean_chunks) // 2]]
+            pages.append((text, highlights, chunks))
+            if len(pages) == SAMPLE_PAGES:
+                return pages
+    return pages
+
+
+def run_highlight_text(pages):
+    for text, highlights, chunks in pages:
+        highlight_text(text, highlights, chunks)
+    return len(pages)
+
+
+BENCHMARKS = {
+    "clean_book": ("lines", prepare_clean_book, run_clean_book),
+    "combine_data": ("pages", prepare_combine_data, run_combine_data),
+    "find_number_before_position": ("annotations", prepare_annotations, run_find_number_before_position),
+    "find_pages": ("annotations", prepare_annotations, run_find_pages),
+    "process_report": ("annotations", prepare_process_report, run_process_report),
+    "highlight_text": ("pages", prepare_highlight_text, run_highlight_text),
+}
+
+
+##
+## Running and comparing
+##
+
+def run_benchmark(name, corpus_dir, corpus, repeats=REPEATS, measure_memory=True):
+    unit, prepare, run = BENCHMARKS[name]
+    data = prepare(corpus_dir, corpus)
+
+    seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        units = run(data)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            run(data)
+            peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    return {"unit": unit, "units": units, "seconds": seconds,
+            "throughput": units / seconds if seconds > 0 else 0.0, "peak_memory_mib": peak_memory}
+
+
+def compare(result, baseline, tolerance=TOLERANCE):
+    """Return a description of the result relative to the baseline result and whether it is a regression."""
+    ratio = result["throughput"] / baseline["throughput"] if baseline["throughput"] else 1.0
+    regression = ratio < 1 - tolerance
+    description = f"{ratio - 1:+.0%} throughput"
+    if result["peak_memory_mib"] is not None and baseline.get("peak_memory_mib"):
+        memory_ratio = result["peak_memory_mib"] / baseline["peak_memory_mib"]
+        regression = regression or memory_ratio > 1 + tolerance
+        description += f", {memory_ratio - 1:+.0%} memory"
+    return description, regression
+
+
+def load_baseline(path, corpus):
+    """Return the baseline results, or None if there is no baseline for the same corpus."""
+    if not os.path.exists(path):
+        print(f"No baseline in {path}, run with --save-baseline to store one")
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    settings = ("books", "pages_per_book", "seed")
+    if any(baseline["corpus"].get(key) != corpus.get(key) for key in settings):
+        measured_on = ', '.join(f"{key}={baseline['corpus'].get(key)}" for key in settings)
+        print(f"The baseline in {path} was measured on another corpus ({measured_on}), not comparing")
+        return None
+    return baseline
+
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the pipeline on a synthetic corpus.")
+    parser.add_argument('--books', type=int, default=BOOKS)
+    parser.add_argument('--pages', type=int, default=PAGES_PER_BOOK, help="pages per book")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--only', help="comma-separated names of the benchmarks to run")
+    parser.add_argument('--corpus-dir', help="default: a folder per corpus size in benchmark_dir")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory runs")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)} (available: {', '.join(BENCHMARKS)})")
+
+    corpus_dir = args.corpus_dir or os.path.join(benchmark_dir, f"corpus_{args.books}x{args.pages}_seed{args.seed}")
+    start = time.perf_counter()
+    corpus = generate_corpus(corpus_dir, args.books, args.pages, args.seed)
+    print(f"Corpus: {corpus['books']} books, {corpus['pages']} pages, {corpus['characters'] / 1e6:.1f} M characters "
+          f"in {corpus_dir} (ready in {time.perf_counter() - start:.1f} s)")
+
+    baseline = None if args.save_baseline else load_baseline(baseline_file, corpus)
+    results = {"corpus": corpus, "python": platform.python_version(), "machine": platform.machine(),
+               "cpus": os.cpu_count(), "created": time.strftime('%Y-%m-%d %H:%M:%S'), "benchmarks": {}}
+    regressions = []
+    for name in names:
+        result = run_benchmark(name, corpus_dir, corpus, args.repeats, not args.no_memory)
+        results["benchmarks"][name] = result
+
+        memory = f"{result['peak_memory_mib']:8.1f} MiB" if result['peak_memory_mib'] is not None else "       - MiB"
+        line = (f"{name:>28}: {result['seconds']:8.3f} s {result['throughput']:12.0f} {result['unit']}/s, "
+                f"peak {memory}")
+        if baseline and name in baseline["benchmarks"]:
+            description, regression = compare(result, baseline["benchmarks"][name])
+            line += f" ({description}{', REGRESSION' if regression else ''})"
+            if regression:
+                regressions.append(name)
+        print(line)
+
+    save_results(results, results_file)
+    if args.save_baseline:
+        # Keep the baseline of the benchmarks that were not run
+        previous = load_baseline(baseline_file, corpus) if os.path.exists(baseline_file) else None
+        if previous:
+            results["benchmarks"] = dict(previous["benchmarks"], **results["benchmarks"])
+        save_results(results, baseline_file)
+        print(f"Baseline saved to {baseline_file}")
+    else:
+        print(f"Results saved to {results_file}")
+
+    if regressions:
+        print(f"Regressions (more than {TOLERANCE:.0%} slower or larger than the baseline): {', '.join(regressions)}")
+        sys.exit(1)
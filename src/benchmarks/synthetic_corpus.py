@@ -0,0 +1,236 @@
+"""
+Generates synthetic corpora that look like the ONiT data, for the benchmarks in run_benchmarks.py.
+
+Every book is a travelogue page sequence of German text with the historical spellings of the originals (ſ, ß, umlauts,
+'ey', 'th'), OCR noise (confused letters, stray marks, hyphenated line ends) and the usual odd pages: statuscode and
+<html> pages of failed downloads, pages with nothing but punctuation, and short title pages. Books are generated
+independently from the seed and their number, in parallel across processes, so a corpus of 10 or 10,000 books is
+always the same. The corpus directory contains
+- original/<barcode>.txt: the OCR of every book as one file (input of clean_books.py),
+- pages/orig/<barcode>/<page>.txt, pages/clean/<barcode>_clean/<page>.txt and
+  pages/prep/<barcode>_clean_preprocessed/<page>_corrected.txt: the page variants (input of extract_data.py),
+- merged/<barcode>_clean_merged.txt: the cleaned book with 'page' markers, and
+- annotations/<barcode>_annotations.csv: a Recogito export for the book (input of annotations_preprocessing.py),
+- corpus.json: the settings and size of the corpus.
+
+Usage:
+    python src/benchmarks/synthetic_corpus.py corpus_dir [books] [pages_per_book]
+
+Code by Michela Vignoli.
+"""
+
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from clean_books import clean_book
+
+BOOKS = 100
+PAGES_PER_BOOK = 50
+SEED = 1
+
+RECOGITO_COLUMNS = ["UUID", "FILE", "QUOTE_TRANSCRIPTION", "ANCHOR", "COMMENTS", "TAGS"]
+
+# Words in the spelling of 17-19th century prints
+WORDS = (
+    "und der die das den dem des ein eine einen einem einer wir ſie ihr ihm ihn uns man ſich nicht auch noch nur "
+    "ſehr ſo wie als daß dieſe dieſer dieſes welche welcher jene alle viele einige andere ganz gar bey zu mit von "
+    "aus nach über unter gegen durch ohne um an auf in im am vom zum zur hier dort da wo wann dann denn doch aber "
+    "oder ſondern weil wenn ob iſt ſind war waren ſeyn hat haben hatte hatten wird werden wurde wurden kann konnte "
+    "muß mußte ſoll ſollte will wollte läßt ließ ſah ſahen fand fanden kam kamen gieng giengen reiſte reiſten "
+    "Pferd Pferde Pferden Roß Roſſe Kameel Kameele Eſel Maulthiere Ochſen Schafe Ziegen Vögel Störche Krokodil "
+    "Löwen Schlangen Heuſchrecken Palmen Dattelbäume Feigen Reiß Korn Waizen Waſſer Brunnen Fluß Nil Meer Ufer "
+    "Hafen Schiff Schiffe Wind Sturm Küſte Inſel Wüſte Sand Berge Thal Thäler Gebirge Wald Felder Gärten Stadt "
+    "Städte Dorf Dörfer Häuſer Moſchee Kirche Kloſter Schloß Mauern Thor Thore Straßen Markt Bazar Caravane "
+    "Türken Araber Griechen Juden Chriſten Einwohner Bauern Kaufleute Reiſende Führer Pilger Sultan Paſcha Bey "
+    "Aga Conſul Kaiſer Volk Völker Sitten Gebräuche Kleidung Speiſen Brod Fleiſch Milch Kaffee Tabak Wein "
+    "Aegypten Cairo Alexandrien Syrien Aleppo Damaſcus Jeruſalem Conſtantinopel Smyrna Cypern Candia Rhodus "
+    "Tag Tage Nacht Morgen Abend Stunden Jahr Jahre Monat Winter Sommer Hitze Kälte Regen Luft Sonne Mond "
+    "große großen groſſe kleine kleinen ſchöne ſchönen alte alten neue neuen weiße ſchwarze rothe grüne "
+    "fruchtbare dürre reiche arme wilde zahme ſchnelle langſam weit nahe hoch tief gut übel beſonders gewiß "
+    "ſchon bald endlich zuweilen beſtändig ungemein außerordentlich vortrefflich ſeltſam häufig Theil Theile "
+    "Art Arten Menge Zahl Gegend Gegenden Land Länder Reiſe Reiſen Weg Wege Nachricht Beſchreibung Urſache"
+).split()
+
+# Letters OCR engines confuse in Fraktur prints, and stray marks they produce
+OCR_CONFUSIONS = {
+    'ſ': 'f', 'f': 'ſ', 's': 'f', 'n': 'u', 'u': 'n', 'e': 'c', 'c': 'e', 'h': 'b', 'b': 'h', 'r': 't', 't': 'r',
+    'l': 'I', 'i': 'l', 'm': 'rn', 'ü': 'u', 'ä': 'a', 'ö': 'o', 'k': 'f', 'd': 'b', 'a': 'á',
+}
+STRAY_MARKS = ["„", "»", "«", "·", "'", ":", ",", ".", "⸗", "*", "ͤ", "|", "^", "~"]
+
+LINE_WIDTH = 52
+ANNOTATION_TAGS = ["Tier", "Tier|Pferd", "Pflanze", "Landschaft", "Gewässer", "Tier|Kameel", "Wetter"]
+
+
+def barcode_of(book_number):
+    return f"Z{100000000 + book_number:09d}"
+
+
+def sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 22))
+    if rng.random() < 0.3:
+        words.insert(rng.randint(1, len(words) - 1), str(rng.randint(1, 1850)))
+    if rng.random() < 0.4:
+        words[rng.randint(0, len(words) - 2)] += ','
+    text = ' '.join(words)
+    return text[0].upper() + text[1:] + rng.choice('....!?;')
+
+
+def page_text(rng):
+    """Return the corrected text of a page, as flowing text."""
+    sentences = [sentence(rng) for _ in range(rng.randint(12, 24))]
+    return ' '.join(sentences)
+
+
+def break_lines(text, rng):
+    """Set the text in lines of the printed page, hyphenating some words at the line end."""
+    lines = []
+    line = ''
+    for word in text.split(' '):
+        if line and len(line) + len(word) + 1 > LINE_WIDTH:
+            if len(word) > 6 and rng.random() < 0.3:
+                cut = rng.randint(3, len(word) - 3)
+                lines.append(f"{line} {word[:cut]}{rng.choice('¬-⸗')}")
+                word = word[cut:]
+            else:
+                lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    lines.append(line)
+    return lines
+
+
+def add_ocr_noise(text, rng, rate=0.03):
+    """Confuse letters and add stray marks at about rate of the characters."""
+    chars = list(text)
+    for position in rng.sample(range(len(chars)), k=int(len(chars) * rate)):
+        char = chars[position]
+        if char in OCR_CONFUSIONS and rng.random() < 0.8:
+            chars[position] = OCR_CONFUSIONS[char]
+        elif not char.isspace():
+            chars[position] = char + rng.choice(STRAY_MARKS)
+    return ''.join(chars)
+
+
+def original_page(rng, page_number, corrected):
+    """Return the OCR of a page with the corrected text, or of an odd page if corrected is None."""
+    if corrected is None:
+        kind = rng.random()
+        if kind < 0.4:
+            return f"statuscode {rng.choice([404, 500, 503])}\nThe requested page could not be retrieved.\n"
+        if kind < 0.6:
+            return "<html><head><title>Error</title></head><body>Service unavailable</body></html>\n"
+        if kind < 0.8:
+            return f"{page_number}\n.\n\n.\n\n!\n\n.\n"
+        title = ' '.join(rng.choices(WORDS, k=rng.randint(3, 8)))
+        return f"{title.upper()}\n\n{rng.randint(1700, 1850)}.\n"
+    lines = [f"{page_number}", ' '.join(rng.choices(WORDS, k=3)).capitalize(), '']
+    lines.extend(add_ocr_noise(line, rng) for line in break_lines(corrected, rng))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_book(args):
+    """Generate and write one book of the corpus; return its number of pages and characters."""
+    corpus_dir, book_number, pages_per_book, seed = args
+    rng = random.Random(seed * 1000003 + book_number)
+    barcode = barcode_of(book_number)
+
+    orig_dir = os.path.join(corpus_dir, 'pages', 'orig', barcode)
+    clean_dir = os.path.join(corpus_dir, 'pages', 'clean', f"{barcode}_clean")
+    prep_dir = os.path.join(corpus_dir, 'pages', 'prep', f"{barcode}_clean_preprocessed")
+    for folder in (orig_dir, clean_dir, prep_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    original_pages = []
+    merged_parts = []
+    characters = 0
+    for page_number in range(1, pages_per_book + 1):
+        # About 8% of the pages are empty, failed or title pages
+        corrected = page_text(rng) if rng.random() >= 0.08 else None
+        original = original_page(rng, page_number, corrected)
+        cleaned = '\n'.join(clean_book(original))
+        original_pages.append(original)
+        merged_parts.append(f"page{page_number}\n{cleaned}\n")
+        characters += len(original)
+
+        name = f"{page_number:05d}"
+        with open(os.path.join(orig_dir, f"{name}.txt"), 'w', encoding='utf-8') as f:
+            f.write(original)
+        with open(os.path.join(clean_dir, f"{name}.txt"), 'w', encoding='utf-8') as f:
+            f.write(cleaned)
+        with open(os.path.join(prep_dir, f"{name}_corrected.txt"), 'w', encoding='utf-8') as f:
+            f.write(corrected.replace('ſ', 's') if corrected else "<empty page>")
+
+    with open(os.path.join(corpus_dir, 'original', f"{barcode}.txt"), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(original_pages))
+    merged = ''.join(merged_parts)
+    merged_file = f"{barcode}_clean_merged.txt"
+    with open(os.path.join(corpus_dir, 'merged', merged_file), 'w', encoding='utf-8') as f:
+        f.write(merged)
+
+    # Recogito export with about one annotation per two pages
+    with open(os.path.join(corpus_dir, 'annotations', f"{barcode}_annotations.csv"), 'w', encoding='utf-8',
+              newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECOGITO_COLUMNS)
+        writer.writeheader()
+        for _ in range(max(1, pages_per_book // 2)):
+            start = rng.randrange(max(1, len(merged) - 60))
+            writer.writerow({
+                "UUID": str(uuid.UUID(int=rng.getrandbits(128))),
+                "FILE": merged_file,
+                "QUOTE_TRANSCRIPTION": merged[start:start + rng.randint(5, 60)],
+                "ANCHOR": f"char-offset:{start}",
+                "COMMENTS": rng.choice(["", "", "unsicher", "OCR schlecht"]),
+                "TAGS": rng.choice(ANNOTATION_TAGS),
+            })
+    return pages_per_book, characters
+
+
+def generate_corpus(corpus_dir, books=BOOKS, pages_per_book=PAGES_PER_BOOK, seed=SEED, max_workers=None):
+    """Generate a corpus of books into corpus_dir, unless the same corpus is already there; return its settings."""
+    settings = {"books": books, "pages_per_book": pages_per_book, "seed": seed}
+    manifest_path = os.path.join(corpus_dir, 'corpus.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if all(manifest.get(key) == value for key, value in settings.items()):
+            return manifest
+        # A corpus with other settings: generate it again from scratch
+        for folder in ('original', 'pages', 'merged', 'annotations'):
+            shutil.rmtree(os.path.join(corpus_dir, folder), ignore_errors=True)
+
+    for folder in ('original', 'merged', 'annotations'):
+        os.makedirs(os.path.join(corpus_dir, folder), exist_ok=True)
+    tasks = [(corpus_dir, book_number, pages_per_book, seed) for book_number in range(books)]
+    pages = characters = 0
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for book_pages, book_characters in executor.map(generate_book, tasks, chunksize=4):
+            pages += book_pages
+            characters += book_characters
+
+    manifest = dict(settings, pages=pages, characters=characters)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+if __name__ == '__main__':
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else 'output/path/synthetic_corpus/'
+    books = int(sys.argv[2]) if len(sys.argv) > 2 else BOOKS
+    pages_per_book = int(sys.argv[3]) if len(sys.argv) > 3 else PAGES_PER_BOOK
+
+    start = time.perf_counter()
+    manifest = generate_corpus(corpus_dir, books, pages_per_book)
+    print(f"{manifest['books']} books, {manifest['pages']} pages ({manifest['characters'] / 1e6:.1f} M characters) "
+          f"in {corpus_dir} ({time.perf_counter() - start:.1f} s)")
@@ -0,0 +1,263 @@
+"""
+This script runs a list of queries against the clean, prep and orig indexes concurrently and writes one result file
+per (index, query) in the layout of data/retrieval_results/ (document, rrf_score, ..., unpacked_highlights,
+onb_viewer_link, and the chunk_offsets of the indexed documents), with the search parameters of the run in a JSON
+file of the same name (read by src/analysis/evaluate_retrieval.py). Each result is the reciprocal rank fusion of a tensor and a lexical search, computed as in
+src/analysis/query_index.ipynb, and it is written as soon as its searches return.
+
+By default the queries are the content tags of text_annotations_final/ONiT_text_annotations_final.csv (the tag labels
+without their Iconclass notation); alternatively pass a text file with one query per line:
+    python src/indexing/batch_query.py [queries.txt] [--refresh]
+
+Query embeddings are cached across indexes when the local backend is used. Marqo embeds queries on the server, so
+for Marqo the raw search responses are cached on disk instead, and reruns only send queries that are not cached yet.
+The cached responses are keyed by the stats of the index and the time of its last indexed batch (from the ledger of
+index_data.py), so they are not used after the index changed; --refresh sends all queries again.
+
+Code by Michela Vignoli.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from bm25_index import rrf_fuse
+from index_data import INDEX_BACKEND, LEDGER_DIR, MODEL, IndexLedger, get_client
+
+indexes = {
+    "clean": "onit-sonnini-DHd2025-clean",
+    "prep": "onit-sonnini-DHd2025-prep",
+    "orig": "onit-test-index-sonnini",
+}
+
+annotations_file = "text_annotations_final/ONiT_text_annotations_final.csv"
+corpus_metadata_file = "data/ONiT_barcodes_ALL_metadata_ONB_status_2024-05-23.csv"
+output_dir = "data/retrieval_results/batch/"
+query_cache_dir = "data/retrieval_results/query_cache/"
+
+## Query parameter
+limit = 1000  # max limit = 1000
+threshold = 0.7  # set threshold
+filter_string = "barcode:(Z166069305)"  # Sonnini Bd. 1
+k = 60  # RRF parameter
+
+# Number of searches sent at the same time
+MAX_WORKERS = 6
+
+OUTPUT_COLUMNS = ["document", "rrf_score", "barcode", "page", "iiif_link", "text_orig", "text_clean", "text_prep",
+                  "_id", "_highlights", "_score", "rank", "corpus", "rerank", "unpacked_highlights",
+                  "ST_cosine_similarity", "onb_viewer_link", "chunk_offsets"]
+
+ICONCLASS_PATTERN = re.compile(r'\s+\d[\dA-Z()+.:]*')
+
+base_url = "https://digital.onb.ac.at/OnbViewer/viewer.faces?doc=ABO_%2B"
+
+
+def annotation_queries(annotations_file):
+    """Return the labels of all annotation tags that carry an Iconclass notation, e.g. 'horses and kindred animals'."""
+    annotations = pd.read_csv(annotations_file)
+    queries = set()
+    for tag_list in annotations["annotation"].dropna():
+        for tag in tag_list.split("', '"):
+            tag = tag.strip().strip("'")
+            if ICONCLASS_PATTERN.search(tag):
+                queries.add(' '.join(ICONCLASS_PATTERN.sub(' ', tag).split()))
+    return sorted(queries)
+
+
+def load_corpus_metadata():
+    if not os.path.exists(corpus_metadata_file):
+        return None
+    bc_corpus = pd.read_csv(corpus_metadata_file)
+    return bc_corpus.drop_duplicates(subset='barcode', keep='last')[["barcode", "corpus"]]
+
+
+##
+## Search with response cache
+##
+
+def index_version(client, index_name):
+    """Stats of the index and the time of its last indexed batch, part of the key of the cached responses."""
+    version = client.index(index_name).get_stats()
+    # Indexes that were not filled from this machine have no ledger
+    if os.path.exists(os.path.join(LEDGER_DIR, f"{index_name}_ledger.sqlite")):
+        ledger = IndexLedger(index_name)
+        try:
+            version["last_indexed"] = ledger.last_indexed()
+        finally:
+            ledger.close()
+    return version
+
+
+def cached_search(client, index_name, query, version, refresh=False, **search_args):
+    key = json.dumps({"backend": INDEX_BACKEND, "index": index_name, "version": version, "q": query, **search_args},
+                     sort_keys=True)
+    cache_path = os.path.join(query_cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    response = client.index(index_name).search(q=query, **search_args)
+    tmp_path = cache_path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+    return response
+
+
+##
+## Result table as in query_index.ipynb
+##
+
+def to_ranked_frame(output, bc_corpus):
+    # The hits that are left after filtering, best first, are ranked 1..n
+    if output.empty:
+        return output
+    # Add corpus metadata
+    if bc_corpus is not None:
+        output = output.merge(bc_corpus, on='barcode', how='left')
+    else:
+        output = output.reset_index(drop=True)
+        output['corpus'] = None
+    # Add index +1 as a new column called 'rank'
+    output['rank'] = output.index + 1
+    # Add document identifier
+    output['document'] = output['barcode'].astype(str) + '_' + output['page'].astype(str)
+    return output
+
+
+# Custom aggregation function to combine values with a '/'
+def combine_values(values):
+    # Convert to string and join unique values with a '/' separator
+    return '/'.join(values.astype(str).unique())
+
+
+# Function to unpack and concatenate all texts from the lists of dictionaries
+def unpack_highlights(highlights):
+    if not isinstance(highlights, list):
+        return ''
+    return ' '.join([d.get('text_clean', d.get('text_prep', '')) for d in highlights if isinstance(d, dict)])
+
+
+def fuse_results(results_tensor, results_lexical, bc_corpus):
+    # results tensor search
+    output1 = pd.DataFrame(results_tensor["hits"])
+    if not output1.empty:
+        # Filter rows where _highlights are 5 tokens or more
+        output1 = output1[output1["_highlights"].apply(lambda x: len(str(x).split()) >= 5)]
+        ### Filter rows where _score is >= threshold
+        output1 = output1[output1["_score"] >= threshold]
+    output1 = to_ranked_frame(output1, bc_corpus)
+
+    # results keyword search
+    if len(results_lexical['hits']) == 0:
+        # No lexical search results, using only tensor results (as in the notebook)
+        output2 = output1
+    else:
+        output2 = to_ranked_frame(pd.DataFrame(results_lexical["hits"]), bc_corpus)
+
+    ## Reciprocal Rank Fusion (RRF)
+    combined_df = pd.concat([output1, output2], ignore_index=True)
+    if combined_df.empty:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+    rrf_scores = dict(rrf_fuse([output['document'].tolist() for output in (output1, output2) if not output.empty],
+                               k=k))
+
+    # Group by document and add the summed RRF score of each document
+    aggregations = {column: 'first' for column in OUTPUT_COLUMNS[2:11] + ['corpus', 'chunk_offsets']
+                    if column in combined_df}
+    aggregations['rank'] = combine_values
+    final_scores_df = combined_df.groupby('document', as_index=False).agg(aggregations)
+    final_scores_df['rrf_score'] = final_scores_df['document'].map(rrf_scores)
+
+    # Sort by total RRF score in descending order and reset index
+    final_scores_df = final_scores_df.sort_values(by='rrf_score', ascending=False).reset_index(drop=True)
+    # Add rerank based on the sorted order
+    final_scores_df['rerank'] = final_scores_df.index + 1
+
+    # Unpack the highlights, falling back to the page text if there are none
+    text_col = 'text_prep' if 'text_prep' in final_scores_df.columns else 'text_clean'
+    final_scores_df['unpacked_highlights'] = final_scores_df['_highlights'].apply(unpack_highlights)
+    empty = final_scores_df['unpacked_highlights'] == ''
+    final_scores_df.loc[empty, 'unpacked_highlights'] = final_scores_df.loc[empty, text_col]
+
+    # Computed with a sentence-transformers model in the notebook, not part of the batch run
+    final_scores_df['ST_cosine_similarity'] = None
+    # Add direct link to ÖNB Viewer
+    final_scores_df['onb_viewer_link'] = base_url + final_scores_df['barcode'].astype(str)
+
+    return final_scores_df.reindex(columns=OUTPUT_COLUMNS)
+
+
+def run_query(client, index_name, query, bc_corpus, version, refresh=False):
+    search_args = {"limit": limit, "filter_string": filter_string}
+    results_tensor = cached_search(client, index_name, query, version, refresh, **search_args)
+    results_lexical = cached_search(client, index_name, query, version, refresh, search_method="LEXICAL",
+                                    **search_args)
+    return fuse_results(results_tensor, results_lexical, bc_corpus)
+
+
+def result_path(index_name, query):
+    safe_query = re.sub(r'[\\/:*?"<>|]', '-', query)
+    return os.path.join(output_dir, f"i_{index_name}-q_{safe_query}.csv")
+
+
+def write_run_metadata(path, index_name, query):
+    # The evaluation only counts the annotated pages of the barcodes that were searched
+    metadata = {"index": index_name, "query": query, "limit": limit, "filter_string": filter_string, "k": k}
+    with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=1)
+
+
+def run_batch(client, queries, indexes, max_workers=MAX_WORKERS, refresh=False):
+    """Run every query on every index concurrently and write each result file as soon as it is complete."""
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(query_cache_dir, exist_ok=True)
+    bc_corpus = load_corpus_metadata()
+
+    versions = {}
+    for index_name in indexes.values():
+        try:
+            versions[index_name] = index_version(client, index_name)
+        except Exception as e:
+            print(f"Index {index_name} is not available, skipping it: {e}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_query, client, index_name, query, bc_corpus, version, refresh):
+                   (index_name, query)
+                   for query in queries for index_name, version in versions.items()}
+        for future in as_completed(futures):
+            index_name, query = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Query '{query}' on {index_name} failed: {e}")
+                continue
+            path = result_path(index_name, query)
+            results.to_csv(path, index=False)
+            write_run_metadata(path, index_name, query)
+            print(f"{len(results):5d} results for '{query}' on {index_name} saved to {path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run queries against the indexes and write the fused results.")
+    parser.add_argument('queries_file', nargs='?', help="text file with one query per line (default: annotation tags)")
+    parser.add_argument('--refresh', action='store_true', help="send all queries again instead of using the cache")
+    args = parser.parse_args()
+
+    if args.queries_file:
+        with open(args.queries_file, 'r', encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = annotation_queries(annotations_file)
+    print(f"Running {len(queries)} queries on {len(indexes)} indexes")
+
+    client = get_client()
+    if INDEX_BACKEND == "local":
+        # All three indexes use the same model, so every query only has to be embedded once
+        from local_index import EmbeddingCache, load_embedder
+        client.embed = EmbeddingCache(load_embedder(MODEL))
+    run_batch(client, queries, indexes, refresh=args.refresh)
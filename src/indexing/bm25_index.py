@@ -0,0 +1,186 @@
+"""
+Local BM25 inverted index over the text_orig, text_clean and text_prep columns of the corpus store, and a reciprocal
+rank fusion (RRF) combiner that merges BM25 and vector rankings like the hybrid search behind our retrieval results.
+
+Posting lists are stored as flat numpy arrays (CSR layout: one offsets array, one document array and one weight array
+for all terms). The BM25 weight of every posting is computed at build time, so a query only gathers the postings of
+its terms and sums them per document.
+
+Benchmark the index on a corpus store:
+    python src/indexing/bm25_index.py data/indices/DHd_index-cleaned/
+
+Code by Michela Vignoli.
+"""
+
+import os
+import re
+import sys
+import time
+from collections import Counter
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from corpus_store import read_corpus
+
+TEXT_FIELDS = ["text_orig", "text_clean", "text_prep"]
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# RRF parameter, as in the retrieval notebook
+RRF_K = 60
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class BM25Index:
+    """
+    Parameters:
+    - doc_ids (array): External id of every document, e.g. Z166069305_430.
+    - vocabulary (dict): Term -> term number.
+    - offsets (array): Postings of term t are at offsets[t]:offsets[t + 1].
+    - postings (array): Document numbers of all postings.
+    - weights (array): BM25 weight of all postings.
+    """
+
+    def __init__(self, doc_ids, vocabulary, offsets, postings, weights):
+        self.doc_ids = np.asarray(doc_ids, dtype=object)
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+
+    @classmethod
+    def build(cls, documents, k1=1.2, b=0.75):
+        """Build the index from an iterable of (doc_id, text) pairs."""
+        doc_ids = []
+        doc_lengths = []
+        vocabulary = {}
+        term_postings = []  # per term: list of (document number, term frequency)
+
+        for doc_number, (doc_id, text) in enumerate(documents):
+            tokens = tokenize(text)
+            doc_ids.append(doc_id)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                if term_id == len(term_postings):
+                    term_postings.append([])
+                term_postings[term_id].append((doc_number, tf))
+
+        n_docs = len(doc_ids)
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = doc_lengths.mean() if n_docs else 0.0
+
+        counts = np.fromiter((len(p) for p in term_postings), dtype=np.int64, count=len(term_postings))
+        offsets = np.zeros(len(term_postings) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        postings = np.fromiter((d for p in term_postings for d, _ in p), dtype=np.int32, count=offsets[-1])
+        tfs = np.fromiter((tf for p in term_postings for _, tf in p), dtype=np.float32, count=offsets[-1])
+
+        # Precompute the BM25 weight of every posting
+        idf = np.log(1.0 + (n_docs - counts + 0.5) / (counts + 0.5)).astype(np.float32)
+        length_norm = k1 * (1.0 - b + b * doc_lengths[postings] / max(avg_length, 1e-9))
+        weights = np.repeat(idf, counts) * tfs * (k1 + 1.0) / (tfs + length_norm)
+
+        return cls(doc_ids, vocabulary, offsets, postings, weights.astype(np.float32))
+
+    @classmethod
+    def from_corpus_store(cls, store_dir, field, barcodes=None):
+        """Build the index of one text column (text_orig, text_clean or text_prep) of the corpus store."""
+        table = read_corpus(store_dir, columns=["barcode", "page", field], barcodes=barcodes)
+        documents = (
+            (f"{barcode}_{page}", text)
+            for barcode, page, text in zip(table.column("barcode").to_pylist(), table.column("page").to_pylist(),
+                                           table.column(field).to_pylist())
+        )
+        return cls.build(documents)
+
+    def save(self, path):
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=object)
+        np.savez(path, doc_ids=self.doc_ids.astype(str), terms=terms.astype(str), offsets=self.offsets,
+                 postings=self.postings, weights=self.weights)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        vocabulary = {term: term_id for term_id, term in enumerate(data['terms'].tolist())}
+        return cls(data['doc_ids'].tolist(), vocabulary, data['offsets'], data['postings'], data['weights'])
+
+    def scores(self, query):
+        """Return (document numbers, scores) of all documents that contain at least one query term."""
+        slices = []
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                slices.append(slice(self.offsets[term_id], self.offsets[term_id + 1]))
+        if not slices:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        if len(slices) == 1:
+            return self.postings[slices[0]], self.weights[slices[0]]
+
+        docs = np.concatenate([self.postings[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        # Sum the weights per document; dense accumulation only pays off for very frequent terms
+        if len(docs) * 8 > len(self.doc_ids):
+            totals = np.bincount(docs, weights=weights, minlength=len(self.doc_ids))
+            matched = np.flatnonzero(totals)
+            return matched, totals[matched].astype(np.float32)
+        matched, inverse = np.unique(docs, return_inverse=True)
+        return matched, np.bincount(inverse, weights=weights).astype(np.float32)
+
+    def search(self, query, limit=10):
+        """Return the top documents as a list of (doc_id, score), best first."""
+        docs, scores = self.scores(query)
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            docs, scores = docs[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return list(zip(self.doc_ids[docs[order]].tolist(), scores[order].tolist()))
+
+    def search_batch(self, queries, limit=10):
+        return [self.search(query, limit) for query in queries]
+
+
+def rrf_fuse(rankings, k=RRF_K, limit=None):
+    """
+    Merge rankings with reciprocal rank fusion: every document scores sum(1 / (k + rank)) over the rankings it
+    appears in (rank starting at 1).
+
+    Parameters:
+    - rankings (list): Rankings to merge, each a list of doc ids or of (doc_id, score) pairs, best first.
+    - k (int): RRF parameter.
+    - limit (int): Number of documents to return, all if None.
+
+    Returns:
+    - list: (doc_id, rrf_score) pairs, best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, entry in enumerate(ranking, start=1):
+            doc_id = entry[0] if isinstance(entry, tuple) else entry
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return ranked[:limit] if limit is not None else ranked
+
+
+if __name__ == '__main__':
+    store_dir = sys.argv[1]
+    queries = ["Pferd", "Pferde", "Pferd, Pferde", "Ross", "Rosse", "Gaul", "Gäule", "Hengst", "Stute", "Fohlen",
+               "Reiter", "Kamel", "Esel", "Maulthier"]
+    repeats = 200
+
+    for field in TEXT_FIELDS:
+        start = time.perf_counter()
+        index = BM25Index.from_corpus_store(store_dir, field)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            index.search_batch(queries, limit=100)
+        elapsed = time.perf_counter() - start
+
+        n_queries = repeats * len(queries)
+        print(f"{field}: {len(index.doc_ids)} documents, {len(index.vocabulary)} terms, {len(index.postings)} postings, "
+              f"built in {build_time:.2f} s, {n_queries / elapsed:.0f} queries/s")
@@ -0,0 +1,51 @@
+"""
+This script runs the same queries against the Marqo server and the embedded local index (local_index.py) and reports
+search latency and memory use of both backends. Index the same corpus into both backends with index_data.py first.
+
+Code by Michela Vignoli.
+"""
+
+import resource
+import statistics
+import time
+from index_data import get_client
+
+index_name = "onit-sonnini-DHd2025-clean"
+queries = ["Pferd, Pferde", "Kamel", "Esel und Maulthiere", "Palmen", "Wüste", "Nil", "Krokodil", "Vögel"]
+limit = 100
+repeats = 5
+
+
+def time_queries(client, index_name, queries, limit, repeats):
+    index = client.index(index_name)
+    # Warm-up, e.g. loading the embedding model
+    index.search(q=queries[0], limit=limit)
+
+    latencies = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            index.search(q=query, limit=limit)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(backend, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{backend:>6}: mean {statistics.mean(latencies):7.1f} ms, median {statistics.median(latencies):7.1f} ms, "
+          f"p95 {p95:7.1f} ms over {len(latencies)} queries")
+
+
+if __name__ == '__main__':
+    for backend in ("marqo", "local"):
+        client = get_client(backend)
+        report(backend, time_queries(client, index_name, queries, limit, repeats))
+
+        if backend == "local":
+            index = client.index(index_name)
+            print(f"        embedding matrix: {index.memory_usage() / 2**20:.1f} MiB (memory-mapped), "
+                  f"{index.get_stats()['numberOfVectors']} vectors")
+
+    # ru_maxrss is in KiB on Linux
+    print(f"Peak memory of this process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
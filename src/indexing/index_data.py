@@ -2,20 +2,56 @@
 This script creates a Marqo index of preprocessed and original OCR texts. Each page is indexed as a document that is split into 2 sentences long vectors.
 The model used for sentence embedding is https://huggingface.co/flax-sentence-embeddings/all_datasets_v4_mpnet-base.
 
+Documents get a stable _id derived from barcode and page, and a local ledger stores the content hash of every page
+that Marqo confirmed. Reruns therefore only upsert new or changed pages, and an interrupted run resumes after the last
+completed batch. The indexing functions take the client as a parameter, so they can be run against the in-process
+stand-in in marqo_standin.py instead of a Marqo server. Set INDEX_BACKEND to "local" to index into the embedded
+vector index in local_index.py instead of Marqo.
+
+The tensor fields of all pages are split into sentence chunks with sentence_chunker.py in parallel before indexing, and
+every document carries the exact offsets of its chunks (field 'chunk_offsets'), so retrieved chunks can be placed on
+the page without fuzzy matching. The local backend embeds exactly these chunks; Marqo still splits the text itself.
+
+If the cleaned pages were labelled with dedup_pages.py, empty and boilerplate pages are not indexed and near-duplicate
+pages carry the _id of their canonical page (field 'duplicate_of'); the local backend copies the embeddings of the
+canonical page for them instead of embedding them again, Marqo still embeds them.
+
+Set ONIT_METRICS_DIR to write a run report with the batch timings (see metrics.py).
+
 Code by Michela Vignoli. Parts of this code were developed with assistance from Simon König.
 """
 
 from pprint import pprint
-import csv
-import marqo as mq
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from corpus_store import read_corpus
+from metrics import metrics
+from sentence_chunker import add_chunk_offsets
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from dedup_pages import load_labels
 
 ##
 ## Connect to Marqo
 ##
 
 MARQO_URL = "http://10.103.251.104:8882"
-marqoClient = mq.Client(url=MARQO_URL)
-#pprint(marqoClient.get_indexes())
+
+# "marqo" for the Marqo server, "local" for the embedded index in local_index.py
+INDEX_BACKEND = "marqo"
+
+def get_client(backend=INDEX_BACKEND):
+    if backend == "local":
+        from local_index import LocalClient
+        return LocalClient()
+    # Imported here so that the functions below can be used with other clients without Marqo installed
+    import marqo as mq
+    return mq.Client(url=MARQO_URL)
 
 ##
 ## Index settings
@@ -29,69 +65,217 @@ settings = {
     },
 }
 
+MODEL = "flax-sentence-embeddings/all_datasets_v4_mpnet-base"
+TENSOR_FIELDS = ["text_clean"]
+
+# Number of documents sent to Marqo per request; the ledger is checkpointed after every batch
+BATCH_SIZE = 128
+
+# Ledger of indexed documents
+LEDGER_DIR = 'data/indices/'
+
 ##
 ## Ask if index exists, if not create it
 ##
 
-indexName = "onit-sonnini-DHd2025-clean"
-print("Indexname: ", indexName)
-current_indexes = [d["indexName"] for d in marqoClient.get_indexes()["results"]]
-if indexName in current_indexes:
-    print(f"Index already exists: {indexName} ")
-    # Set indexName as the current index
-    print(f"Defaulting to index connection. Index connected: {indexName} ")
-else:  # Create a new index
-    print(f"Index does not exist: {indexName} ")
-    print(f"Creating index: {indexName} ")
-    marqoClient.create_index(
-        indexName,
-        model="flax-sentence-embeddings/all_datasets_v4_mpnet-base",
-        settings_dict=settings
-    )
+def ensure_index(client, index_name):
+    current_indexes = [d["indexName"] for d in client.get_indexes()["results"]]
+    if index_name in current_indexes:
+        print(f"Index already exists: {index_name} ")
+        # Set indexName as the current index
+        print(f"Defaulting to index connection. Index connected: {index_name} ")
+    else:  # Create a new index
+        print(f"Index does not exist: {index_name} ")
+        print(f"Creating index: {index_name} ")
+        client.create_index(
+            index_name,
+            model=MODEL,
+            settings_dict=settings
+        )
 
 ## List of models integrated in Marqo: https://docs.marqo.ai/latest/models/marqo/list-of-models/
 
-pprint(marqoClient.get_indexes())
-
 ##
 ## Load dict of data
 ##
 
-
-# Load list of dictionaries with each dictionary containing keys: text, barcode, page
-# CSV path
-csv_file = 'data/DHd_index-cleaned.csv'
-
-# Read data from CSV file into a list of dictionaries
-with open(csv_file, mode='r', encoding='utf-8') as file:
-    reader = csv.DictReader(file)
-    animal_descriptions = [row for row in reader]
-
 # Function to clean text by replacing \n with spaces
 def clean_text(text):
-    return text.replace('\n', ' ').strip()
+    return (text or '').replace('\n', ' ').strip()
+
+# Stable document id, e.g. Z166069305_430 (the same format as the 'document' column of the retrieval results)
+def document_id(barcode, page):
+    return f"{barcode}_{int(page)}"
 
-# Clean the 'text' field in each dictionary
-for entry in animal_descriptions:
+def content_hash(document):
+    serialized = json.dumps(document, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def prepare_document(entry):
+    """Give a page row of the corpus its stable _id and clean its text fields, in place."""
+    entry['_id'] = document_id(entry['barcode'], entry['page'])
+    # Keep the page as a string, as in the documents indexed from the CSV
+    entry['page'] = str(entry['page'])
     entry['text_orig'] = clean_text(entry['text_orig'])
     entry['text_clean'] = clean_text(entry['text_clean'])
     entry['text_prep'] = clean_text(entry['text_prep'])
+    return entry
+
+def apply_page_labels(documents, labels_path):
+    """
+    Drop empty and boilerplate pages and set 'duplicate_of' of near-duplicate pages to the _id of their canonical page,
+    with the labels written by dedup_pages.py.
+    """
+    rows = load_labels(labels_path)
+    labels = {document_id(row['barcode'], row['page']): row for row in rows.values()}
+    if not labels:
+        return documents
+
+    kept = []
+    for document in documents:
+        label = labels.get(document['_id'])
+        if label is None or label['label'] == 'unique':
+            kept.append(document)
+        elif label['label'] == 'duplicate':
+            # The canonical path is relative to the labelled folder, so take the barcode and page from its own row
+            canonical = rows[label['canonical']]
+            document['duplicate_of'] = document_id(canonical['barcode'], canonical['page'])
+            kept.append(document)
+    print(f"Skipping {len(documents) - len(kept)} empty or boilerplate pages")
+    return kept
+
+def load_documents(corpus_store_dir, page_labels_file=None):
+    # Load list of dictionaries with each dictionary containing keys: text, barcode, page
+    # Read only the needed columns from the memory-mapped store into a list of dictionaries
+    columns = ["barcode", "page", "iiif_link", "text_orig", "text_clean", "text_prep"]
+    documents = read_corpus(corpus_store_dir, columns=columns).to_pylist()
+
+    # Clean the 'text' field in each dictionary
+    for entry in documents:
+        prepare_document(entry)
 
-pprint(animal_descriptions[:3])
+    if page_labels_file:
+        documents = apply_page_labels(documents, page_labels_file)
+
+    # Store the offsets of the sentence chunks of the tensor fields with every document
+    preprocessing = settings["textPreprocessing"]
+    return add_chunk_offsets(documents, TENSOR_FIELDS, preprocessing["splitLength"], preprocessing["splitOverlap"])
+
+##
+## Ledger of indexed documents
+##
+
+class IndexLedger:
+    """
+    SQLite record of the content hash of every document that the index confirmed, one ledger file per index.
+    """
+
+    def __init__(self, index_name, ledger_dir=LEDGER_DIR):
+        os.makedirs(ledger_dir, exist_ok=True)
+        self.path = os.path.join(ledger_dir, f"{index_name}_ledger.sqlite")
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS indexed (doc_id TEXT PRIMARY KEY, hash TEXT NOT NULL, indexed_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        self._hashes = None
+
+    def hashes(self):
+        """Hashes by doc_id, read from the ledger once and then kept up to date by record()."""
+        if self._hashes is None:
+            self._hashes = dict(self._connection.execute("SELECT doc_id, hash FROM indexed"))
+        return self._hashes
+
+    def record(self, entries):
+        """Checkpoint (doc_id, hash) pairs of a completed batch."""
+        entries = list(entries)
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO indexed (doc_id, hash, indexed_at) VALUES (?, ?, ?)",
+            [(doc_id, doc_hash, now) for doc_id, doc_hash in entries],
+        )
+        self._connection.commit()
+        if self._hashes is not None:
+            self._hashes.update(entries)
+
+    def last_indexed(self):
+        """Time of the last checkpoint, None if nothing was indexed yet."""
+        return self._connection.execute("SELECT MAX(indexed_at) FROM indexed").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
 
 ##
 ## Add documents to the index
 ##
 
-print(f"Indexing data...")
-# Define client_batch_size
-client_batch_size = 128
+def pending_documents(documents, ledger):
+    """Return (document, hash) pairs of the documents that are new or changed since they were last indexed."""
+    indexed = ledger.hashes()
+    pending = []
+    for document in documents:
+        doc_hash = content_hash(document)
+        if indexed.get(document['_id']) != doc_hash:
+            pending.append((document, doc_hash))
+    return pending
+
+def index_documents(client, index_name, documents, ledger, batch_size=BATCH_SIZE):
+    """
+    Upsert new or changed documents in batches and checkpoint every batch in the ledger.
+
+    Returns:
+    - tuple: The number of indexed documents and the number of documents that failed.
+    """
+    pending = pending_documents(documents, ledger)
+    print(f"{len(pending)} of {len(documents)} documents are new or changed")
+    metrics.set("index_documents_unchanged", len(documents) - len(pending))
+
+    indexed = 0
+    failed = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        with metrics.timer("index_batch_seconds"):
+            response = client.index(index_name).add_documents(
+                [document for document, _ in batch],
+                tensor_fields=TENSOR_FIELDS,
+            )
+
+        # Only record the documents that Marqo confirmed, failed ones are retried on the next run
+        hashes = {document['_id']: doc_hash for document, doc_hash in batch}
+        confirmed = [(item['_id'], hashes[item['_id']]) for item in response.get('items', [])
+                     if item.get('status', 200) < 300 and item.get('_id') in hashes]
+        ledger.record(confirmed)
+
+        indexed += len(confirmed)
+        failed += len(batch) - len(confirmed)
+        metrics.inc("index_documents_total", len(confirmed), status="indexed")
+        metrics.inc("index_documents_total", len(batch) - len(confirmed), status="failed")
+        print(f"Batch {start // batch_size + 1}: indexed {indexed}/{len(pending)} documents ({failed} failed)")
+
+    return indexed, failed
+
+if __name__ == '__main__':
+    marqoClient = get_client()
+    #pprint(marqoClient.get_indexes())
+
+    indexName = "onit-sonnini-DHd2025-clean"
+    print("Indexname: ", indexName)
+    ensure_index(marqoClient, indexName)
+    pprint(marqoClient.get_indexes())
+
+    # Corpus store path (written by extract_data.py, or converted from the index CSV with corpus_store.py)
+    corpus_store_dir = 'data/indices/DHd_index-cleaned/'
+    # Page labels written by dedup_pages.py into the folder of the cleaned pages
+    page_labels_file = 'output/path/page_labels.csv'
+    animal_descriptions = load_documents(corpus_store_dir, page_labels_file)
+    pprint(animal_descriptions[:3])
 
-# Indexing
-marqoClient.index(indexName).add_documents(
-    animal_descriptions,
-    client_batch_size=client_batch_size,
-    tensor_fields=["text_clean"],
-)
+    print(f"Indexing data...")
+    ledger = IndexLedger(indexName)
+    try:
+        indexed, failed = index_documents(marqoClient, indexName, animal_descriptions, ledger)
+    finally:
+        ledger.close()
 
-print(f"Data has been indexed in {indexName}")
\ No newline at end of file
+    print(f"Data has been indexed in {indexName} ({indexed} documents upserted, {failed} failed)")
+    metrics.write_report("index_data")
@@ -0,0 +1,465 @@
+"""
+Embedded vector index that runs inside the process, as an alternative backend to the Marqo server for experiments
+and CI. It implements the parts of the Marqo client API that index_data.py uses (get_indexes, create_index,
+index(name).add_documents) plus index(name).search, so the backends can be switched and compared on the same corpus.
+Lexical search (search_method="LEXICAL") uses the BM25 index from bm25_index.py over the tensor fields.
+Tensor fields are split into chunks with sentence_chunker.py; chunk offsets that are stored in a document
+('chunk_offsets', see index_data.py) are used as they are, and documents marked as near-duplicates ('duplicate_of')
+copy the chunks and embeddings of their canonical page if it is already indexed.
+
+Every index is a directory with
+- settings.json: model, split settings, embedding size and dtype,
+- index.sqlite: the documents and their chunks (one row of the embedding matrix per chunk),
+- embeddings.bin: the chunk embeddings as a row-major float16/float32 matrix, opened memory-mapped,
+- ivf.npz (optional): an IVF index (k-means centroids and the list of every chunk) built with build_ivf().
+
+Search is exact top-k by batched matrix multiplication over the memory-mapped matrix; with an IVF index only the
+chunks in the nprobe closest lists (and chunks added after the IVF index was built) are scored.
+
+Code by Michela Vignoli.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from bm25_index import BM25Index
+from sentence_chunker import chunk_spans
+
+INDEX_ROOT = 'data/indices/local/'
+
+# Number of matrix rows multiplied at once when scanning the embeddings
+BLOCK_SIZE = 65536
+
+DEFAULT_SETTINGS = {
+    "textPreprocessing": {
+        "splitLength": 2,
+        "splitOverlap": 0,
+        "splitMethod": "sentence",
+    },
+}
+
+FILTER_TERM_PATTERN = re.compile(r'(\w+):\(([^)]*)\)')
+FILTER_OPERATORS = ('AND', 'OR')
+
+
+def load_embedder(model_name):
+    """Return a function that embeds a list of texts into L2-normalized float32 vectors with sentence-transformers."""
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name)
+
+    def embed(texts):
+        return model.encode(list(texts), batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+
+    return embed
+
+
+class EmbeddingCache:
+    """Wraps an embedding function and embeds every distinct text only once."""
+
+    def __init__(self, embed, max_entries=100000):
+        self.embed = embed
+        self.max_entries = max_entries
+        self._vectors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        texts = list(texts)
+        with self._lock:
+            vectors = {text: self._vectors[text] for text in texts if text in self._vectors}
+        missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+        if missing:
+            new_vectors = dict(zip(missing, np.asarray(self.embed(missing), dtype=np.float32)))
+            vectors.update(new_vectors)
+            with self._lock:
+                if len(self._vectors) + len(new_vectors) > self.max_entries:
+                    self._vectors.clear()
+                self._vectors.update(new_vectors)
+        return np.stack([vectors[text] for text in texts])
+
+
+def parse_filter_string(filter_string):
+    """
+    Parse filters like 'barcode:(Z166069305) OR barcode:(Z166069408) AND page:(12)' into a list of groups of
+    (field, value) pairs: a document matches if it matches all pairs of any group (AND binds tighter than OR, as in
+    Marqo). Other operators and nested parentheses raise a ValueError.
+    """
+    if not filter_string:
+        return None
+    groups = [[]]
+    position = 0
+    for match in FILTER_TERM_PATTERN.finditer(filter_string):
+        operator = filter_string[position:match.start()].strip()
+        if groups[0] and operator == 'OR':
+            groups.append([])
+        elif operator != ('AND' if groups[0] else ''):
+            raise ValueError(f"Unsupported filter string: {filter_string} (only {' and '.join(FILTER_OPERATORS)} "
+                             f"between field:(value) terms)")
+        groups[-1].append(match.groups())
+        position = match.end()
+    if not groups[0] or filter_string[position:].strip():
+        raise ValueError(f"Unsupported filter string: {filter_string}")
+    return groups
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class LocalIndex:
+
+    def __init__(self, path, embed):
+        self.path = path
+        self.embed = embed
+        with open(os.path.join(path, 'settings.json'), 'r', encoding='utf-8') as f:
+            self.settings = json.load(f)
+        self.dtype = np.dtype(self.settings['dtype'])
+        self._connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, doc_id TEXT NOT NULL, field TEXT NOT NULL,"
+            " text TEXT NOT NULL, alive INTEGER NOT NULL)"
+        )
+        self._connection.commit()
+        self._load_rows()
+        self._load_ivf()
+        self._bm25 = None
+
+    ##
+    ## Storage
+    ##
+
+    @property
+    def _embeddings_path(self):
+        return os.path.join(self.path, 'embeddings.bin')
+
+    def _load_rows(self):
+        rows = self._connection.execute("SELECT doc_id, alive FROM chunks ORDER BY row").fetchall()
+        self.row_doc_ids = np.array([doc_id for doc_id, _ in rows], dtype=object)
+        self.row_alive = np.array([alive for _, alive in rows], dtype=bool)
+        self._matrix = None
+        self._truncate_embeddings()
+
+    def _truncate_embeddings(self):
+        # Embeddings are appended before their chunks are committed, so an interrupted add_documents can leave rows
+        # without chunks at the end of the file; drop them, or every later row would be stored after them
+        if self.settings.get('dim') is None or not os.path.exists(self._embeddings_path):
+            return
+        committed_size = len(self.row_alive) * self.settings['dim'] * self.dtype.itemsize
+        if os.path.getsize(self._embeddings_path) > committed_size:
+            with open(self._embeddings_path, 'r+b') as f:
+                f.truncate(committed_size)
+
+    def _load_ivf(self):
+        ivf_path = os.path.join(self.path, 'ivf.npz')
+        self.ivf = dict(np.load(ivf_path)) if os.path.exists(ivf_path) else None
+
+    def matrix(self):
+        """The chunk embeddings as a read-only memory-mapped matrix."""
+        if self._matrix is None and len(self.row_alive):
+            self._matrix = np.memmap(self._embeddings_path, dtype=self.dtype, mode='r',
+                                     shape=(len(self.row_alive), self.settings['dim']))
+        return self._matrix
+
+    def _append_embeddings(self, vectors):
+        if self.settings.get('dim') is None:
+            self.settings['dim'] = int(vectors.shape[1])
+            with open(os.path.join(self.path, 'settings.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.settings, f, indent=1)
+        with open(self._embeddings_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+
+    ##
+    ## Marqo-compatible API
+    ##
+
+    def add_documents(self, documents, tensor_fields=None, client_batch_size=None):
+        """Upsert documents by _id, embedding the sentence chunks of their tensor fields."""
+        start_time = time.perf_counter()
+        preprocessing = self.settings['settings'].get('textPreprocessing', {})
+        split_length = preprocessing.get('splitLength', 2)
+        split_overlap = preprocessing.get('splitOverlap', 0)
+
+        first_row = len(self.row_alive)
+        chunk_rows = []
+        # Matrix row to copy the embedding of every chunk from, None for chunks that are embedded
+        copy_rows = []
+        for document in documents:
+            # Near-duplicate pages (see dedup_pages.py) reuse the chunks of their indexed canonical page
+            canonical_chunks = self._alive_chunks(document['duplicate_of']) if document.get('duplicate_of') else []
+            for row, field, text in canonical_chunks:
+                chunk_rows.append((document['_id'], field, text))
+                copy_rows.append(row)
+            if canonical_chunks:
+                continue
+
+            # Chunks precomputed by sentence_chunker.add_chunk_offsets are used as they are
+            offsets = json.loads(document['chunk_offsets']) if document.get('chunk_offsets') else {}
+            for field in tensor_fields or []:
+                text = document.get(field) or ''
+                spans = offsets[field] if field in offsets else chunk_spans(text, split_length, split_overlap)
+                for start, end in spans:
+                    chunk_rows.append((document['_id'], field, text[start:end]))
+                    copy_rows.append(None)
+
+        if chunk_rows:
+            texts = [text for (_, _, text), row in zip(chunk_rows, copy_rows) if row is None]
+            embedded = iter(normalize(self.embed(texts)) if texts else [])
+            matrix = self.matrix()
+            self._append_embeddings(np.stack([next(embedded) if row is None else np.asarray(matrix[row], np.float32)
+                                              for row in copy_rows]))
+
+        # Chunks of earlier versions of the documents stay in the matrix, but are no longer searched
+        doc_ids = [(document['_id'],) for document in documents]
+        self._connection.executemany("UPDATE chunks SET alive = 0 WHERE doc_id = ?", doc_ids)
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO documents (doc_id, body) VALUES (?, ?)",
+            [(document['_id'], json.dumps(document, ensure_ascii=False)) for document in documents],
+        )
+        self._connection.executemany(
+            "INSERT INTO chunks (row, doc_id, field, text, alive) VALUES (?, ?, ?, ?, 1)",
+            [(first_row + i, doc_id, field, text) for i, (doc_id, field, text) in enumerate(chunk_rows)],
+        )
+        self._connection.commit()
+        self._load_rows()
+        self._bm25 = None
+
+        items = [{"_id": document['_id'], "status": 200, "result": "created"} for document in documents]
+        return {"errors": False, "items": items,
+                "processingTimeMs": (time.perf_counter() - start_time) * 1000, "index_name": self.settings['name']}
+
+    def _alive_chunks(self, document_id):
+        """(row, field, text) of the searched chunks of an indexed document, empty if it is not indexed."""
+        return self._connection.execute(
+            "SELECT row, field, text FROM chunks WHERE doc_id = ? AND alive = 1 ORDER BY row", (document_id,)
+        ).fetchall()
+
+    def get_document(self, document_id):
+        row = self._connection.execute("SELECT body FROM documents WHERE doc_id = ?", (document_id,)).fetchone()
+        if row is None:
+            raise KeyError(document_id)
+        return json.loads(row[0])
+
+    def get_stats(self):
+        return {"numberOfDocuments": self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0],
+                "numberOfVectors": int(self.row_alive.sum())}
+
+    def search(self, q, limit=10, filter_string=None, search_method="TENSOR", nprobe=None):
+        if search_method.upper() == "LEXICAL":
+            return self.search_lexical(q, limit=limit, filter_string=filter_string)
+        if search_method.upper() != "TENSOR":
+            raise NotImplementedError(f"Search method {search_method} is not supported by the local index")
+        return self.search_batch([q], limit=limit, filter_string=filter_string, nprobe=nprobe)[0]
+
+    def search_lexical(self, q, limit=10, filter_string=None):
+        """BM25 search over the text of the tensor fields, built on first use after the documents changed."""
+        start_time = time.perf_counter()
+        if self._bm25 is None:
+            documents = self._connection.execute(
+                "SELECT doc_id, group_concat(text, ' ') FROM (SELECT doc_id, text FROM chunks WHERE alive = 1"
+                " ORDER BY row) GROUP BY doc_id")
+            self._bm25 = BM25Index.build(documents)
+
+        filter_groups = parse_filter_string(filter_string)
+        if filter_groups:
+            allowed = set(self.row_doc_ids[self._row_mask(filter_groups)])
+            ranking = [(doc_id, score) for doc_id, score in self._bm25.search(q, limit=len(self._bm25.doc_ids))
+                       if doc_id in allowed][:limit]
+        else:
+            ranking = self._bm25.search(q, limit=limit)
+
+        hits = []
+        for doc_id, score in ranking:
+            hit = self.get_document(doc_id)
+            hit["_highlights"] = []
+            hit["_score"] = float(score)
+            hits.append(hit)
+        return {"hits": hits, "query": q, "limit": limit,
+                "processingTimeMs": (time.perf_counter() - start_time) * 1000}
+
+    def search_batch(self, queries, limit=10, filter_string=None, nprobe=None):
+        """
+        Run several queries with one matrix multiplication per block of the embedding matrix.
+
+        Returns:
+        - list: One Marqo-shaped result ({"hits": [...], "processingTimeMs": ...}) per query.
+        """
+        start_time = time.perf_counter()
+        query_vectors = normalize(self.embed(list(queries)))
+        mask = self._row_mask(parse_filter_string(filter_string))
+
+        if self.ivf is not None and nprobe:
+            top_rows = [self._search_ivf(query_vector, mask, limit, nprobe) for query_vector in query_vectors]
+        else:
+            top_rows = self._search_exact(query_vectors, mask, limit)
+
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        return [{"hits": self._hits(rows, scores, limit), "query": query, "limit": limit,
+                 "processingTimeMs": elapsed_ms}
+                for query, (rows, scores) in zip(queries, top_rows)]
+
+    ##
+    ## Search internals
+    ##
+
+    def _row_mask(self, filter_groups):
+        mask = self.row_alive.copy()
+        if filter_groups:
+            allowed = set()
+            for group in filter_groups:
+                matching = None
+                for field, value in group:
+                    doc_ids = {doc_id for (doc_id,) in self._connection.execute(
+                        "SELECT doc_id FROM documents WHERE CAST(json_extract(body, ?) AS TEXT) = ?",
+                        (f'$.{field}', value))}
+                    matching = doc_ids if matching is None else matching & doc_ids
+                allowed |= matching
+            mask &= np.isin(self.row_doc_ids, list(allowed))
+        return mask
+
+    def _candidates(self, limit):
+        # Take enough chunks to find limit distinct documents even if documents have several matching chunks
+        return min(max(limit * 8, 64), len(self.row_alive))
+
+    def _search_exact(self, query_vectors, mask, limit):
+        matrix = self.matrix()
+        if matrix is None:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))] * len(query_vectors)
+
+        n_candidates = self._candidates(limit)
+        best_rows = np.empty((len(query_vectors), 0), dtype=np.int64)
+        best_scores = np.empty((len(query_vectors), 0), dtype=np.float32)
+        for start in range(0, matrix.shape[0], BLOCK_SIZE):
+            block = np.asarray(matrix[start:start + BLOCK_SIZE], dtype=np.float32)
+            scores = query_vectors @ block.T
+            scores[:, ~mask[start:start + BLOCK_SIZE]] = -np.inf
+
+            # Keep the running top candidates of every query
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + block.shape[0]),
+                                                              (len(query_vectors), block.shape[0]))], axis=1)
+            if scores.shape[1] > n_candidates:
+                keep = np.argpartition(-scores, n_candidates - 1, axis=1)[:, :n_candidates]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        for rows, scores in zip(best_rows, best_scores):
+            order = np.argsort(-scores, kind='stable')
+            valid = np.isfinite(scores[order])
+            results.append((rows[order][valid], scores[order][valid]))
+        return results
+
+    def _search_ivf(self, query_vector, mask, limit, nprobe):
+        centroids = self.ivf['centroids']
+        lists = self.ivf['lists']
+        probed = np.argsort(-(centroids @ query_vector))[:nprobe]
+
+        # Chunks added after the IVF index was built are always scored
+        candidate_rows = np.concatenate([np.flatnonzero(np.isin(lists, probed)),
+                                         np.arange(len(lists), len(self.row_alive))])
+        candidate_rows = candidate_rows[mask[candidate_rows]]
+        if not len(candidate_rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.asarray(self.matrix()[candidate_rows], dtype=np.float32) @ query_vector
+        n_candidates = min(self._candidates(limit), len(scores))
+        keep = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        order = keep[np.argsort(-scores[keep], kind='stable')]
+        return candidate_rows[order], scores[order]
+
+    def _hits(self, rows, scores, limit):
+        hits = []
+        seen = set()
+        for row, score in zip(rows, scores):
+            doc_id = self.row_doc_ids[row]
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            field, text = self._connection.execute(
+                "SELECT field, text FROM chunks WHERE row = ?", (int(row),)).fetchone()
+            hit = self.get_document(doc_id)
+            hit["_highlights"] = [{field: text}]
+            hit["_score"] = float(score)
+            hits.append(hit)
+            if len(hits) == limit:
+                break
+        return hits
+
+    ##
+    ## Approximate search
+    ##
+
+    def build_ivf(self, n_lists=256, iterations=10, sample_size=100000, seed=0):
+        """Cluster the chunk embeddings with k-means and store the IVF lists for approximate search."""
+        matrix = self.matrix()
+        if matrix is None:
+            return
+        rng = np.random.default_rng(seed)
+        alive_rows = np.flatnonzero(self.row_alive)
+        sample = np.sort(rng.choice(alive_rows, size=min(sample_size, len(alive_rows)), replace=False))
+        vectors = np.asarray(matrix[sample], dtype=np.float32)
+
+        n_lists = min(n_lists, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            for list_id in range(n_lists):
+                members = vectors[assignment == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = normalize(centroids)
+
+        lists = np.empty(matrix.shape[0], dtype=np.int32)
+        for start in range(0, matrix.shape[0], BLOCK_SIZE):
+            block = np.asarray(matrix[start:start + BLOCK_SIZE], dtype=np.float32)
+            lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        np.savez(os.path.join(self.path, 'ivf.npz'), centroids=centroids, lists=lists)
+        self._load_ivf()
+
+    def memory_usage(self):
+        """Size of the embedding matrix on disk (it is memory-mapped, so only touched pages use RAM)."""
+        return os.path.getsize(self._embeddings_path) if os.path.exists(self._embeddings_path) else 0
+
+
+class LocalClient:
+    """
+    Parameters:
+    - root (str): Directory that holds one subdirectory per index.
+    - embed (callable): Function that embeds a list of texts; defaults to the index model via sentence-transformers.
+    - dtype (str): 'float16' or 'float32', the dtype of the stored embeddings.
+    """
+
+    def __init__(self, root=INDEX_ROOT, embed=None, dtype='float16'):
+        self.root = root
+        self.embed = embed
+        self.dtype = dtype
+        self._indexes = {}
+        os.makedirs(root, exist_ok=True)
+
+    def get_indexes(self):
+        return {"results": [{"indexName": name} for name in sorted(os.listdir(self.root))
+                            if os.path.exists(os.path.join(self.root, name, 'settings.json'))]}
+
+    def create_index(self, index_name, model=None, settings_dict=None):
+        path = os.path.join(self.root, index_name)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'settings.json'), 'w', encoding='utf-8') as f:
+            json.dump({"name": index_name, "model": model, "settings": settings_dict or DEFAULT_SETTINGS,
+                       "dtype": self.dtype, "dim": None}, f, indent=1)
+
+    def index(self, index_name):
+        if index_name not in self._indexes:
+            path = os.path.join(self.root, index_name)
+            with open(os.path.join(path, 'settings.json'), 'r', encoding='utf-8') as f:
+                model = json.load(f)['model']
+            embed = self.embed or load_embedder(model)
+            self._indexes[index_name] = LocalIndex(path, embed)
+        return self._indexes[index_name]
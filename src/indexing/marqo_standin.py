@@ -0,0 +1,69 @@
+"""
+In-process stand-in for the parts of the Marqo client API that index_data.py uses (get_indexes, create_index,
+index(name).add_documents). Documents are kept in memory, and failures can be injected to check that an interrupted
+or partially failed run resumes correctly.
+
+Example:
+    from index_data import IndexLedger, ensure_index, index_documents
+    from marqo_standin import StandInClient
+
+    client = StandInClient(fail_on_call=3)  # the third add_documents request raises
+    ensure_index(client, "test-index")
+    index_documents(client, "test-index", documents, IndexLedger("test-index", ledger_dir="/tmp/ledger/"))
+
+Code by Michela Vignoli.
+"""
+
+
+class StandInIndex:
+
+    def __init__(self, client, index_name, model=None, settings_dict=None):
+        self.client = client
+        self.index_name = index_name
+        self.model = model
+        self.settings_dict = settings_dict
+        self.documents = {}
+
+    def add_documents(self, documents, tensor_fields=None, client_batch_size=None):
+        """Upsert documents by _id and return a response shaped like Marqo's."""
+        self.client.calls += 1
+        if self.client.fail_on_call is not None and self.client.calls == self.client.fail_on_call:
+            raise ConnectionError(f"Injected failure on add_documents call {self.client.calls}")
+
+        items = []
+        for document in documents:
+            if document['_id'] in self.client.failing_ids:
+                items.append({"_id": document['_id'], "status": 500, "message": "Injected failure"})
+                continue
+            self.documents[document['_id']] = dict(document)
+            items.append({"_id": document['_id'], "status": 200, "result": "created"})
+        return {"errors": any(item["status"] >= 300 for item in items), "index_name": self.index_name, "items": items}
+
+    def get_document(self, document_id):
+        return self.documents[document_id]
+
+    def get_stats(self):
+        return {"numberOfDocuments": len(self.documents)}
+
+
+class StandInClient:
+    """
+    Parameters:
+    - fail_on_call (int): Raise on the n-th add_documents request (counted over all indexes).
+    - failing_ids (set): Document ids that are always reported with status 500.
+    """
+
+    def __init__(self, fail_on_call=None, failing_ids=()):
+        self.fail_on_call = fail_on_call
+        self.failing_ids = set(failing_ids)
+        self.calls = 0
+        self.indexes = {}
+
+    def get_indexes(self):
+        return {"results": [{"indexName": index_name} for index_name in self.indexes]}
+
+    def create_index(self, index_name, model=None, settings_dict=None):
+        self.indexes[index_name] = StandInIndex(self, index_name, model=model, settings_dict=settings_dict)
+
+    def index(self, index_name):
+        return self.indexes[index_name]
@@ -0,0 +1,155 @@
+"""
+Deterministic sentence chunker for historical German OCR text, mirroring the index settings
+splitMethod 'sentence', splitLength and splitOverlap. Chunks are returned as exact (start, end) character offsets
+into the page, so every chunk is text[start:end] and a retrieved chunk can be placed on the page by a dictionary
+lookup instead of fuzzy matching.
+
+A sentence ends at '.', '!' or '?' (and closing quotes or brackets) followed by whitespace, except
+- before a lowercase letter or ',;:' (abbreviations, OCR noise like 'an. fänglich' and words broken at a
+  hyphenated line end like 'Kut. scher'),
+- after the abbreviations in ABBREVIATIONS (compared with ſ read as s), single letters (initials like 'C. S.')
+  and numbers of up to two digits (ordinals like 'den 3. May').
+
+index_data.py stores the offsets of the tensor fields with every document (field 'chunk_offsets', a JSON string
+{field: [[start, end], ...]}); chunking runs in parallel across processes before the documents are sent to the index.
+
+Code by Michela Vignoli.
+"""
+
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+[\'"»«“”‘’)\]]*(?=\s|$)')
+LAST_WORD_PATTERN = re.compile(r'(\S+)$')
+NEXT_CHAR_PATTERN = re.compile(r'\s*(\S)')
+
+ABBREVIATIONS = {
+    "bd", "bde", "bl", "ca", "cap", "dergl", "dgl", "dr", "ebd", "etc", "ew", "ff", "fig", "fol", "fr", "geb", "gest",
+    "hl", "hr", "hrn", "ibid", "jh", "jun", "kap", "kk", "lib", "mad", "mr", "nr", "no", "pag", "sc", "sen", "seq", "sq",
+    "sqq", "sr", "st", "tab", "th", "ua", "usw", "vgl", "zb",
+}
+
+CONTINUATION_CHARS = set(',;:')
+LEADING_CHARS = '(["\'»«“”‘’'
+
+# Documents chunked per task when chunking in parallel
+CHUNKSIZE = 256
+
+
+def is_sentence_end(text, start, end):
+    """Decide whether the punctuation text[start:end] ends a sentence."""
+    following = NEXT_CHAR_PATTERN.match(text, end)
+    if following is None:
+        return True
+    next_char = following.group(1)
+    if next_char.islower() or next_char in CONTINUATION_CHARS:
+        return False
+    if text[start] != '.' or text.startswith('..', start):
+        # '!', '?' and ellipses always end a sentence
+        return True
+
+    last_word = LAST_WORD_PATTERN.search(text, max(0, start - 40), start)
+    if last_word is None:
+        return True
+    word = last_word.group(1).lstrip(LEADING_CHARS).replace('ſ', 's').replace('.', '').lower()
+    if word in ABBREVIATIONS:
+        return False
+    if len(word) == 1 and word.isalpha():
+        return False
+    if word.isdigit() and len(word) <= 2:
+        return False
+    return True
+
+
+def split_sentences(text):
+    """Return the (start, end) offsets of the sentences in text, without surrounding whitespace."""
+    sentences = []
+    start = None
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        if start is None:
+            leading = NEXT_CHAR_PATTERN.match(text, 0 if not sentences else sentences[-1][1])
+            if leading is None:
+                break
+            start = leading.start(1)
+        if match.start() < start:
+            continue
+        if is_sentence_end(text, match.start(), match.end()):
+            sentences.append((start, match.end()))
+            start = None
+
+    # Text after the last sentence end
+    position = sentences[-1][1] if sentences else 0
+    remainder = NEXT_CHAR_PATTERN.match(text, position)
+    if remainder is not None:
+        sentences.append((remainder.start(1), len(text.rstrip())))
+    return sentences
+
+
+def chunk_spans(text, split_length=2, split_overlap=0):
+    """Split text into chunks of split_length sentences and return their (start, end) offsets."""
+    sentences = split_sentences(text or '')
+    step = max(split_length - split_overlap, 1)
+    return [(sentences[i][0], sentences[min(i + split_length, len(sentences)) - 1][1])
+            for i in range(0, len(sentences), step)]
+
+
+def split_text(text, split_length=2, split_overlap=0):
+    """Split text into chunks of split_length sentences."""
+    return [text[start:end] for start, end in chunk_spans(text, split_length, split_overlap)]
+
+
+def chunk_offsets(document, fields, split_length=2, split_overlap=0):
+    """Return the chunk offsets of the given fields of a document as {field: [[start, end], ...]}."""
+    return {field: [list(span) for span in chunk_spans(document.get(field) or '', split_length, split_overlap)]
+            for field in fields}
+
+
+def _chunk_offsets_json(args):
+    return json.dumps(chunk_offsets(*args), separators=(',', ':'))
+
+
+def add_chunk_offsets(documents, fields, split_length=2, split_overlap=0, max_workers=None):
+    """Store the chunk offsets of the given fields in every document (field 'chunk_offsets'), chunking in parallel."""
+    tasks = [({field: document.get(field) for field in fields}, fields, split_length, split_overlap)
+             for document in documents]
+    if len(tasks) <= CHUNKSIZE:
+        results = [_chunk_offsets_json(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            results = list(executor.map(_chunk_offsets_json, tasks, chunksize=CHUNKSIZE))
+    for document, offsets in zip(documents, results):
+        document['chunk_offsets'] = offsets
+    return documents
+
+
+def chunk_lookup(document, field):
+    """Return a dict from the text of every chunk of a field to its (start, end) offsets in the field."""
+    if not document.get('chunk_offsets'):
+        return {}
+    text = document.get(field) or ''
+    return {text[start:end]: (start, end) for start, end in json.loads(document['chunk_offsets']).get(field, [])}
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+    from corpus_store import read_corpus
+
+    corpus_store_dir = sys.argv[1] if len(sys.argv) > 1 else 'data/indices/DHd_index-cleaned/'
+    documents = read_corpus(corpus_store_dir, columns=["barcode", "page", "text_clean"]).to_pylist()
+    for document in documents:
+        document['text_clean'] = (document['text_clean'] or '').replace('\n', ' ').strip()
+
+    start_time = time.perf_counter()
+    add_chunk_offsets(documents, ["text_clean"])
+    seconds = time.perf_counter() - start_time
+    n_chunks = sum(len(json.loads(document['chunk_offsets'])["text_clean"]) for document in documents)
+    print(f"Chunked {len(documents)} pages into {n_chunks} chunks in {seconds:.2f} s")
+
+    example = documents[0]
+    for start, end in json.loads(example['chunk_offsets'])["text_clean"][:5]:
+        print(f"[{start}:{end}] {example['text_clean'][start:end]}")
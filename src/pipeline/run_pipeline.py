@@ -0,0 +1,397 @@
+"""
+Runs the whole pipeline as one streaming process, with keyword extraction as a branch after cleaning:
+
+    original OCR pages - clean -+- correct (LLM) - extract - index
+                                +- keywords (LLM)
+
+Every stage runs on its own thread and hands the pages on through bounded queues of queue_size pages, so all stages
+work at the same time, and a slow stage (usually the LLM) holds back the stages before it instead of letting pages
+pile up in memory. Every stage persists its output in the work directory, in the layout of the single scripts:
+- clean/<barcode>_clean/<page>.txt (clean_books.py, per page),
+- prep/<barcode>_clean_preprocessed/<page>_corrected.txt or <page>_FAILED.txt (llm_preprocessing.py),
+- keywords/<barcode>_keywords/<page>_keywords.txt or <page>_FAILED.txt (llm_keywords.py),
+- index.csv and corpus_store/ (extract_data.py),
+- the index and its ledger (index_data.py).
+
+--from-stage restarts the pipeline at a stage: the stages before it are not run and their persisted output is read
+instead (e.g. --from-stage extract reads the cleaned and corrected pages, --from-stage index the corpus store).
+--to-stage stops after a stage and --skip leaves out single stages (e.g. keywords, or index without an index server).
+LLM answers are cached (llm_cache.py), so a restarted LLM stage only sends the pages that were not answered yet.
+Empty pages (see dedup_pages.is_empty) are passed through the LLM stages without a request.
+A failing stage cancels the pipeline: the other stages stop without taking the pages they got so far for their complete
+input, and index.csv and corpus_store/ are only replaced once the extract stage has written all pages.
+
+input_dir contains one folder of original OCR page files per book (<barcode>/<page>.txt).
+
+Usage:
+    python src/pipeline/run_pipeline.py input_dir work_dir [--from-stage clean] [--to-stage index] [--skip keywords]
+        [--index-name onit-sonnini-DHd2025-clean] [--backend marqo] [--ollama-url URL] [--max-in-flight 4]
+        [--queue-size 64]
+
+Set ONIT_METRICS_DIR to write a run report with the pages and the time blocked by backpressure per stage.
+
+Code by Michela Vignoli.
+"""
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+here = os.path.dirname(os.path.abspath(__file__))
+for folder in ('preprocessing', 'utils', 'indexing'):
+    sys.path.append(os.path.join(here, '..', folder))
+from clean_books import clean_book
+from corpus_store import write_corpus_store, read_corpus
+from dedup_pages import is_empty
+from extract_data import collect_files, index_files, process_file, iiif_link, write_csv
+from index_data import (get_client, ensure_index, prepare_document, index_documents, IndexLedger, settings,
+                        TENSOR_FIELDS, BATCH_SIZE, INDEX_BACKEND)
+from llm_cache import LLMCache
+from llm_keywords import PROMPT as KEYWORDS_PROMPT
+from llm_preprocessing import PROMPT as CORRECTION_PROMPT
+from metrics import metrics
+from ollama_client import OllamaClient, OLLAMA_URL, MAX_IN_FLIGHT
+from page_packing import PagePacker, TOKEN_BUDGET
+from sentence_chunker import add_chunk_offsets
+
+STAGES = ["clean", "correct", "keywords", "extract", "index"]
+# Stage whose output every stage reads ('source': the original OCR pages in input_dir)
+UPSTREAM = {"clean": "source", "correct": "clean", "keywords": "clean", "extract": "correct", "index": "extract"}
+
+INDEX_NAME = "onit-sonnini-DHd2025-clean"
+
+# Pages waiting between two stages
+QUEUE_SIZE = 64
+# Interval in seconds at which blocked stages check whether the pipeline was cancelled
+POLL_SECONDS = 0.2
+
+
+##
+## Layout of the work directory
+##
+
+def clean_path(work_dir, barcode, page):
+    return os.path.join(work_dir, 'clean', f"{barcode}_clean", f"{page}.txt")
+
+def prep_path(work_dir, barcode, page, failed=False):
+    return os.path.join(work_dir, 'prep', f"{barcode}_clean_preprocessed", f"{page}_{'FAILED' if failed else 'corrected'}.txt")
+
+def keywords_path(work_dir, barcode, page, failed=False):
+    return os.path.join(work_dir, 'keywords', f"{barcode}_keywords", f"{page}_{'FAILED' if failed else 'keywords'}.txt")
+
+def csv_path(work_dir):
+    return os.path.join(work_dir, 'index.csv')
+
+def store_path(work_dir):
+    return os.path.join(work_dir, 'corpus_store')
+
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def read_optional(path):
+    return process_file(path) if path and os.path.exists(path) else None
+
+def page_files(folder):
+    """Yield (barcode, page, path) of the page files in the book folders of folder, in a stable order."""
+    for root, subfolders, files in os.walk(folder):
+        subfolders.sort()
+        for file in sorted(files):
+            if file.endswith('.txt'):
+                yield os.path.basename(root)[:10], file[:5], os.path.join(root, file)
+
+
+##
+## Readers of the persisted output of every stage, for restarts
+##
+
+def read_source(context):
+    for barcode, page, path in page_files(context.input_dir):
+        yield {"barcode": barcode, "page": page, "text_orig": process_file(path)}
+
+def read_clean(context):
+    for barcode, page, path in page_files(os.path.join(context.work_dir, 'clean')):
+        yield {"barcode": barcode, "page": page, "text_orig": read_optional(context.original_files().get((barcode, page))),
+               "text_clean": process_file(path)}
+
+def read_correct(context):
+    for barcode, page, path in page_files(os.path.join(context.work_dir, 'prep')):
+        yield {"barcode": barcode, "page": page, "text_orig": read_optional(context.original_files().get((barcode, page))),
+               "text_clean": read_optional(clean_path(context.work_dir, barcode, page)),
+               # Failed pages are kept in _FAILED files with their cleaned text, but are not corrected text
+               "text_prep": None if path.endswith('_FAILED.txt') else process_file(path)}
+
+def read_extract(context):
+    for batch in read_corpus(store_path(context.work_dir)).to_batches():
+        yield from batch.to_pylist()
+
+READERS = {"source": read_source, "clean": read_clean, "correct": read_correct, "extract": read_extract}
+
+
+##
+## Stages: every stage reads pages from items and hands its output pages to emit
+##
+
+def clean_stage(context, items, emit):
+    for item in items:
+        text_clean = '\n'.join(clean_book(item["text_orig"] or ''))
+        write_text(clean_path(context.work_dir, item["barcode"], item["page"]), text_clean)
+        emit(dict(item, text_clean=text_clean))
+
+def llm_stage(prompt, field, output_path):
+    """Stage that sends the cleaned text of every page to the LLM with prompt and stores the answer in field."""
+
+    def run_stage(context, items, emit):
+        def on_result(request, answer):
+            item = request["item"]
+            write_text(output_path(context.work_dir, item["barcode"], item["page"], failed=not answer),
+                       answer or request["text"])
+            emit(dict(item, **{field: answer}))
+
+        requests = ({"text": item["text_clean"] or '', "label": "empty" if is_empty(item["text_clean"] or '') else None,
+                     "item": item} for item in items)
+        client = OllamaClient(url=context.ollama_url, max_in_flight=context.max_in_flight)
+        try:
+            PagePacker(prompt, client, context.cache, on_result, context.token_budget).process(requests,
+                                                                                              context.max_in_flight)
+        finally:
+            client.close()
+
+    return run_stage
+
+def extract_stage(context, items, emit):
+    def rows():
+        for item in items:
+            yield {"barcode": item["barcode"], "page": item["page"], "iiif_link": iiif_link(item["barcode"], item["page"]),
+                   "text_clean": item.get("text_clean"), "text_orig": item.get("text_orig"),
+                   "text_prep": item.get("text_prep")}
+
+    def forward(rows):
+        for row in rows:
+            emit(row)
+            yield row
+
+    csv_rows = write_csv(rows(), csv_path(context.work_dir))
+    try:
+        write_corpus_store(forward(csv_rows), store_path(context.work_dir))
+    finally:
+        # Removes the temporary CSV if the stage did not finish
+        csv_rows.close()
+
+def index_stage(context, items, emit):
+    client = get_client(context.backend)
+    ensure_index(client, context.index_name)
+    ledger = IndexLedger(context.index_name)
+    preprocessing = settings["textPreprocessing"]
+    try:
+        batch = []
+        for row in items:
+            # Pages as numbers, as in the documents loaded from the corpus store
+            batch.append(prepare_document(dict(row, page=int(row["page"]))))
+            if len(batch) == BATCH_SIZE:
+                add_chunk_offsets(batch, TENSOR_FIELDS, preprocessing["splitLength"], preprocessing["splitOverlap"])
+                index_documents(client, context.index_name, batch, ledger)
+                for document in batch:
+                    emit(document)
+                batch = []
+        if batch:
+            add_chunk_offsets(batch, TENSOR_FIELDS, preprocessing["splitLength"], preprocessing["splitOverlap"])
+            index_documents(client, context.index_name, batch, ledger)
+            for document in batch:
+                emit(document)
+    finally:
+        ledger.close()
+
+STAGE_FUNCTIONS = {
+    "clean": clean_stage,
+    "correct": llm_stage(CORRECTION_PROMPT, "text_prep", prep_path),
+    "keywords": llm_stage(KEYWORDS_PROMPT, "keywords", keywords_path),
+    "extract": extract_stage,
+    "index": index_stage,
+}
+
+
+##
+## Running the stages
+##
+
+class PipelineCancelled(Exception):
+    pass
+
+DONE = object()
+
+class Pipeline:
+    """Runs stages on threads connected by bounded queues and stops all of them as soon as one fails."""
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.cancelled = threading.Event()
+        self.errors = []
+        self.stats = {}
+        self._threads = []
+
+    def channel(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def receive(self, channel):
+        """
+        Iterate over the pages of a channel until the stage before is done. Raises PipelineCancelled if the pipeline
+        is cancelled, so that the stage does not take the pages it got so far for its complete input.
+        """
+        while True:
+            if self.cancelled.is_set():
+                raise PipelineCancelled()
+            try:
+                item = channel.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
+
+    def _put(self, channel, item):
+        while True:
+            try:
+                channel.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                if self.cancelled.is_set():
+                    raise PipelineCancelled()
+
+    def start(self, name, function, context, items, outputs):
+        stats = self.stats[name] = {"pages": 0, "blocked_seconds": 0.0, "seconds": 0.0}
+
+        def emit(item):
+            if self.cancelled.is_set():
+                raise PipelineCancelled()
+            start = time.perf_counter()
+            for channel in outputs:
+                self._put(channel, item)
+            blocked = time.perf_counter() - start
+            stats["pages"] += 1
+            stats["blocked_seconds"] += blocked
+            metrics.inc("pipeline_pages_total", stage=name)
+            metrics.inc("pipeline_blocked_seconds_total", blocked, stage=name)
+
+        def run():
+            start = time.perf_counter()
+            try:
+                function(context, items, emit)
+            except Exception as e:
+                # Errors of other stages after a cancellation are only consequences of it
+                if not self.cancelled.is_set():
+                    self.errors.append((name, e))
+                    traceback.print_exc()
+                    self.cancelled.set()
+            finally:
+                stats["seconds"] = time.perf_counter() - start
+                for channel in outputs:
+                    try:
+                        self._put(channel, DONE)
+                    except PipelineCancelled:
+                        pass
+
+        thread = threading.Thread(target=run, name=f"stage-{name}", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def join(self):
+        try:
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(timeout=POLL_SECONDS)
+        except KeyboardInterrupt:
+            self.cancelled.set()
+            raise
+
+
+class Context:
+    """Settings of the run and resources shared by the stages."""
+
+    def __init__(self, args):
+        self.input_dir = args.input_dir
+        self.work_dir = args.work_dir
+        self.index_name = args.index_name
+        self.backend = args.backend
+        self.ollama_url = args.ollama_url
+        self.max_in_flight = args.max_in_flight
+        self.token_budget = args.token_budget
+        self.cache = None
+        self._original_files = None
+        self._lock = threading.Lock()
+
+    def original_files(self):
+        """Paths of the original OCR pages by (barcode, page)."""
+        with self._lock:
+            if self._original_files is None:
+                self._original_files = index_files(collect_files(self.input_dir))
+            return self._original_files
+
+
+def active_stages(from_stage, to_stage, skip):
+    stages = STAGES[STAGES.index(from_stage):STAGES.index(to_stage) + 1]
+    return [stage for stage in stages if stage not in skip]
+
+
+def run_pipeline(context, stages, queue_size=QUEUE_SIZE):
+    """Run the stages (in the order of STAGES) and return the Pipeline with its statistics and errors."""
+    pipeline = Pipeline(queue_size)
+    # One input channel per running stage that follows a running stage
+    channels = {stage: pipeline.channel() for stage in stages if UPSTREAM[stage] in stages}
+    for stage in stages:
+        upstream = UPSTREAM[stage]
+        items = pipeline.receive(channels[stage]) if stage in channels else READERS[upstream](context)
+        outputs = [channels[downstream] for downstream in stages if UPSTREAM[downstream] == stage]
+        pipeline.start(stage, STAGE_FUNCTIONS[stage], context, items, outputs)
+    pipeline.join()
+    return pipeline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run clean, correct, keywords, extract and index as one streaming "
+                                                 "pipeline.")
+    parser.add_argument('input_dir', help="folders of original OCR page files, one per book")
+    parser.add_argument('work_dir', help="directory of the persisted output of every stage")
+    parser.add_argument('--from-stage', choices=STAGES, default=STAGES[0],
+                        help="restart at this stage from the persisted output of the stages before it")
+    parser.add_argument('--to-stage', choices=STAGES, default=STAGES[-1], help="stop after this stage")
+    parser.add_argument('--skip', choices=STAGES, action='append', default=[], help="stage to leave out")
+    parser.add_argument('--index-name', default=INDEX_NAME)
+    parser.add_argument('--backend', choices=["marqo", "local"], default=INDEX_BACKEND)
+    parser.add_argument('--ollama-url', default=OLLAMA_URL)
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help="LLM requests in flight per stage")
+    parser.add_argument('--token-budget', type=int, default=TOKEN_BUDGET, help="tokens of page text per LLM request")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="pages waiting between two stages")
+    args = parser.parse_args()
+
+    stages = active_stages(args.from_stage, args.to_stage, args.skip)
+    if not stages:
+        parser.error("no stage to run")
+    print(f"Running {' -> '.join(stages)}")
+
+    context = Context(args)
+    if "correct" in stages or "keywords" in stages:
+        context.cache = LLMCache()
+    start = time.perf_counter()
+    try:
+        pipeline = run_pipeline(context, stages, args.queue_size)
+    finally:
+        if context.cache is not None:
+            context.cache.print_stats()
+            context.cache.close()
+    elapsed = time.perf_counter() - start
+
+    for stage, stats in pipeline.stats.items():
+        print(f"{stage:>10}: {stats['pages']:8d} pages in {stats['seconds']:8.1f} s, "
+              f"{stats['blocked_seconds']:8.1f} s waiting for the next stages")
+    print(f"Pipeline finished in {elapsed:.1f} s")
+    metrics.write_report("pipeline")
+
+    if pipeline.errors:
+        print(f"Failed stages: {', '.join(stage for stage, _ in pipeline.errors)}")
+        sys.exit(1)
@@ -0,0 +1,216 @@
+"""
+This script labels the cleaned pages before they are sent to the LLM (llm_preprocessing.py, llm_keywords.py) and
+indexed (index_data.py). It runs on the per-page clean folders that these scripts and extract_data.py read: one
+<barcode>_clean folder per book with one text file per page, e.g. 'Sonnini Z166069305/Z166069305_clean/' or the clean
+folder in the work directory of run_pipeline.py (not on the one _cleaned.txt per book written by clean_books.py).
+Pages are labelled:
+- empty: '<empty page>', statuscode/<html> pages and pages with fewer than MIN_LETTERS letters in all,
+- duplicate: near-duplicate of an earlier page (its canonical page), found with MinHash signatures of character
+  shingles and locality-sensitive hashing (estimated Jaccard similarity of at least DUPLICATE_THRESHOLD),
+- boilerplate: pages of a near-duplicate group that occurs in at least BOILERPLATE_MIN_BOOKS books (library stamps,
+  notices, blank forms),
+- unique: all other pages.
+
+Signatures are computed in parallel across processes. The LSH pass streams over the pages once and keeps one bucket
+table per band and the signatures of canonical pages only, so time and memory grow linearly with the number of pages.
+
+The labels are written to page_labels.csv in the cleaned folder. The LLM scripts do not send empty pages and send the
+canonical page's text for duplicates and boilerplate, so their answer is reused from the LLM cache. index_data.py
+drops empty and boilerplate pages and marks duplicates, whose embeddings the local backend copies from the canonical
+page.
+
+Usage:
+    python src/preprocessing/dedup_pages.py [clean_pages_dir]
+
+Code by Michela Vignoli.
+"""
+
+import csv
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from metrics import metrics
+
+cleaned_dir = 'output/path/'
+LABELS_FILE = 'page_labels.csv'
+LABEL_COLUMNS = ["path", "barcode", "page", "label", "canonical", "similarity"]
+
+MIN_LETTERS = 20
+SHINGLE_SIZE = 7
+NUM_PERM = 128
+# 16 bands of 8 rows: pages with a Jaccard similarity of about 0.7 or more share a bucket in at least one band
+BANDS = 16
+DUPLICATE_THRESHOLD = 0.8
+BOILERPLATE_MIN_BOOKS = 3
+
+# Pages per task when computing signatures in parallel
+CHUNKSIZE = 64
+
+LETTER_PATTERN = re.compile(r'[^\W\d_]')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Random odd multipliers and offsets of the multiply-shift hash functions
+_rng = np.random.default_rng(1)
+_MULTIPLIERS = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+_SHINGLE_BASE = np.uint64(1099511628211)
+
+
+def is_empty(text):
+    stripped = text.strip()
+    if stripped == '<empty page>' or stripped.startswith('statuscode') or stripped.startswith('<html>'):
+        return True
+    # Count the letters of the whole page (it may open with a table of numbers), but stop at MIN_LETTERS
+    return sum(1 for _ in islice(LETTER_PATTERN.finditer(stripped), MIN_LETTERS)) < MIN_LETTERS
+
+
+def shingle_hashes(text):
+    """Return the distinct hashes of all SHINGLE_SIZE-byte shingles of the normalized text."""
+    data = np.frombuffer(WHITESPACE_PATTERN.sub(' ', text.lower()).strip().encode('utf-8'), dtype=np.uint8)
+    size = max(min(SHINGLE_SIZE, len(data)), 1)
+    n = max(len(data) - size + 1, 1)
+    hashes = np.zeros(n, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(min(size, len(data))):
+            hashes = hashes * _SHINGLE_BASE + data[j:j + n]
+    return np.unique(hashes)
+
+
+def minhash(text):
+    """Return the MinHash signature (NUM_PERM uint32 values) of the text."""
+    hashes = shingle_hashes(text)
+    with np.errstate(over='ignore'):
+        permuted = (_MULTIPLIERS[:, None] * hashes[None, :] + _OFFSETS[:, None]) >> np.uint64(32)
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def page_signature(path):
+    """Return None for an empty page, else the MinHash signature of the page."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    return None if is_empty(text) else minhash(text)
+
+
+def page_key(path):
+    """(barcode, page) of a page file, as in extract_data.py."""
+    return os.path.basename(os.path.dirname(path))[:10], os.path.basename(path)[:5]
+
+
+class LSHIndex:
+    """Buckets of the canonical pages per band of their signatures."""
+
+    def __init__(self, bands=BANDS, threshold=DUPLICATE_THRESHOLD):
+        self.bands = bands
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def find_or_add(self, page_id, signature):
+        """
+        Return (canonical page id, similarity) if the page is a near-duplicate of a canonical page, otherwise add the
+        page as a new canonical page and return (None, 0.0).
+        """
+        band_keys = [band.tobytes() for band in np.split(signature, self.bands)]
+        best, best_similarity = None, 0.0
+        for buckets, key in zip(self.buckets, band_keys):
+            candidate = buckets.get(key)
+            if candidate is not None and candidate != best:
+                similarity = float(np.mean(self.signatures[candidate] == signature))
+                if similarity > best_similarity:
+                    best, best_similarity = candidate, similarity
+        if best is not None and best_similarity >= self.threshold:
+            return best, best_similarity
+
+        self.signatures[page_id] = signature
+        for buckets, key in zip(self.buckets, band_keys):
+            buckets.setdefault(key, page_id)
+        return None, 0.0
+
+
+def collect_pages(folder, extension='.txt'):
+    # Same stable, sorted order as the LLM scripts
+    paths = []
+    for root, subfolders, files in os.walk(folder):
+        subfolders.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files) if file.endswith(extension))
+    return paths
+
+
+def label_pages(paths, root, max_workers=None):
+    """Return one label row per page (see LABEL_COLUMNS), with paths relative to root."""
+    index = LSHIndex()
+    labels = []
+    canonical_of = []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for page_id, signature in enumerate(executor.map(page_signature, paths, chunksize=CHUNKSIZE)):
+            if signature is None:
+                labels.append(("empty", None, 0.0))
+                canonical_of.append(None)
+                continue
+            canonical, similarity = index.find_or_add(page_id, signature)
+            labels.append(("duplicate" if canonical is not None else "unique", canonical, similarity))
+            canonical_of.append(page_id if canonical is None else canonical)
+
+    # Near-duplicate groups that occur in many books are boilerplate
+    books = {}
+    for page_id, canonical in enumerate(canonical_of):
+        if canonical is not None:
+            books.setdefault(canonical, set()).add(page_key(paths[page_id])[0])
+    boilerplate = {canonical for canonical, barcodes in books.items() if len(barcodes) >= BOILERPLATE_MIN_BOOKS}
+
+    rows = []
+    for page_id, (path, (label, canonical, similarity)) in enumerate(zip(paths, labels)):
+        if canonical_of[page_id] in boilerplate:
+            label = "boilerplate"
+            canonical = canonical_of[page_id] if canonical_of[page_id] != page_id else None
+        barcode, page = page_key(path)
+        rows.append({"path": os.path.relpath(path, root), "barcode": barcode, "page": page, "label": label,
+                     "canonical": os.path.relpath(paths[canonical], root) if canonical is not None else '',
+                     "similarity": round(similarity, 3)})
+    return rows
+
+
+def write_labels(rows, labels_path):
+    tmp_path = labels_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=LABEL_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, labels_path)
+
+
+def load_labels(labels_path):
+    """Return the label rows by page path (relative to the cleaned folder), or an empty dict if there are none."""
+    if not os.path.exists(labels_path):
+        return {}
+    with open(labels_path, 'r', encoding='utf-8', newline='') as f:
+        return {row["path"]: row for row in csv.DictReader(f)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        cleaned_dir = sys.argv[1]
+
+    start = time.perf_counter()
+    paths = collect_pages(cleaned_dir)
+    rows = label_pages(paths, cleaned_dir)
+    labels_path = os.path.join(cleaned_dir, LABELS_FILE)
+    write_labels(rows, labels_path)
+    elapsed = time.perf_counter() - start
+
+    counts = {}
+    for row in rows:
+        counts[row["label"]] = counts.get(row["label"], 0) + 1
+        metrics.inc("dedup_pages_total", label=row["label"])
+    rate = len(rows) / elapsed if elapsed > 0 else 0.0
+    print(f"Labelled {len(rows)} pages in {elapsed:.1f} s ({rate:.0f} pages/s): "
+          + ', '.join(f"{count} {label}" for label, count in sorted(counts.items())))
+    print(f"Labels saved to {labels_path}")
+    metrics.set("dedup_pages_per_second", rate)
+    metrics.write_report("dedup_pages")
@@ -0,0 +1,108 @@
+"""
+Persistent SQLite cache of LLM outputs shared by llm_preprocessing.py and llm_keywords.py.
+Entries are content-addressed by a hash of the model name, the prompt template and the page text, so a rerun after a
+crash skips every page that was already answered, and changing a prompt only recomputes the pages sent with it.
+
+Code by Michela Vignoli.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = 'preprocessed/llm_cache.sqlite'
+
+# Eviction limits: entries older than MAX_AGE_DAYS are dropped, then the least recently used entries are dropped
+# until the stored responses fit into MAX_SIZE_MB
+MAX_AGE_DAYS = 180
+MAX_SIZE_MB = 1024
+
+
+def cache_key(model, prompt_template, text):
+    digest = hashlib.sha256()
+    for part in (model, prompt_template, text):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LLMCache:
+    """
+    Thread-safe key-value store of LLM responses backed by a single SQLite file.
+
+    Parameters:
+    - path (str): Location of the SQLite database file.
+    - max_age_days (float): Maximum age of an entry before it is evicted.
+    - max_size_mb (float): Maximum total size of the stored responses.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_age_days=MAX_AGE_DAYS, max_size_mb=MAX_SIZE_MB):
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._connection.commit()
+        self.evict()
+
+    def get(self, model, prompt_template, text):
+        """Return the cached response for this page and prompt, or None."""
+        key = cache_key(model, prompt_template, text)
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+        return row[0]
+
+    def put(self, model, prompt_template, text, response):
+        key = cache_key(model, prompt_template, text)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode('utf-8')), now, now),
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """Drop entries that are older than max_age_days, then the least recently used ones beyond max_size_mb."""
+        cutoff = time.time() - self.max_age_days * 86400
+        max_bytes = int(self.max_size_mb * 1024 * 1024)
+        with self._lock:
+            self._connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (cutoff,))
+            self._connection.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running"
+                " FROM llm_cache) WHERE running > ?)",
+                (max_bytes,),
+            )
+            self._connection.commit()
+
+    def print_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"LLM cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)")
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
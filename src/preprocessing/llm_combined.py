@@ -0,0 +1,118 @@
+"""
+This script parses through the cleaned texts and prompts Ollama once per page for both the corrected transcription
+(as llm_preprocessing.py) and the list of keywords (as llm_keywords.py), so that the LLM processes every page only once
+instead of twice.
+
+The LLM answers with a JSON object {"corrected": "...", "keywords": ["...", ...]} per page. The answer is validated and
+split into the outputs of the two scripts, <page>_corrected.txt in preprocessed/<folder>_preprocessed and
+<page>_keywords.txt in preprocessed/<folder>_keywords. Pages without a valid answer are sent again afterwards with the
+prompts of the two scripts, as separate requests.
+
+Code by Michela Vignoli.
+"""
+
+import json
+import os
+import sys
+from ollama_client import OllamaClient, MAX_IN_FLIGHT
+from llm_cache import LLMCache
+from page_packing import PagePacker, TOKEN_BUDGET
+import llm_keywords
+import llm_preprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from metrics import metrics
+
+PROMPT = "You are a historian expert in historical German texts. Process the following faulty OCR texts generated from historical traveolgues printed from the 17-19th century in two ways. First, correct the text: remain as closely to the original, historical wording as possible while correcting all the errors from the faulty OCR, remove the unnecessary line breaks in the pages where full sentences occur and leave the line breaks in other pages. Second, create a list of keywords summarizing the animals, plants, landscapes, and maps mentioned in the text. If animals, plants, landscapes, or maps are mentioned in the text, include the aforementioned general keywords and more specific ones afterwards. If none of these is mentioned in the text, add up to three keywords describing the content of the page. Output only a JSON object with the corrected text as a string in the field \"corrected\" and the keywords as a list of strings in the field \"keywords\", without further comments, explanations, or information.\n\n"
+
+def parse_answer(answer):
+    """
+    Validate the answer for one page and return the corrected text and the keywords, or None if it is invalid.
+    Long pages are sent in segments (see page_packing.py), so the answer can be several JSON objects in a row;
+    their corrected texts are joined with the whitespace between the objects.
+    """
+    # Models write the line breaks of the corrected text into the string as they are
+    decoder = json.JSONDecoder(strict=False)
+    corrected_parts = []
+    keywords = []
+    position = previous_end = 0
+    while True:
+        # Skip anything around the objects, e.g. a code fence
+        start = answer.find('{', position)
+        if start < 0:
+            break
+        try:
+            obj, position = decoder.raw_decode(answer, start)
+        except json.JSONDecodeError:
+            return None
+
+        corrected = obj.get("corrected") if isinstance(obj, dict) else None
+        page_keywords = obj.get("keywords") if isinstance(obj, dict) else None
+        if isinstance(page_keywords, str):
+            page_keywords = page_keywords.split(',')
+        if (not isinstance(corrected, str) or not corrected.strip() or not isinstance(page_keywords, list)
+                or not all(isinstance(keyword, str) for keyword in page_keywords)):
+            return None
+
+        if corrected_parts:
+            corrected_parts.append('\n' if '\n' in answer[previous_end:start] else ' ')
+        corrected_parts.append(corrected.strip())
+        keywords.extend(keyword.strip() for keyword in page_keywords if keyword.strip())
+        previous_end = position
+
+    if not corrected_parts or not keywords:
+        return None
+    return ''.join(corrected_parts), list(dict.fromkeys(keywords))
+
+def keywords_item(item):
+    # The same page with the output folder of llm_keywords.py
+    return dict(item, path=item["path"][:-len('_preprocessed')] + '_keywords')
+
+def process_txt(root_folder, max_in_flight=MAX_IN_FLIGHT, token_budget=TOKEN_BUDGET):
+    # Stream text files from the root folder while the walk is still running
+    pages = llm_preprocessing.get_data(root_folder)
+    client = OllamaClient(max_in_flight=max_in_flight)
+    cache = LLMCache()
+    # Pages without a valid combined answer
+    fallback = []
+
+    def save_result(item, answer):
+        if item.get("label") == "empty":
+            # Not sent to the LLM, saved as is by both scripts
+            llm_preprocessing.save_result(item, answer)
+            llm_keywords.save_result(keywords_item(item), answer)
+            return
+
+        parsed = parse_answer(answer) if answer else None
+        if parsed is None:
+            metrics.inc("combined_pages_total", result="fallback")
+            fallback.append(item)
+            return
+        corrected_text, keywords = parsed
+        metrics.inc("combined_pages_total", result="ok")
+        llm_preprocessing.save_result(item, corrected_text)
+        llm_keywords.save_result(keywords_item(item), ', '.join(keywords))
+
+    try:
+        # Only valid answers are cached, so reruns send the pages without a valid answer again
+        PagePacker(PROMPT, client, cache, save_result, token_budget,
+                   validate=lambda answer: parse_answer(answer) is not None).process(pages, max_in_flight)
+
+        if fallback:
+            print(f"{len(fallback)} pages without a valid answer, sending them with the separate prompts")
+            PagePacker(llm_preprocessing.PROMPT, client, cache, llm_preprocessing.save_result,
+                       token_budget).process(fallback, max_in_flight)
+            PagePacker(llm_keywords.PROMPT, client, cache, llm_keywords.save_result,
+                       token_budget).process([keywords_item(item) for item in fallback], max_in_flight)
+    finally:
+        client.close()
+        cache.print_stats()
+        metrics.inc("llm_cache_hits_total", cache.hits)
+        metrics.inc("llm_cache_misses_total", cache.misses)
+        cache.close()
+        metrics.write_report("llm_combined")
+
+# Example usage
+if __name__ == '__main__':
+    root_folder = 'source/folder/'
+    process_txt(root_folder)
@@ -0,0 +1,165 @@
+"""
+Shared Ollama client for the LLM preprocessing scripts (llm_preprocessing.py and llm_keywords.py).
+Requests are sent in-process over a small pool of persistent HTTP connections instead of forking one cURL subprocess
+per page, and a thread pool keeps a configurable number of requests in flight on the Ollama server.
+Request latencies, retries and failures are recorded in the metrics of the run (see metrics.py).
+
+Code by Michela Vignoli.
+"""
+
+import json
+import http.client
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from metrics import metrics
+
+OLLAMA_URL = 'http://your.ip:port/api/generate'
+MODEL = "llama3.1:70b"
+
+# Number of requests sent to the Ollama server at the same time
+MAX_IN_FLIGHT = 4
+
+
+def extract_corrected_text(raw_response):
+    # Split the response by newline to handle multiple JSON objects
+    lines = raw_response.strip().split('\n')
+    response_segments = []
+
+    # Process each line as a JSON object
+    for line in lines:
+        try:
+            json_obj = json.loads(line)
+            response_segment = json_obj.get('response', '')
+            response_segments.append(response_segment)
+        except json.JSONDecodeError:
+            print(f"Skipping invalid JSON line: {line}")
+
+    # Join all response segments into a single text
+    full_text = ''.join(response_segments)
+    return full_text
+
+
+class OllamaClient:
+    """
+    Thread-safe client for the Ollama /api/generate endpoint with a pool of keep-alive connections.
+
+    Parameters:
+    - url (str): Full URL of the generate endpoint.
+    - model (str): Name of the model to prompt.
+    - max_in_flight (int): Maximum number of concurrent requests (and pooled connections).
+    - timeout (float): Socket timeout in seconds for a single request.
+    """
+
+    def __init__(self, url=OLLAMA_URL, model=MODEL, max_in_flight=MAX_IN_FLIGHT, timeout=600):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/api/generate'
+        self.https = parts.scheme == 'https'
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _post(self, payload):
+        connection = self._get_connection()
+        try:
+            connection.request('POST', self.path, body=json.dumps(payload).encode('utf-8'),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            body = response.read().decode('utf-8')
+        except Exception:
+            # Drop broken connections instead of returning them to the pool
+            connection.close()
+            raise
+        self._pool.put(connection)
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {body[:200]}")
+        return body
+
+    def generate(self, prompt, retries=3, options=None):
+        """
+        Send a prompt and return the concatenated response text, or None if all attempts failed.
+        options are passed to Ollama as model parameters, e.g. {"num_ctx": 8192}.
+        """
+        payload = {"model": self.model, "prompt": prompt}
+        if options:
+            payload["options"] = options
+        for attempt in range(retries):
+            if attempt:
+                metrics.inc("llm_retries_total")
+            start = time.perf_counter()
+            try:
+                raw_response = self._post(payload)
+            except Exception as e:
+                metrics.observe("llm_request_seconds", time.perf_counter() - start, status="error")
+                print(f"Attempt {attempt + 1} of {retries}: LLM request failed with error: {e}")
+                time.sleep(2)  # Wait before retrying
+                continue
+
+            text = extract_corrected_text(raw_response)
+            if text:
+                metrics.observe("llm_request_seconds", time.perf_counter() - start, status="ok")
+                metrics.inc("llm_prompt_characters_total", len(prompt))
+                metrics.inc("llm_response_characters_total", len(text))
+                return text
+
+            metrics.observe("llm_request_seconds", time.perf_counter() - start, status="invalid")
+            print(f"Attempt {attempt + 1} of {retries}: Invalid response, retrying...")
+            time.sleep(2)  # Wait before retrying
+
+        metrics.inc("llm_failures_total")
+        print("Failed to get a valid response from the LLM API.")
+        return None
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def run_concurrently(items, process_item, on_result, max_in_flight=MAX_IN_FLIGHT, unit="pages"):
+    """
+    Run process_item over items on a thread pool and hand every result to on_result as soon as it completes.
+    At most max_in_flight items are submitted at any time. Prints the throughput in items (unit) per second at the end.
+
+    Returns:
+    - int: The number of processed items.
+    """
+    start = time.perf_counter()
+    processed = 0
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(lambda item=item: (item, process_item(item))))
+            if len(pending) >= max_in_flight:
+                done = next(as_completed(pending))
+                pending.remove(done)
+                on_result(*done.result())
+                processed += 1
+        for done in as_completed(pending):
+            on_result(*done.result())
+            processed += 1
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    metrics.inc("processed_total", processed, unit=unit)
+    metrics.set("throughput_per_second", rate, unit=unit)
+    print(f"Processed {processed} {unit} in {elapsed:.1f} s ({rate:.2f} {unit}/s)")
+    return processed
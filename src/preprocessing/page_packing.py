@@ -0,0 +1,230 @@
+"""
+Packs several pages into one LLM request up to a token budget, for llm_preprocessing.py and llm_keywords.py.
+
+Short pages (title pages, '<empty page>', ...) are sent together in one prompt, each between the lines <<<PAGE n>>> and
+<<<END PAGE n>>>, and the answer is split back per page by the same delimiters. Pages longer than the budget are split
+at sentence boundaries into segments that are sent separately and rejoined afterwards. No page is silently dropped:
+a page whose answer is missing from a packed response is resent on its own, and a page that still fails is handed to
+on_result with None (and saved as _FAILED by the scripts).
+
+Answers are cached per page (or segment) under the prompt of the script, so reruns skip every page that was already
+answered, whatever it was packed with. Identical texts are only sent once while they are in flight. Pages labelled
+'empty' by dedup_pages.py are not sent at all, and near-duplicates carry the text of their canonical page
+('canonical_text'), so they reuse its answer.
+
+Code by Michela Vignoli.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_right
+from ollama_client import run_concurrently, MAX_IN_FLIGHT
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'indexing'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from sentence_chunker import split_sentences
+from metrics import metrics
+
+# Ollama truncates prompts to the context window (num_ctx, 2048 tokens by default), so every request sets it
+NUM_CTX = 8192
+# Tokens of page text per request; a corrected page is about as long as the input, so prompt, input and answer
+# fit into NUM_CTX
+TOKEN_BUDGET = 3000
+MAX_PAGES_PER_REQUEST = 16
+# Rough length of a token in characters for (noisy) German text
+CHARS_PER_TOKEN = 3
+
+PACKING_INSTRUCTIONS = "The input consists of several separate pages. Each page starts with a line <<<PAGE n>>> and ends with a line <<<END PAGE n>>>. Process every page separately as described above and output the result for every page between the same two lines, in the same order, without any text outside of them.\n\n"
+PAGE_OUTPUT_PATTERN = re.compile(r'<<<\s*PAGE\s+(\d+)\s*>>>(.*?)<<<\s*END\s+PAGE\s+\1\s*>>>', re.DOTALL | re.IGNORECASE)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def split_page(text, budget=TOKEN_BUDGET):
+    """
+    Split a page into consecutive segments of at most budget tokens, at sentence boundaries where possible.
+
+    Returns:
+    - tuple: The segments (stripped) and the separators to put between their answers when rejoining them.
+    """
+    max_chars = budget * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text], []
+
+    sentence_starts = [start for start, _ in split_sentences(text)]
+    pieces = []
+    start = 0
+    while len(text) - start > max_chars:
+        limit = start + max_chars
+        # Cut at the last sentence start before the limit, else at the last whitespace, else hard
+        k = bisect_right(sentence_starts, limit) - 1
+        cut = sentence_starts[k] if k >= 0 and sentence_starts[k] > start else text.rfind(' ', start + 1, limit + 1)
+        if cut <= start:
+            cut = limit
+        pieces.append(text[start:cut])
+        start = cut
+    pieces.append(text[start:])
+
+    separators = []
+    for piece, next_piece in zip(pieces, pieces[1:]):
+        gap = piece[len(piece.rstrip()):] + next_piece[:len(next_piece) - len(next_piece.lstrip())]
+        separators.append('\n' if '\n' in gap else ' ' if gap else '')
+    return [piece.strip() for piece in pieces], separators
+
+
+class PagePacker:
+    """
+    Sends pages to the LLM in packed requests and hands every page with its answer to on_result(item, answer).
+
+    Parameters:
+    - prompt (str): The prompt of the script, followed by the page text(s).
+    - client (OllamaClient): The client used for all requests.
+    - cache (LLMCache): Cache of the answers per page text.
+    - on_result (callable): Called with the page item and its (rejoined) answer, or None if it failed.
+    - budget (int): Maximum number of tokens of page text per request.
+    - max_pages (int): Maximum number of pages (or segments) per request.
+    - validate (callable): Returns whether an answer for one page (or segment) is valid; invalid answers are still
+      handed to on_result, but they are neither cached nor taken from the cache.
+    """
+
+    def __init__(self, prompt, client, cache, on_result, budget=TOKEN_BUDGET, max_pages=MAX_PAGES_PER_REQUEST,
+                 validate=None):
+        self.prompt = prompt
+        self.client = client
+        self.cache = cache
+        self.on_result = on_result
+        self.budget = budget
+        self.max_pages = max_pages
+        self.validate = validate
+        self.options = {"num_ctx": NUM_CTX}
+        self._pages = {}
+        # Pages (page id, segment number) waiting for the answer to each text that is in flight
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self.stats = {"pages": 0, "empty": 0, "segments": 0, "cached": 0, "reused": 0, "requests": 0, "resent": 0}
+
+    ##
+    ## Planning
+    ##
+
+    def requests(self, items):
+        """Yield lists of texts (pages or segments) that fit into one request each, while reading the items."""
+        batch = []
+        batch_tokens = 0
+        for page_id, item in enumerate(items):
+            self.stats["pages"] += 1
+            if item.get("label") == "empty":
+                # Nothing to correct or summarize on empty pages
+                self.stats["empty"] += 1
+                self.on_result(item, item["text"])
+                continue
+
+            segments, separators = split_page(item.get("canonical_text") or item["text"], self.budget)
+            self._pages[page_id] = {"item": item, "answers": [None] * len(segments), "separators": separators,
+                                    "remaining": len(segments), "failed": False}
+            self.stats["segments"] += len(segments)
+
+            for segment_number, segment in enumerate(segments):
+                cached = self.cache.get(self.client.model, self.prompt, segment)
+                if cached is not None and self._valid(cached):
+                    self.stats["cached"] += 1
+                    self._complete(page_id, segment_number, cached)
+                    continue
+                if segment in self._waiting:
+                    self.stats["reused"] += 1
+                    self._waiting[segment].append((page_id, segment_number))
+                    continue
+                self._waiting[segment] = [(page_id, segment_number)]
+                tokens = estimate_tokens(segment)
+                if batch and (batch_tokens + tokens > self.budget or len(batch) >= self.max_pages):
+                    self.stats["requests"] += 1
+                    yield batch
+                    batch, batch_tokens = [], 0
+                batch.append(segment)
+                batch_tokens += tokens
+        if batch:
+            self.stats["requests"] += 1
+            yield batch
+
+    ##
+    ## Requests (run on the worker threads)
+    ##
+
+    def _valid(self, answer):
+        return self.validate is None or self.validate(answer)
+
+    def _generate(self, text):
+        answer = self.client.generate(self.prompt + text, options=self.options)
+        if answer and self._valid(answer):
+            self.cache.put(self.client.model, self.prompt, text, answer)
+        return answer
+
+    def run(self, batch):
+        """Send one request and return the answer for every entry of the batch (None if it failed)."""
+        if len(batch) == 1:
+            return [self._generate(batch[0])]
+
+        packed = ''.join(f"<<<PAGE {n}>>>\n{text}\n<<<END PAGE {n}>>>\n\n" for n, text in enumerate(batch, 1))
+        response = self.client.generate(self.prompt + PACKING_INSTRUCTIONS + packed, options=self.options) or ''
+        answers = {int(n): answer.strip() for n, answer in PAGE_OUTPUT_PATTERN.findall(response)}
+
+        results = []
+        for n, text in enumerate(batch, 1):
+            answer = answers.get(n)
+            if answer:
+                if self._valid(answer):
+                    self.cache.put(self.client.model, self.prompt, text, answer)
+            else:
+                # Missing from the packed answer: resend the page on its own
+                with self._lock:
+                    self.stats["resent"] += 1
+                answer = self._generate(text)
+            results.append(answer)
+        return results
+
+    ##
+    ## Reassembly (on the main thread)
+    ##
+
+    def _complete(self, page_id, segment_number, answer):
+        page = self._pages[page_id]
+        page["answers"][segment_number] = answer
+        page["failed"] = page["failed"] or not answer
+        page["remaining"] -= 1
+        if page["remaining"] == 0:
+            del self._pages[page_id]
+            if page["failed"]:
+                self.on_result(page["item"], None)
+            else:
+                answers = page["answers"]
+                joined = answers[0] + ''.join(separator + answer
+                                              for separator, answer in zip(page["separators"], answers[1:]))
+                self.on_result(page["item"], joined)
+
+    def collect(self, batch, answers):
+        for text, answer in zip(batch, answers):
+            for page_id, segment_number in self._waiting.pop(text):
+                self._complete(page_id, segment_number, answer)
+
+    def process(self, items, max_in_flight=MAX_IN_FLIGHT):
+        """Pack the pages into requests, send them concurrently and hand every page to on_result."""
+        start = time.perf_counter()
+        run_concurrently(self.requests(items), self.run, self.collect, max_in_flight, unit="requests")
+        elapsed = time.perf_counter() - start
+        stats = self.stats
+        for name, value in stats.items():
+            metrics.inc(f"packed_{name}_total", value)
+
+        # Throughput in pages, comparable between runs with different packing
+        rate = stats["pages"] / elapsed if elapsed > 0 else 0.0
+        metrics.inc("processed_total", stats["pages"], unit="pages")
+        metrics.set("throughput_per_second", rate, unit="pages")
+        print(f"Processed {stats['pages']} pages in {elapsed:.1f} s ({rate:.2f} pages/s)")
+        print(f"Packed {stats['pages']} pages ({stats['empty']} empty, {stats['segments']} segments, {stats['cached']} "
+              f"cached, {stats['reused']} reused) into {stats['requests']} requests, {stats['resent']} segments were "
+              f"resent on their own")
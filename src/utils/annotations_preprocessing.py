@@ -2,91 +2,195 @@
 This script matches the text annotations created on the original OCR files to the cleaned version of the text.
 The annotations were created with Recogito https://recogito.pelagios.org/.
 
+Every Recogito export in exports_dir is matched to the merged OCR file of its book in merged_dir (by the barcode in
+the FILE column), the reports are processed in parallel across processes, and all annotations are written to one
+consolidated, typed table (Parquet) with UUID, barcode, page, tags as a list and character offsets.
+
 Code by Michela Vignoli. Parts of this code were developed with assistance from GPT-4 and GPT-3 (free version).
 """
 
 ## Import packages ##
 
+import numpy as np
 import pandas as pd
+import csv
 import os
 import re
-from typing import Union
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple, Union
 
 
-## Import annotations from Recogito ##
+## Directories ##
 
-path_1 = "source/path/"
-filename_1 = 'jiggvn0g5pgx34.csv'
+exports_dir = "source/path/"
+merged_dir = "source/path/"
+output_file = "output/path/annotations.parquet"
 
-# Function to reformat the labels
-def reformat_labels(label_str):
-    labels = str(label_str).split('|')  # Split the string by '|'
-    reformatted = ', '.join([f"'{label}'" for label in labels])  # Enclose each label in ''
-    return reformatted
+RECOGITO_COLUMNS = ["UUID", "FILE", "QUOTE_TRANSCRIPTION", "ANCHOR", "COMMENTS", "TAGS"]
+BARCODE_PATTERN = re.compile(r'(Z\d{8,9})')
 
-df1 = pd.read_csv(os.path.join(path_1, filename_1))[["UUID", "FILE", "QUOTE_TRANSCRIPTION", "ANCHOR", "COMMENTS", "TAGS"]]
 
-# Apply the function to the 'labels' column
-df1['TAGS'] = df1['TAGS'].apply(reformat_labels)
+## Import annotations from Recogito ##
+
+# Function to find all Recogito exports in a folder
+def discover_exports(folder: str) -> List[str]:
+    """
+    Finds all CSV files in the folder (and its subfolders) whose header has the columns of a Recogito export.
+    """
+    exports = []
+    for root, _, files in os.walk(folder):
+        for file in sorted(files):
+            if not file.endswith('.csv'):
+                continue
+            path = os.path.join(root, file)
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                header = next(csv.reader(f), [])
+            if set(RECOGITO_COLUMNS) <= set(header):
+                exports.append(path)
+    return exports
+
+def merged_text_path(barcode: str) -> str:
+    return os.path.join(merged_dir, f"{barcode}_clean_merged.txt")
 
 
 ## Extract page numbers from merged OCR text file ##
 
-# Read the entire text file into a single string
-with open('source/path/Z255430508_clean_merged.txt', 'r', encoding='utf-8') as file1:
-    text_content1 = file1.read()
+PAGE_MARKER_PATTERN = re.compile(r'page(\d+)')
 
-
-# Function to find a number in the preceding character sequence
-def find_number_before_position(text: str, position: int, search_length: int = 10000) -> Union[str, str]:
+# Function to index all page markers of a merged text in one pass
+def build_page_index(text: str) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Finds the last number following 'page' in the text preceding or succeeding the given position.
+    Finds all 'page' markers in the text.
 
     Parameters:
-    - text (str): The full text to search within.
-    - position (int): The position in the text to search around.
-    - search_length (int): The length of text to search before or after the position.
+    - text (str): The full merged text.
 
     Returns:
-    - Union[str, str]: The last number found after 'page' in the preceding or succeeding text,
-                        or a warning message "Warning: No matches found. Check!" if no match is found.
+    - Tuple[np.ndarray, np.ndarray]: The sorted end offsets of the markers and their page numbers (as strings).
     """
     if not isinstance(text, str):
         raise ValueError("text must be a string")
+
+    ends = []
+    numbers = []
+    for match in PAGE_MARKER_PATTERN.finditer(text):
+        ends.append(match.end())
+        numbers.append(match.group(1))
+    return np.array(ends, dtype=np.int64), np.array(numbers, dtype=object)
+
+# Function to find the page numbers of many positions at once
+def find_pages(page_index: Tuple[np.ndarray, np.ndarray], positions) -> np.ndarray:
+    """
+    Finds the number of the last 'page' marker preceding each position with a binary search over the marker offsets.
+    For position 0 the first marker in the text is used.
+
+    Parameters:
+    - page_index (Tuple[np.ndarray, np.ndarray]): The marker index from build_page_index.
+    - positions (array-like): Character positions in the text; NaN or negative positions are not resolved.
+
+    Returns:
+    - np.ndarray: The page number found for each position, or "Check!" if there is no marker to refer to.
+    """
+    ends, numbers = page_index
+    positions = np.asarray(positions, dtype=np.float64)
+    result = np.full(len(positions), "Check!", dtype=object)
+    valid = ~np.isnan(positions) & (positions >= 0)
+
+    # Number of markers that end at or before each position
+    preceding = np.searchsorted(ends, np.where(valid, positions, 0), side='right')
+
+    before = valid & (positions > 0) & (preceding > 0)
+    result[before] = numbers[preceding[before] - 1]
+    if len(numbers):
+        result[valid & (positions == 0)] = numbers[0]
+    return result
+
+# Function to find a number in the preceding character sequence
+def find_number_before_position(text: str, position: int) -> Union[str, str]:
+    """
+    Finds the last number following 'page' in the text preceding the given position (or the first one for position 0).
+    To resolve many positions in the same text, use build_page_index and find_pages instead.
+
+    Returns:
+    - Union[str, str]: The page number, or a warning message "Check!" if no match is found.
+    """
     if not isinstance(position, int) or position < 0:
         raise ValueError("position must be a non-negative integer")
-    if not isinstance(search_length, int) or search_length < 0:
-        raise ValueError("search_length must be a non-negative integer")
-    
-    if position == 0:
-        # Search after the position
-        following_text = text[position:position + search_length]
-        matches = re.findall(r'page(\d+)', following_text)
-        if matches:
-            return matches[0]  # Return the first match found
-        else:
-            return "Check!"
-    else:
-        # Search before the position
-        start_position = max(0, position - search_length)
-        preceding_text = text[start_position:position]
-        matches = re.findall(r'page(\d+)', preceding_text)
-        if matches:
-            return matches[-1]  # Return the last match found
-        else:
-            return "Check!"
-
-# Apply the function to each row in the DataFrames
-df1['PAGE'] = pd.to_numeric(df1['ANCHOR'].str.extract(r'(\d+)')[0], errors='coerce').apply(lambda x: find_number_before_position(text_content1, x))
-
-
-## Annotation analysis ##
-
-# Split the labels by '|' and flatten the list of lists into a single list
-all_labels = df1['TAGS'].str.split(', ').sum()
-
-# Count the occurrences of each label
-label_counts = pd.Series(all_labels).value_counts()
-
-print(label_counts)
+    return find_pages(build_page_index(text), [position])[0]
 
+## Process one report ##
+
+def process_report(export_path: str) -> Tuple[str, pd.DataFrame, float]:
+    """
+    Reads a Recogito export and resolves the page of every annotation in the merged OCR text of its book.
+
+    Returns:
+    - Tuple[str, pd.DataFrame, float]: The export path, the typed annotation table and the processing time in seconds.
+    """
+    start = time.perf_counter()
+    df = pd.read_csv(export_path)[RECOGITO_COLUMNS]
+    df['BARCODE'] = df['FILE'].astype(str).str.extract(BARCODE_PATTERN, expand=False)
+    df['CHAR_START'] = pd.to_numeric(df['ANCHOR'].str.extract(r'(\d+)')[0], errors='coerce')
+    df['PAGE'] = "Check!"
+
+    # Resolve the pages of all annotations of a book in one vectorized lookup
+    for barcode, rows in df.groupby('BARCODE').groups.items():
+        merged_path = merged_text_path(barcode)
+        if not os.path.exists(merged_path):
+            print(f"No merged text for {barcode} ({export_path}), pages are not resolved")
+            continue
+        # Read the entire text file into a single string
+        with open(merged_path, 'r', encoding='utf-8') as file:
+            text_content = file.read()
+        df.loc[rows, 'PAGE'] = find_pages(build_page_index(text_content), df.loc[rows, 'CHAR_START'])
+
+    quotes = df['QUOTE_TRANSCRIPTION'].fillna('').astype(str)
+    annotations = pd.DataFrame({
+        "uuid": df['UUID'].astype('string'),
+        "barcode": df['BARCODE'].astype('string'),
+        "page": pd.to_numeric(df['PAGE'], errors='coerce').astype('Int32'),
+        "tags": df['TAGS'].apply(lambda tags: [] if pd.isna(tags) else str(tags).split('|')),
+        "char_start": df['CHAR_START'].astype('Int64'),
+        "char_end": (df['CHAR_START'] + quotes.str.len()).astype('Int64'),
+        "quote": df['QUOTE_TRANSCRIPTION'].astype('string'),
+        "comments": df['COMMENTS'].astype('string'),
+        "export_file": os.path.basename(export_path),
+    })
+    return export_path, annotations, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    exports = discover_exports(exports_dir)
+    print(f"Found {len(exports)} Recogito exports")
+    if not exports:
+        sys.exit(f"No Recogito exports (CSV files with the columns {', '.join(RECOGITO_COLUMNS)}) found in "
+                 f"{os.path.abspath(exports_dir)}, check exports_dir")
+
+    run_start = time.perf_counter()
+    tables = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(process_report, export_path) for export_path in exports]
+        for future in as_completed(futures):
+            export_path, annotations, seconds = future.result()
+            barcodes = ', '.join(annotations['barcode'].dropna().unique())
+            unresolved = annotations['page'].isna().sum()
+            print(f"{os.path.basename(export_path)} ({barcodes}): {len(annotations)} annotations, "
+                  f"{unresolved} unresolved pages, {seconds:.2f} s")
+            tables.append(annotations)
+
+    # Write one consolidated annotation table
+    all_annotations = pd.concat(tables, ignore_index=True).sort_values(['barcode', 'page', 'char_start'])
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    all_annotations.to_parquet(output_file, index=False)
+    print(f"{len(all_annotations)} annotations from {len(exports)} reports written to {output_file} "
+          f"in {time.perf_counter() - run_start:.1f} s")
+
+
+    ## Annotation analysis ##
+
+    # Flatten the lists of labels into a single list and count the occurrences of each label
+    label_counts = all_annotations['tags'].explode().value_counts()
+
+    print(label_counts)
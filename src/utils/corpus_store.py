@@ -0,0 +1,136 @@
+"""
+Columnar corpus store that replaces the wide index CSV (e.g. data/indices/DHd_index-cleaned.csv).
+Pages are stored as Parquet files partitioned by barcode, so readers can memory-map the files, load only the columns
+they need (e.g. just text_clean) and filter by barcode or page range without parsing the rest of the corpus.
+
+Convert an existing index CSV into a store:
+    python src/utils/corpus_store.py data/indices/DHd_index-cleaned.csv data/indices/DHd_index-cleaned/
+
+Code by Michela Vignoli.
+"""
+
+import csv
+import os
+import shutil
+import sys
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+SCHEMA = pa.schema([
+    ("barcode", pa.string()),
+    ("page", pa.int32()),
+    ("iiif_link", pa.string()),
+    ("text_clean", pa.string()),
+    ("text_orig", pa.string()),
+    ("text_prep", pa.string()),
+])
+
+# Number of pages per record batch when writing
+BATCH_SIZE = 1024
+
+
+def _to_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        record = {name: row.get(name) or None for name in SCHEMA.names}
+        # Pages are stored as numbers so that page ranges can be filtered
+        record["page"] = int(row["page"])
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield pa.RecordBatch.from_pylist(batch, schema=SCHEMA)
+            batch = []
+    if batch:
+        yield pa.RecordBatch.from_pylist(batch, schema=SCHEMA)
+
+
+def write_corpus_store(rows, store_dir, batch_size=BATCH_SIZE):
+    """
+    Write an iterable of page rows (dicts with the keys of SCHEMA) to a Parquet store partitioned by barcode.
+    The rows are consumed as a stream, so the corpus never has to fit into memory.
+    Partitions of barcodes that occur in rows are replaced, all other partitions are kept. The rows are written to a
+    staging directory first and only replace the partitions once all rows were written, so an interrupted write (or
+    an exception raised by rows) leaves the store as it was.
+    """
+    staging_dir = os.path.normpath(store_dir) + '.tmp'
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    errors = []
+
+    def batches():
+        # pyarrow can leave a native thread behind if the iterator fails, so end the iteration normally and raise
+        # the error after the write
+        try:
+            yield from _to_batches(rows, batch_size)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        ds.write_dataset(
+            batches(),
+            staging_dir,
+            schema=SCHEMA,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("barcode", pa.string())]), flavor="hive"),
+        )
+        if errors:
+            raise errors[0]
+        os.makedirs(store_dir, exist_ok=True)
+        partitions = sorted(os.listdir(staging_dir)) if os.path.isdir(staging_dir) else []
+        for partition in partitions:
+            target = os.path.join(store_dir, partition)
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(os.path.join(staging_dir, partition), target)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def open_corpus_store(store_dir):
+    """Open the store as a memory-mapped pyarrow dataset."""
+    return ds.dataset(
+        store_dir,
+        schema=SCHEMA,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("barcode", pa.string())]), flavor="hive"),
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def read_corpus(store_dir, columns=None, barcodes=None, page_range=None):
+    """
+    Read selected columns and pages from the store.
+
+    Parameters:
+    - store_dir (str): Directory of the store.
+    - columns (list): Columns to load, all columns if None.
+    - barcodes (list): Only load pages of these barcodes.
+    - page_range (tuple): Only load pages from page_range[0] to page_range[1] (inclusive).
+
+    Returns:
+    - pyarrow.Table: The selected pages, e.g. convert with .to_pylist() or .to_pandas().
+    """
+    dataset = open_corpus_store(store_dir)
+    conditions = []
+    if barcodes is not None:
+        conditions.append(ds.field("barcode").isin(list(barcodes)))
+    if page_range is not None:
+        first_page, last_page = page_range
+        conditions.append((ds.field("page") >= first_page) & (ds.field("page") <= last_page))
+
+    filter_expression = None
+    for condition in conditions:
+        filter_expression = condition if filter_expression is None else filter_expression & condition
+
+    return dataset.to_table(columns=columns, filter=filter_expression)
+
+
+def csv_to_corpus_store(csv_file, store_dir):
+    """Convert an index CSV as written by extract_data.py into a corpus store."""
+    # Page texts can be longer than the default field size limit
+    csv.field_size_limit(sys.maxsize)
+    with open(csv_file, mode='r', encoding='utf-8', newline='') as file:
+        write_corpus_store(csv.DictReader(file), store_dir)
+
+
+if __name__ == '__main__':
+    csv_to_corpus_store(sys.argv[1], sys.argv[2])
+    print(f"Corpus store written to {sys.argv[2]}")
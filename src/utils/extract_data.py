@@ -1,13 +1,32 @@
 """
-This script creates a CSV with all data to be indexed on the Marqo server.
+This script creates a CSV and a columnar corpus store (Parquet, partitioned by barcode, see corpus_store.py) with all
+data to be indexed on the Marqo server.
+
+The clean, orig and prep variants of every page are read concurrently on a thread pool and the combined rows are
+streamed to the CSV writer, so the combined data is never held in memory as a whole. The stage timings are also
+recorded in the metrics of the run (see metrics.py).
 
 Code by Michela Vignoli. Parts of this code were developed with assistance from GPT-4 and GPT-3 (free version).
 """
 
 import os
 import csv
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import chardet
 from tqdm import tqdm
+from corpus_store import write_corpus_store
+from metrics import metrics
+
+# Number of bytes passed to chardet when a file is not valid UTF-8
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Number of threads reading files
+MAX_WORKERS = 8
+
+FIELDNAMES = ["barcode", "page", "iiif_link", "text_clean", "text_orig", "text_prep"]
 
 # Helper function to get all file paths with a specific extension in a folder
 def collect_files(folder, extension=".txt"):
@@ -21,37 +40,77 @@ def collect_files(folder, extension=".txt"):
 # Function to process files and extract their text
 def process_file(file_path):
     try:
-        # Detect encoding
         with open(file_path, 'rb') as f:
-            result = chardet.detect(f.read())
-            encoding = result['encoding']
-
-        # Read the file
-        with open(file_path, 'r', encoding=encoding) as f:
-            return f.read()
+            raw = f.read()
+
+        # Almost all files are UTF-8, only detect the encoding of the others
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+
+        # Detect encoding on a bounded sample, and on the whole file if the sample guessed wrong
+        encoding = chardet.detect(raw[:ENCODING_SAMPLE_SIZE])['encoding'] or 'utf-8'
+        try:
+            return raw.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            pass
+        encoding = chardet.detect(raw)['encoding'] or 'utf-8'
+        try:
+            return raw.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            # Never drop a page: keep the text with the undecodable bytes replaced
+            print(f"Undecodable bytes in {file_path} ({encoding}), replacing them")
+            return raw.decode('utf-8', errors='replace')
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return None
 
-# Combine data from clean, orig, and prep folders
-def combine_data(clean_files, orig_files, prep_files):
-    combined_data = []
+def iiif_link(barcode, page):
+    page_url = page[:5].zfill(8)
+    return f"https://iiif.onb.ac.at/images/ABO/{barcode}/{page_url}/full/full/0/native.jpg"
 
-    # Index files by (barcode, page) for matching
-    def index_files(files):
-        indexed = {}
-        for file in files:
-            barcode = os.path.basename(os.path.dirname(file))[:10]
-            page = os.path.basename(file)[:5]
-            indexed[(barcode, page)] = file
-        return indexed
+# Index files by (barcode, page) for matching
+def index_files(files):
+    indexed = {}
+    for file in files:
+        barcode = os.path.basename(os.path.dirname(file))[:10]
+        page = os.path.basename(file)[:5]
+        indexed[(barcode, page)] = file
+    return indexed
+
+class StageTimer:
+    """Accumulates the wall-clock time spent in each stage of the run."""
 
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        metrics.inc("extract_step_seconds_total", seconds, step=stage)
+
+    def report(self):
+        for stage, seconds in self.timings.items():
+            print(f"{stage:>20}: {seconds:8.2f} s")
+
+# Combine data from clean, orig, and prep folders
+def combine_data(clean_files, orig_files, prep_files, max_workers=MAX_WORKERS, timer=None):
+    """
+    Yield one combined row per (barcode, page) of the clean files, in the order of clean_files.
+    The text variants are read on a thread pool, with a bounded number of pages read ahead.
+    """
+    timer = timer or StageTimer()
+
+    start = time.perf_counter()
     clean_index = index_files(clean_files)
     orig_index = index_files(orig_files)
     prep_index = index_files(prep_files)
+    timer.add("indexing files", time.perf_counter() - start)
 
-    # Process files and combine data
-    for key in tqdm(clean_index.keys(), desc="Combining data", unit="file"):
+    def read_row(key):
+        start = time.perf_counter()
         clean_file = clean_index.get(key)
         orig_file = orig_index.get(key)
         prep_file = prep_index.get(key)
@@ -63,48 +122,86 @@ def combine_data(clean_files, orig_files, prep_files):
 
         # Add combined data row
         barcode, page = key
-        page_url = page[:5].zfill(8)
-        iiif_link = f"https://iiif.onb.ac.at/images/ABO/{barcode}/{page_url}/full/full/0/native.jpg"
-
-        combined_data.append({
+        row = {
             "barcode": barcode,
             "page": page,
-            "iiif_link": iiif_link,
+            "iiif_link": iiif_link(barcode, page),
             "text_clean": text_clean,
             "text_orig": text_orig,
             "text_prep": text_prep,
-        })
-
-    return combined_data
-
-# Lists of folders to process
-clean_folders = [
-    'source/path/DHd 2025 dataset/Sonnini Z166069305/Z166069305_clean/',
-]
-orig_folders = [
-    "source/path/02-texts/D19/Z166069305",
-]
-prep_folders = [
-    'source/path/DHd 2025 dataset/Sonnini Z166069305/Z166069305_clean_preprocessed/',
-]
-
-# Collect file paths
-clean_files = [file for folder in clean_folders for file in collect_files(folder)]
-orig_files = [file for folder in orig_folders for file in collect_files(folder)]
-prep_files = [file for folder in prep_folders for file in collect_files(folder)]
-
-# Combine data from all folders
-all_data = combine_data(clean_files, orig_files, prep_files)
-
-# Specify the file path and create the directory if it does not exist
-csv_file = 'output/path/DHd_index.csv'
-os.makedirs(os.path.dirname(csv_file), exist_ok=True)
-
-# Write data to CSV file
-with open(csv_file, mode='w', newline='', encoding='utf-8') as file:
-    writer = csv.DictWriter(file, fieldnames=["barcode", "page", "iiif_link", "text_clean", "text_orig", "text_prep"])
-    writer.writeheader()
-    writer.writerows(all_data)
+        }
+        timer.add("reading files", time.perf_counter() - start)
+        return row
+
+    # Keep a bounded window of pending reads and yield the rows in order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for key in clean_index:
+            pending.append(executor.submit(read_row, key))
+            if len(pending) >= max_workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_csv(rows, csv_file, timer=None):
+    """
+    Write the rows to csv_file as they arrive and pass every row on to the next stage.
+    The rows are written to a temporary file that only replaces csv_file once all rows were written, so an
+    interrupted run keeps the previous CSV.
+    """
+    timer = timer or StageTimer()
+    os.makedirs(os.path.dirname(csv_file) or '.', exist_ok=True)
+
+    tmp_file = csv_file + '.tmp'
+    try:
+        with open(tmp_file, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            for row in rows:
+                start = time.perf_counter()
+                writer.writerow(row)
+                timer.add("writing CSV", time.perf_counter() - start)
+                metrics.inc("extract_pages_total")
+                yield row
+        os.replace(tmp_file, csv_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+if __name__ == '__main__':
+    # Lists of folders to process
+    clean_folders = [
+        'source/path/DHd 2025 dataset/Sonnini Z166069305/Z166069305_clean/',
+    ]
+    orig_folders = [
+        "source/path/02-texts/D19/Z166069305",
+    ]
+    prep_folders = [
+        'source/path/DHd 2025 dataset/Sonnini Z166069305/Z166069305_clean_preprocessed/',
+    ]
+
+    timer = StageTimer()
+    run_start = time.perf_counter()
+
+    # Collect file paths
+    start = time.perf_counter()
+    clean_files = [file for folder in clean_folders for file in collect_files(folder)]
+    orig_files = [file for folder in orig_folders for file in collect_files(folder)]
+    prep_files = [file for folder in prep_folders for file in collect_files(folder)]
+    timer.add("collecting files", time.perf_counter() - start)
+
+    # Specify the output paths and stream the combined data from all folders into the CSV and the corpus store
+    csv_file = 'output/path/DHd_index.csv'
+    store_dir = 'output/path/DHd_index/'
+    rows = tqdm(write_csv(combine_data(clean_files, orig_files, prep_files, timer=timer), csv_file, timer=timer),
+                desc="Combining data", unit="file")
+    write_corpus_store(rows, store_dir)
+    timer.add("total (wall clock)", time.perf_counter() - run_start)
+
+    print(f"{rows.n} pages from all folders have been written to {csv_file} and {store_dir}")
+    # Reading runs on several threads, so its time is summed over all threads
+    timer.report()
+    metrics.write_report("extract_data")
 
 #### IMPORTANT ####
 #### Data Cleaning Needed after storing the file ####
@@ -123,6 +220,4 @@ index_DHd.loc[rows_to_update, columns_to_check] = "<empty page>
 # Remove artifacts from the LLM generation process
 index_DHd['text_prep'] = index_DHd['text_prep'].str.strip("Here is the corrected text:")
 
-""""
-
-print(f"Data from all folders has been written to {csv_file}")
\ No newline at end of file
+"""
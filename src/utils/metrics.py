@@ -0,0 +1,249 @@
+"""
+Lightweight instrumentation shared by the pipeline scripts: counters, gauges, timers and latency histograms.
+
+Metrics are disabled unless the environment variable ONIT_METRICS_DIR names a report directory (or enable() is called).
+Disabled, every call returns right after checking one flag and timers are a shared no-op context manager, so the
+instrumentation can stay in the hot paths. Enabled, every stage (script) writes a run report to the report directory
+with write_report(stage):
+- <stage>.json: duration, counters (with their rate per second), gauges and histograms with p50/p90/p99 latencies,
+- <stage>.prom: the same metrics in the Prometheus text format (e.g. for the node exporter textfile collector).
+
+Metric names follow the Prometheus conventions (counters end in _total, durations are in seconds); labels are passed
+as keyword arguments, e.g. metrics.inc("llm_requests_total", status="error").
+
+    from metrics import metrics
+
+    with metrics.timer("index_batch_seconds"):
+        ...
+    metrics.inc("index_documents_total", len(batch))
+    metrics.write_report("index_data")
+
+Code by Michela Vignoli.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+METRICS_DIR_VARIABLE = 'ONIT_METRICS_DIR'
+PREFIX = 'onit_'
+
+# Upper bounds of the histogram buckets in seconds: 1 ms to about 17 minutes, in steps of sqrt(2)
+DEFAULT_BUCKETS = tuple(round(0.001 * 2 ** (i / 2), 6) for i in range(41))
+QUANTILES = (0.5, 0.9, 0.99)
+
+INVALID_NAME_PATTERN = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+class Histogram:
+    """Counts of the observed values per bucket, with sum, minimum and maximum."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the q-quantile by linear interpolation within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                # Only the observed range of the bucket
+                lower = max(self.buckets[i - 1], self.min) if i > 0 else self.min
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        summary = {"count": self.count, "sum": self.sum,
+                   "min": self.min if self.count else None, "max": self.max if self.count else None,
+                   "mean": self.sum / self.count if self.count else None}
+        summary.update({f"p{round(q * 100)}": self.quantile(q) for q in QUANTILES})
+        return summary
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def format_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}' if labels else ''
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of the metrics of one process.
+
+    Parameters:
+    - report_dir (str): Directory of the run reports; metrics are disabled if it is None.
+    """
+
+    def __init__(self, report_dir=None):
+        self._lock = threading.Lock()
+        self.enable(report_dir)
+
+    def enable(self, report_dir):
+        """(Re)start recording, with reports written to report_dir, or stop recording if report_dir is None."""
+        self.report_dir = report_dir
+        self.enabled = report_dir is not None
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    ##
+    ## Recording
+    ##
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[metric_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Context manager that observes its duration in seconds in the histogram name."""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name, labels)
+
+    ##
+    ## Reports
+    ##
+
+    def report(self, stage):
+        """Return the run report of the stage as a dict."""
+        duration = time.perf_counter() - self._start
+        with self._lock:
+            counters = {name + format_labels(labels): value for (name, labels), value in sorted(self.counters.items())}
+            gauges = {name + format_labels(labels): value for (name, labels), value in sorted(self.gauges.items())}
+            histograms = {name + format_labels(labels): histogram.summary()
+                          for (name, labels), histogram in sorted(self.histograms.items())}
+        return {
+            "stage": stage,
+            "started_at": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            "duration_seconds": duration,
+            "counters": counters,
+            "rates_per_second": {name: value / duration if duration > 0 else 0.0 for name, value in counters.items()},
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def prometheus_text(self, stage):
+        """Return the metrics in the Prometheus text exposition format, with the label stage on every sample."""
+        lines = []
+        stage_label = (('stage', stage),)
+        with self._lock:
+            duration = time.perf_counter() - self._start
+            lines.append(f"# TYPE {PREFIX}run_duration_seconds gauge")
+            lines.append(f"{PREFIX}run_duration_seconds{format_labels(stage_label)} {duration}")
+
+            for metric_type, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    full_name = PREFIX + INVALID_NAME_PATTERN.sub('_', name)
+                    if full_name not in typed:
+                        lines.append(f"# TYPE {full_name} {metric_type}")
+                        typed.add(full_name)
+                    lines.append(f"{full_name}{format_labels(stage_label + labels)} {value}")
+
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                full_name = PREFIX + INVALID_NAME_PATTERN.sub('_', name)
+                if full_name not in typed:
+                    lines.append(f"# TYPE {full_name} histogram")
+                    typed.add(full_name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{format_labels(stage_label + labels + (('le', bound),))} "
+                                 f"{cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(stage_label + labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{format_labels(stage_label + labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, stage):
+        """Write <stage>.json and <stage>.prom to the report directory; return the path of the JSON report."""
+        if not self.enabled:
+            return None
+        os.makedirs(self.report_dir, exist_ok=True)
+        json_path = os.path.join(self.report_dir, f"{stage}.json")
+        for path, content in ((json_path, json.dumps(self.report(stage), indent=1)),
+                              (os.path.join(self.report_dir, f"{stage}.prom"), self.prometheus_text(stage))):
+            # Write to a temporary file first, so that a collector never reads a half-written report
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        print(f"Metrics of {stage} written to {json_path}")
+        return json_path
+
+
+# Registry of the process, enabled by the environment variable ONIT_METRICS_DIR
+metrics = MetricsRegistry(os.environ.get(METRICS_DIR_VARIABLE) or None)
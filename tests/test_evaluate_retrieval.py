@@ -0,0 +1,29 @@
+"""
+Tests of the retrieval evaluation (src/analysis/evaluate_retrieval.py) on the result files shipped in
+data/retrieval_results/.
+
+Code by Michela Vignoli.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'analysis'))
+from evaluate_retrieval import CUTOFFS, PageKeys, evaluate, load_all_relevance, load_runs
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def test_shipped_results_have_metrics(monkeypatch):
+    # The paths of the script are relative to the repository root
+    monkeypatch.chdir(REPO_ROOT)
+    keys = PageKeys()
+    relevance = load_all_relevance(keys)
+    runs, ranked = load_runs("data/retrieval_results/", keys, max(CUTOFFS))
+    metrics = evaluate(runs, ranked, relevance)
+
+    assert set(metrics["variant"]) == {"clean", "prep", "orig"}
+    assert (metrics["relevant"] > 0).all()
+    metric_columns = [column for column in metrics.columns if "@" in column or column == "mrr"]
+    assert metrics[metric_columns].notna().all().all()
+    assert (metrics["recall@100"] > 0).all()
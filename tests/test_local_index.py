@@ -0,0 +1,55 @@
+"""
+Tests of the filter strings of the local index (src/indexing/local_index.py).
+
+Code by Michela Vignoli.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'indexing'))
+from local_index import LocalClient, parse_filter_string
+
+
+def fake_embed(texts):
+    # Deterministic vectors, one per text, so no model has to be loaded
+    vectors = np.array([np.random.default_rng(sum(map(ord, text))).normal(size=8) for text in texts], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def index(tmp_path):
+    client = LocalClient(root=str(tmp_path), embed=fake_embed)
+    client.create_index('test')
+    index = client.index('test')
+    index.add_documents([{"_id": f"{barcode}_{page}", "barcode": barcode, "page": page,
+                          "text": f"Ein Pferd auf Seite {page}."}
+                         for barcode in ("Z1", "Z2") for page in (1, 2)], tensor_fields=["text"])
+    return index
+
+
+def found(response):
+    return sorted(hit["_id"] for hit in response["hits"])
+
+
+def test_parse_filter_string():
+    assert parse_filter_string(None) is None
+    assert parse_filter_string('barcode:(Z1) OR barcode:(Z2) AND page:(2)') == [
+        [('barcode', 'Z1')], [('barcode', 'Z2'), ('page', '2')]]
+
+
+@pytest.mark.parametrize('filter_string', ['barcode:(Z1) NOT page:(2)', 'barcode:(Z1) page:(2)',
+                                           'barcode:(Z1) AND', 'OR barcode:(Z1)', 'barcode:Z1'])
+def test_unsupported_filter_string(filter_string):
+    with pytest.raises(ValueError):
+        parse_filter_string(filter_string)
+
+
+def test_and_filter(index):
+    for search_method in ("TENSOR", "LEXICAL"):
+        assert found(index.search("Pferd", filter_string='barcode:(Z1) AND page:(2)',
+                                  search_method=search_method)) == ['Z1_2']
+        assert found(index.search("Pferd", filter_string='barcode:(Z1) OR barcode:(Z2) AND page:(2)',
+                                  search_method=search_method)) == ['Z1_1', 'Z1_2', 'Z2_2']